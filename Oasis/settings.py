@@ -45,6 +45,7 @@ INSTALLED_APPS = [
     'post',
     'favorites',
     'recommend',
+    'push',
 ]
 
 MIDDLEWARE = [
@@ -130,6 +131,15 @@ END_POINT = "oss-cn-beijing.aliyuncs.com"
 BUCKET_NAME = "oasis-story"
 ALIYUN_OSS_CNAME = ""
 BUCKET_ACL_TYPE = "public-read"  # private, public-read, public-read-write
+# 超过10MB的文件分片上传 每片1MB 同时上传4片
+OSS_MULTIPART_THRESHOLD = 10 * 1024 * 1024
+OSS_PART_SIZE = 1024 * 1024
+OSS_UPLOAD_THREADS = 4
+# 进程内缓存的OSS文件元信息数量与有效期(秒)
+OSS_METADATA_CACHE_SIZE = 10000
+OSS_METADATA_CACHE_TTL = 24 * 60 * 60
+# 进程内缓存的文件地址数量 有效期同文件元信息
+MEDIA_URL_CACHE_SIZE = 10000
 
 DEFAULT_FILE_STORAGE = 'common.storage.AliyunMediaStorage'
 
@@ -145,6 +155,29 @@ IM_SECRET = 'Ff30v0CPgU'
 MAX_IMAGE_SIZE = 2097152
 MAX_VIDEO_SIZE = 20971520
 MAX_FILE_SIZE = 20971520
+# 批量上传时同时上传的文件数
+FILE_UPLOAD_THREADS = 4
+# 分片上传的分片大小 OSS要求除最后一片外不小于100KB
+UPLOAD_PART_SIZE = 1024 * 1024
+# 存储不支持分片上传时分片的本地暂存目录
+UPLOAD_SPOOL_DIR = os.path.join(BASE_DIR, 'spool')
+# 超过该时间(秒)未完成的分片上传由clear_upload_sessions清理
+UPLOAD_SESSION_EXPIRE = 24 * 60 * 60
+# 直传OSS表单的有效期(秒) 客户端需在有效期内上传并确认
+UPLOAD_POLICY_EXPIRE = 10 * 60
+# 图片缩略图尺寸 {尺寸名: (宽, 高)} 按比例裁剪到固定尺寸
+THUMBNAIL_SIZES = {
+    'small': (100, 100),
+    'medium': (480, 480),
+}
+# 缩略图格式 WEBP或JPEG Pillow不支持WebP时使用JPEG
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_QUALITY = 80
+# 生成缩略图的进程数
+THUMBNAIL_PROCESSES = 2
+
+# 附近帖子的最大检索距离(km)
+NEARBY_MAX_DISTANCE = 100
 
 # REST_FRAMEWORK设置
 REST_FRAMEWORK = {
@@ -208,6 +241,8 @@ CONSTANCE_BACKEND = 'constance.backends.database.DatabaseBackend'
 CONSTANCE_IGNORE_ADMIN_VERSION_CHECK = True
 
 SENSITIVE_WORD = '敏感词'
+# 各进程检查敏感词是否更新的间隔(秒)
+SENSITIVE_WORD_CHECK_INTERVAL = 5
 CONSTANCE_CONFIG = OrderedDict([
     (SENSITIVE_WORD, ('', '以中文或英文逗号隔开')),
 ])
@@ -215,6 +250,18 @@ CONSTANCE_CONFIG_FIELDSETS = OrderedDict([
     ('敏感词', (SENSITIVE_WORD,)),
 ])
 
+# 推送队列 由push_worker发送
+# 最大尝试次数
+PUSH_MAX_ATTEMPTS = 5
+# 首次重试间隔(秒) 之后每次翻倍
+PUSH_RETRY_DELAY = 30
+# 最大重试间隔(秒)
+PUSH_MAX_RETRY_DELAY = 3600
+# 领取后超过该时间(秒)未完成视为发送进程退出 重新发送
+PUSH_CLAIM_TIMEOUT = 300
+# 合并窗口(秒) 同一用户同一分组在窗口内的推送合并为一条
+PUSH_COALESCE_WINDOW = 60
+
 # 输出日志
 LOG_PATH = os.path.join(BASE_DIR, "log/")
 DJANGO_LOG = os.path.dirname(LOG_PATH + 'django.log')
@@ -8,7 +8,7 @@ from django.conf.urls.static import static
 from rest_framework.routers import DefaultRouter
 from rest_framework_jwt.views import refresh_jwt_token, verify_jwt_token
 
-from user.views import UserViewSet, FileViewSet, AgreementViewSet
+from user.views import UserViewSet, FileViewSet, UploadSessionViewSet, AgreementViewSet
 from friend.views import FriendViewSet
 from follow.views import FollowViewSet
 from post.views import PostViewSet, CommentViewSet
@@ -19,6 +19,7 @@ router = DefaultRouter()
 router.register(r'user', UserViewSet, base_name='user')
 # 文件
 router.register(r'file', FileViewSet)
+router.register(r'upload', UploadSessionViewSet)
 # 协议
 router.register(r'agreement', AgreementViewSet)
 # 好友
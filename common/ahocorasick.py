@@ -0,0 +1,71 @@
+from collections import deque
+
+
+class AhoCorasick(object):
+    """
+    Aho-Corasick多模式匹配自动机
+    构建后一次扫描文本即可找出全部命中的词 耗时与词库大小无关
+    """
+
+    def __init__(self, words):
+        # 每个节点: 转移表 失配指针 以该节点结尾的词
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for word in words:
+            if word:
+                self._add(word)
+        self._build()
+
+    def _add(self, word):
+        node = 0
+        for char in word:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        if word not in self._output[node]:
+            self._output[node].append(word)
+
+    def _build(self):
+        # 广度优先设置失配指针 并合并失配节点上的词
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self._goto[node].items():
+                queue.append(next_node)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_node] = fail if fail != next_node else 0
+                self._output[next_node] = self._output[next_node] + self._output[self._fail[next_node]]
+
+    def iter(self, text):
+        """
+        :param text: 文本
+        :return: 依次产出 (结束位置, 命中的词)
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for word in output[node]:
+                yield index, word
+
+    def findall(self, text):
+        """
+        :param text: 文本
+        :return: 文本中出现的全部词(去重 按首次出现顺序)
+        """
+        words = []
+        for index, word in self.iter(text):
+            if word not in words:
+                words.append(word)
+        return words
@@ -1,5 +1,5 @@
 import jpush
-from jpush.common import Unauthorized, APIConnectionException, JPushFailure
+from jpush.common import Unauthorized, APIConnectionException, JPushFailure, PUSH_URL
 
 from .exception import PushError
 
@@ -12,11 +12,21 @@ master_secret = u'd2a89afb0b1251ea19f7b0d5'
 _jpush = jpush.JPush(app_key, master_secret)
 _jpush.set_logging("DEBUG")
 
+# 推送接口地址 压测时指向本地服务
+push_url = PUSH_URL
+# 单次推送最多的别名数
+MAX_ALIAS = 1000
+
 
 def audience(alias, title, msg_content, extras=None):
+    """
+    :param alias: 别名 或别名列表(不超过MAX_ALIAS个) 一次请求推送给多个用户
+    """
+    aliases = alias if isinstance(alias, (list, tuple)) else [alias]
     push = _jpush.create_push()
+    push.url = push_url
     push.audience = jpush.audience(
-        jpush.alias(alias),
+        jpush.alias(*aliases),
     )
     push.message = jpush.message(msg_content, title=title, extras=extras)
     push.platform = jpush.all_
@@ -32,3 +42,11 @@ def audience(alias, title, msg_content, extras=None):
         raise PushError("Exception:{}".format(str(e)), 3)
 
 
+def audience_async(alias, title, msg_content, extras=None, group='', summary=''):
+    """
+    写入推送队列 由push_worker在后台发送 请求中不等待极光接口
+    :param group: 合并分组 如'post_like:1' 同一用户同组的推送在合并窗口内合并为一条
+    :param summary: 合并后的内容 {others}为其余推送数 如'用户A和其他{others}人赞了您的帖子'
+    """
+    from push.models import Push
+    return Push.enqueue(alias, title, msg_content, extras, group, summary)
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 
 
 # 未被删除的管理器
@@ -24,3 +25,34 @@ class Base(models.Model):
 
     class Meta:
         abstract = True
+
+
+# 点赞计数 模型需有likes多对多字段和likes_count字段
+class LikesCountMixin(object):
+    def like(self, user):
+        """
+        点赞并原子递增likes_count
+        :param user: 点赞用户
+        :return: 是否新增点赞
+        """
+        with transaction.atomic():
+            # 锁定被点赞的记录 同一用户并发点赞只计数一次
+            type(self).all.select_for_update().filter(pk=self.pk).first()
+            if self.likes.filter(pk=user.pk).exists():
+                return False
+            self.likes.add(user)
+            type(self).all.filter(pk=self.pk).update(likes_count=F('likes_count') + 1)
+            return True
+
+    def unlike(self, user):
+        """
+        取消点赞并原子递减likes_count
+        :param user: 取消点赞用户
+        :return: 是否取消了点赞
+        """
+        with transaction.atomic():
+            deleted, _ = self.likes.through.objects.filter(**{self.likes.source_field_name: self,
+                                                              self.likes.target_field_name: user}).delete()
+            if deleted:
+                type(self).all.filter(pk=self.pk).update(likes_count=F('likes_count') - deleted)
+            return deleted != 0
@@ -1,7 +1,14 @@
+import json
+import base64
+import binascii
+from datetime import datetime
 from collections import OrderedDict
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django.core.paginator import Paginator, InvalidPage
+from django.core.exceptions import ValidationError, FieldDoesNotExist
+from django.db.models import Q, F
 
 
 # 屏蔽UnorderedObjectListWarning
@@ -20,17 +27,28 @@ class Pagination(PageNumberPagination):
     page_number = 1
     page_size_query_param = 'page_size'
     max_page_size = 100
+    # 游标分页参数 带有该参数时使用游标分页
+    cursor_query_param = 'cursor'
+    # 游标分页默认排序 视图可用cursor_ordering覆盖 末位须为唯一且非空的字段
+    cursor_ordering = ('-id',)
+    cursor = None
+    # 排序字段中可为空的字段 空值排在最后
+    cursor_nullable = ()
 
     def paginate_queryset(self, queryset, request, view=None):
         """
         使用page_size参数限制每页条数
         超出页码范围返回第一页
         最后一页页码用last表示
+        带cursor参数时使用游标分页
         """
         page_size = self.get_page_size(request)
         if not page_size:
             return None
 
+        if self.cursor_query_param in request.query_params:
+            return self.paginate_queryset_cursor(queryset, request, page_size, view)
+
         paginator = self.django_paginator_class(queryset, page_size)
         self.page_number = request.query_params.get(self.page_query_param, 1)
         if self.page_number in self.last_page_strings:
@@ -50,6 +68,94 @@ class Pagination(PageNumberPagination):
         self.request = request
         return list(self.page)
 
+    def paginate_queryset_cursor(self, queryset, request, page_size, view=None):
+        """
+        游标分页 按cursor_ordering排序 以上一页最后一条记录的排序字段值定位下一页
+        不执行COUNT(*)和OFFSET 非法游标返回第一页
+        """
+        self.request = request
+        self.cursor_ordering = getattr(view, 'cursor_ordering', self.cursor_ordering)
+        self.cursor_nullable = [field.lstrip('-') for field in self.cursor_ordering
+                                if queryset.model._meta.get_field(field.lstrip('-')).null]
+        queryset = queryset.order_by(*self.get_cursor_order_by())
+
+        values = self.decode_cursor(queryset.model, request.query_params[self.cursor_query_param])
+        if values is not None:
+            queryset = queryset.filter(self.get_cursor_filter(values))
+
+        # 多取一条判断是否有下一页
+        results = list(queryset[:page_size + 1])
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.cursor = self.encode_cursor(results[-1])
+        else:
+            self.cursor = ''
+        return results
+
+    def get_cursor_order_by(self):
+        """
+        可为空的字段显式将空值排在最后 各数据库默认的空值顺序不同
+        """
+        order_by = []
+        for field in self.cursor_ordering:
+            name = field.lstrip('-')
+            if name not in self.cursor_nullable:
+                order_by.append(field)
+            elif field.startswith('-'):
+                order_by.append(F(name).desc(nulls_last=True))
+            else:
+                order_by.append(F(name).asc(nulls_last=True))
+        return order_by
+
+    def get_cursor_filter(self, values):
+        """
+        (a, b) 降序时 a < va or (a = va and b < vb)
+        a可为空时空值排在最后: va非空时 a < va 包含 a为空; va为空时没有排在其后的a 只比较b
+        """
+        condition = Q()
+        for index, field in enumerate(self.cursor_ordering):
+            name = field.lstrip('-')
+            if values[index] is None:
+                continue
+            lookup = '{}__lt' if field.startswith('-') else '{}__gt'
+            q = Q(**{lookup.format(name): values[index]})
+            if name in self.cursor_nullable:
+                q |= Q(**{'{}__isnull'.format(name): True})
+            for prev_field, prev_value in zip(self.cursor_ordering[:index], values[:index]):
+                prev_name = prev_field.lstrip('-')
+                if prev_value is None:
+                    q &= Q(**{'{}__isnull'.format(prev_name): True})
+                else:
+                    q &= Q(**{prev_name: prev_value})
+            condition |= q
+        return condition
+
+    def encode_cursor(self, instance):
+        values = []
+        for field in self.cursor_ordering:
+            value = getattr(instance, field.lstrip('-'))
+            values.append(value.isoformat() if isinstance(value, datetime) else value)
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, model, cursor):
+        """
+        :return: 排序字段值列表 空游标或非法游标返回None
+        """
+        if not cursor:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            if not isinstance(values, list) or len(values) != len(self.cursor_ordering):
+                return None
+            # 只有可为空的字段可以为空
+            if any(value is None and field.lstrip('-') not in self.cursor_nullable
+                   for field, value in zip(self.cursor_ordering, values)):
+                return None
+            return [None if value is None else model._meta.get_field(field.lstrip('-')).to_python(value)
+                    for field, value in zip(self.cursor_ordering, values)]
+        except (ValueError, TypeError, binascii.Error, ValidationError, FieldDoesNotExist):
+            return None
+
     def get_page_size(self, request):
         """
         page_size > 0 使用新page_size
@@ -75,6 +181,8 @@ class Pagination(PageNumberPagination):
         :param data: 
         :return: 
         """
+        if self.cursor is not None:
+            return self.get_cursor_paginated_response(data)
         return Response({'code': 0, 'msg': '', 'data': OrderedDict([
             ('count', self.page.paginator.count),
             ('page_num', self.page.paginator.num_pages),
@@ -83,3 +191,17 @@ class Pagination(PageNumberPagination):
             ('previous', self.get_previous_link() if self.get_previous_link() else ''),
             ('results', data)
         ])})
+
+    def get_cursor_paginated_response(self, data):
+        """
+        cursor 下一页游标 为空时表示没有下一页
+        next 下一页链接
+        """
+        next_link = ''
+        if self.cursor:
+            next_link = replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.cursor)
+        return Response({'code': 0, 'msg': '', 'data': OrderedDict([
+            ('cursor', self.cursor),
+            ('next', next_link),
+            ('results', data)
+        ])})
@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from django.db import models
 from rest_framework import serializers
 from rest_framework.fields import SkipField
 
@@ -82,3 +83,28 @@ class ModelSerializer(serializers.ModelSerializer):
             if field not in ['request', 'view', 'format']:
                 ret[field] = self.context[field]
         return ret
+
+
+# 列表序列化 整页一次查询当前用户点赞过的对象
+class LikedListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, models.Manager) else data)
+        user = getattr(self.context.get('request'), 'user', None)
+        if user is not None and user.is_authenticated and iterable:
+            model = self.child.Meta.model
+            self.child.liked_ids = set(model._base_manager.filter(pk__in=[item.pk for item in iterable], likes=user)
+                                       .values_list('pk', flat=True))
+        else:
+            self.child.liked_ids = set()
+        return [self.child.to_representation(item) for item in iterable]
+
+
+# 是否已点赞 Meta中需设置list_serializer_class = LikedListSerializer
+class LikedSerializerMixin(object):
+    liked_ids = None
+
+    def get_is_liked(self, instance):
+        if self.liked_ids is not None:
+            return instance.pk in self.liked_ids
+        user = self.context['request'].user
+        return user.is_authenticated and instance.likes.filter(pk=user.pk).exists()
@@ -1,14 +1,23 @@
 import os
+import hmac
+import json
+import base64
+import hashlib
 
 import datetime
 import six
+import time
 import posixpath
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from urllib.parse import urljoin
 
 from django.core.files import File
 from django.utils.encoding import force_text, filepath_to_uri, force_bytes
-from oss2 import Auth, Service, BucketIterator, Bucket, ObjectIterator
+from oss2 import Auth, Service, BucketIterator, Bucket, ObjectIterator, determine_part_size
+from oss2.models import PartInfo
 from oss2.exceptions import AccessDenied
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured, SuspiciousOperation
@@ -25,6 +34,52 @@ class AliyunOperationError(Exception):
         return repr(self.value)
 
 
+class MetadataCache(object):
+    """
+    进程内的OSS文件元信息LRU缓存 文件名唯一且上传后不修改 减少head_object请求
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        :param max_size: 最多缓存的文件数
+        :param ttl: 缓存有效期(秒)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: {'size': 大小, 'last_modified': 修改时间戳} 未缓存或已过期时返回None
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, **metadata):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None and item[0] >= time.time():
+                metadata = dict(item[1], **metadata)
+            self._items[key] = (time.time() + self.ttl, metadata)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+metadata_cache = MetadataCache(settings.OSS_METADATA_CACHE_SIZE, settings.OSS_METADATA_CACHE_TTL)
+
+
 class BucketOperationMixin(object):
     def _get_bucket(self, auth):
         if self.cname:
@@ -58,20 +113,44 @@ class AliyunBaseStorage(BucketOperationMixin, Storage):
         self.end_point = _normalize_endpoint(self._get_config('END_POINT').strip())
         self.bucket_name = self._get_config('BUCKET_NAME')
         self.cname = self._get_config('ALIYUN_OSS_CNAME')
-
+        # 超过该大小(字节)的文件使用分片上传
+        self.multipart_threshold = int(self._get_config('OSS_MULTIPART_THRESHOLD'))
+        # 分片大小(字节)
+        self.part_size = int(self._get_config('OSS_PART_SIZE'))
+        # 同时上传的分片数 单个文件上传时最多占用part_size*upload_threads内存
+        self.upload_threads = int(self._get_config('OSS_UPLOAD_THREADS'))
+
+        # 不在初始化时访问OSS 创建Bucket与设置权限使用 python manage.py init_bucket
         self.auth = Auth(self.access_key_id, self.access_key_secret)
-        self.service = Service(self.auth, self.end_point)
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self._get_bucket(self.auth)
+        return self._bucket
 
+    @property
+    def service(self):
+        return Service(self.auth, self.end_point)
+
+    def provision_bucket(self):
+        """
+        Bucket不存在时创建 存在时检查权限是否与BUCKET_ACL_TYPE一致
+        :return: created 已创建 checked 已检查权限 denied 启用了RAM访问策略 无法列举和创建Bucket
+        """
         try:
             if self.bucket_name not in self._list_bucket(self.service):
                 # create bucket if not exists
-                self.bucket = self._create_bucket(self.auth)
+                self._bucket = self._create_bucket(self.auth)
+                return 'created'
             else:
                 # change bucket acl if not consists
-                self.bucket = self._check_bucket_acl(self._get_bucket(self.auth))
+                self._check_bucket_acl(self.bucket)
+                return 'checked'
         except AccessDenied:
             # 当启用了RAM访问策略，是不允许list和create bucket的
-            self.bucket = self._get_bucket(self.auth)
+            return 'denied'
 
     def _get_config(self, name):
         """
@@ -137,26 +216,147 @@ class AliyunBaseStorage(BucketOperationMixin, Storage):
         target_name = self._get_target_name(name)
 
         content.open()
-        content_str = b''.join(chunk for chunk in content.chunks())
-        self.bucket.put_object(target_name, content_str)
+        size = content.size
+        if size >= self.multipart_threshold:
+            self._multipart_upload(target_name, content, size)
+        else:
+            # 边读边传 不在内存中拼接整个文件
+            self.bucket.put_object(target_name, content)
         content.close()
+        metadata_cache.set(target_name, size=size)
 
         return self._clean_name(name)
 
+    def _multipart_upload(self, target_name, content, size):
+        """
+        分片上传 并行上传upload_threads个分片 内存中最多同时存在upload_threads个分片
+        :param target_name: OSS文件名
+        :param content: 文件
+        :param size: 文件大小
+        """
+        part_size = determine_part_size(size, preferred_size=self.part_size)
+        upload_id = self.bucket.init_multipart_upload(target_name).upload_id
+        slots = threading.BoundedSemaphore(self.upload_threads)
+        futures = []
+
+        def upload_part(part_number, data):
+            try:
+                result = self.bucket.upload_part(target_name, upload_id, part_number, data)
+                return PartInfo(part_number, result.etag, size=len(data))
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(self.upload_threads) as executor:
+                part_number = 1
+                while True:
+                    # 等待有空闲的上传线程再读取下一个分片
+                    slots.acquire()
+                    if any(future.done() and future.exception() for future in futures):
+                        slots.release()
+                        break
+                    data = content.read(part_size)
+                    if not data:
+                        slots.release()
+                        break
+                    futures.append(executor.submit(upload_part, part_number, data))
+                    part_number += 1
+            parts = [future.result() for future in futures]
+            self.bucket.complete_multipart_upload(target_name, upload_id, parts)
+        except Exception:
+            self.bucket.abort_multipart_upload(target_name, upload_id)
+            raise
+
+    def get_post_policy(self, name, max_size, expire):
+        """
+        生成直传OSS的POST表单 上传内容不经过应用服务器
+        :param name: 文件名
+        :param max_size: 允许上传的最大字节数
+        :param expire: 有效期(秒)
+        :return: {'url': 上传地址, 'fields': 表单字段} 上传时文件放在最后一个字段file中
+        """
+        key = self._get_target_name(name)
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(seconds=expire)
+        policy = base64.b64encode(json.dumps({
+            'expiration': expiration.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'conditions': [
+                {'bucket': self.bucket_name},
+                ['eq', '$key', key],
+                ['content-length-range', 1, max_size],
+            ],
+        }).encode()).decode()
+        signature = base64.b64encode(hmac.new(self.access_key_secret.encode(), policy.encode(),
+                                              hashlib.sha1).digest()).decode()
+        return {
+            'url': self.bucket._make_url(self.bucket_name, ''),
+            'fields': {
+                'key': key,
+                'OSSAccessKeyId': self.access_key_id,
+                'policy': policy,
+                'Signature': signature,
+                'success_action_status': '201',
+            },
+        }
+
+    def init_multipart_upload(self, name):
+        """
+        开始分片上传 分片上传会话接口
+        :param name: 文件名
+        :return: upload_id
+        """
+        return self.bucket.init_multipart_upload(self._get_target_name(name)).upload_id
+
+    def upload_part(self, name, upload_id, part_number, data, md5):
+        """
+        上传一个分片 OSS按Content-MD5校验分片内容
+        :param md5: 分片内容的md5(十六进制)
+        :return: etag
+        """
+        headers = {'Content-MD5': base64.b64encode(bytes.fromhex(md5)).decode()}
+        return self.bucket.upload_part(self._get_target_name(name), upload_id, part_number, data,
+                                       headers=headers).etag
+
+    def complete_multipart_upload(self, name, upload_id, parts):
+        """
+        :param parts: [(分片序号, etag, 大小)]
+        :return: 文件名
+        """
+        target_name = self._get_target_name(name)
+        self.bucket.complete_multipart_upload(target_name, upload_id,
+                                              [PartInfo(number, etag) for number, etag, size in parts])
+        metadata_cache.set(target_name, size=sum(size for number, etag, size in parts))
+        return self._clean_name(name)
+
+    def abort_multipart_upload(self, name, upload_id):
+        self.bucket.abort_multipart_upload(self._get_target_name(name), upload_id)
+
     def get_file_header(self, name):
         name = self._get_target_name(name)
-        return self.bucket.head_object(name)
+        header = self.bucket.head_object(name)
+        metadata_cache.set(name, size=header.content_length, last_modified=header.last_modified)
+        return header
+
+    def get_metadata(self, name, field):
+        """
+        优先从缓存中获取文件元信息
+        :param field: size 或 last_modified
+        """
+        metadata = metadata_cache.get(self._get_target_name(name))
+        if metadata and field in metadata:
+            return metadata[field]
+        return getattr(self.get_file_header(name), 'content_length' if field == 'size' else field)
 
     def exists(self, name):
-        return self.bucket.object_exists(name)
+        target_name = self._get_target_name(name)
+        if metadata_cache.get(target_name) is not None:
+            return True
+        return self.bucket.object_exists(target_name)
 
     def size(self, name):
-        file_info = self.get_file_header(name)
-        return file_info.content_length
+        return self.get_metadata(name, 'size')
 
     def modified_time(self, name):
-        file_info = self.get_file_header(name)
-        return datetime.datetime.fromtimestamp(file_info.last_modified)
+        return datetime.datetime.fromtimestamp(self.get_metadata(name, 'last_modified'))
 
     def listdir(self, name):
         name = self._normalize_name(self._clean_name(name))
@@ -186,6 +386,7 @@ class AliyunBaseStorage(BucketOperationMixin, Storage):
 
     def delete(self, name):
         name = self._get_target_name(name)
+        metadata_cache.delete(name)
         result = self.bucket.delete_object(name)
         if result.status >= 400:
             raise AliyunOperationError(result.resp)
@@ -200,41 +401,130 @@ class AliyunStaticStorage(AliyunBaseStorage):
 
 
 class AliyunFile(File):
+    """
+    读取时按范围下载 只缓存最近一次读取的数据 seek不触发下载
+    写入时先写入内存 关闭时上传
+    """
+    # 每次按范围下载的最小字节数
+    read_ahead = 64 * 1024
+
     def __init__(self, name, storage, mode):
         self._storage = storage
-        self._name = name[len(self._storage.location):]
+        self._key = storage._get_target_name(name)
         self._mode = mode
-        self.file = six.BytesIO()
+        self._size = None
+        self._pos = 0
+        # 最近一次下载的数据及其起始位置
+        self._buffer = b''
+        self._buffer_start = 0
         self._is_dirty = False
-        self._is_read = False
-        super(AliyunFile, self).__init__(self.file, self._name)
+        super(AliyunFile, self).__init__(six.BytesIO(), name)
 
-    def read(self, num_bytes=None):
-        if not self._is_read:
-            content = self._storage.bucket.get_object(self._name)
-            self.file = six.BytesIO(content.read())
-            self._is_read = True
+    @property
+    def size(self):
+        if 'w' in self._mode:
+            return len(self.file.getvalue())
+        if self._size is None:
+            self._size = self._storage.size(self.name)
+        return self._size
 
-        if num_bytes is None:
-            data = self.file.read()
+    def _fetch(self, start, length):
+        """
+        按范围下载
+        :param start: 起始位置
+        :param length: 字节数
+        :return: 数据 超出文件末尾时返回b''
+        """
+        if self._size is not None:
+            length = min(length, self._size - start)
+        if length <= 0:
+            return b''
+        result = self._storage.bucket.get_object(self._key, byte_range=(start, start + length - 1))
+        data = result.read()
+        if result.status == 206:
+            # Content-Range: bytes start-end/total
+            self._size = int(result.headers['Content-Range'].rsplit('/', 1)[1])
+        else:
+            # 范围超出文件大小时OSS忽略Range返回整个文件
+            self._size = len(data)
+            data = data[start:start + length]
+        return data
+
+    def _read(self, num_bytes):
+        if num_bytes is None or num_bytes < 0:
+            # 读取剩余全部内容
+            num_bytes = max(self.size - self._pos, 0)
+        offset = self._pos - self._buffer_start
+        if 0 <= offset and offset + num_bytes <= len(self._buffer):
+            data = self._buffer[offset:offset + num_bytes]
         else:
-            data = self.file.read(num_bytes)
+            self._buffer = self._fetch(self._pos, max(num_bytes, self.read_ahead))
+            self._buffer_start = self._pos
+            data = self._buffer[:num_bytes]
+            if num_bytes > self.read_ahead:
+                # 大块读取不保留缓存 避免占用内存
+                self._buffer = b''
+        self._pos += len(data)
+        return data
+
+    def read(self, num_bytes=None):
+        if 'w' in self._mode:
+            data = self.file.read() if num_bytes is None else self.file.read(num_bytes)
+        else:
+            data = self._read(num_bytes)
 
         if 'b' in self._mode:
             return data
         else:
             return force_text(data)
 
+    def seek(self, offset, whence=os.SEEK_SET):
+        if 'w' in self._mode:
+            return self.file.seek(offset, whence)
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self):
+        if 'w' in self._mode:
+            return self.file.tell()
+        return self._pos
+
+    def chunks(self, chunk_size=None):
+        """
+        与django的File.chunks一致从头读取 一次下载 按chunk_size分块返回 内存占用与文件大小无关
+        """
+        if 'w' in self._mode:
+            for chunk in super(AliyunFile, self).chunks(chunk_size):
+                yield chunk
+            return
+        chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        self.seek(0)
+        result = self._storage.bucket.get_object(self._key)
+        while True:
+            chunk = result.read(chunk_size)
+            if not chunk:
+                break
+            self._pos += len(chunk)
+            yield chunk
+
+    def multiple_chunks(self, chunk_size=None):
+        return self.size > (chunk_size or self.DEFAULT_CHUNK_SIZE)
+
     def write(self, content):
         if 'w' not in self._mode:
             raise AliyunOperationError("Operation write is not allowed.")
 
         self.file.write(force_bytes(content))
         self._is_dirty = True
-        self._is_read = True
 
     def close(self):
         if self._is_dirty:
             self.file.seek(0)
-            self._storage._save(self._name, self.file)
-        self.file.close()
\ No newline at end of file
+            self._storage._save(self.name, File(self.file))
+            self._is_dirty = False
+        self._buffer = b''
+        self.file.close()
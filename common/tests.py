@@ -0,0 +1,329 @@
+import io
+import random
+from types import SimpleNamespace
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from post.models import Post
+from user.models import User
+
+from .ahocorasick import AhoCorasick
+from .pagination import Pagination
+from .storage import AliyunMediaStorage, metadata_cache
+from .utils import build_absolute_url
+
+
+class FakeResult(object):
+    def __init__(self, data, status=200, headers=None):
+        self._data = io.BytesIO(data)
+        self.status = status
+        self.headers = headers or {}
+
+    def read(self, amt=None):
+        return self._data.read(amt)
+
+
+class FakeHeader(object):
+    def __init__(self, data):
+        self.content_length = len(data)
+        self.last_modified = 0
+
+
+class FakeBucket(object):
+    """
+    内存中模拟的OSS Bucket 记录请求
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+
+    def put_object(self, key, data):
+        self.requests.append(('put', key))
+        self.objects[key] = data.read() if hasattr(data, 'read') else data
+
+    def get_object(self, key, byte_range=None):
+        self.requests.append(('get', key, byte_range))
+        data = self.objects[key]
+        if byte_range is None:
+            return FakeResult(data)
+        start, end = byte_range
+        end = len(data) - 1 if end is None else min(end, len(data) - 1)
+        if start >= len(data):
+            # 范围无效时OSS忽略Range返回整个文件
+            return FakeResult(data)
+        return FakeResult(data[start:end + 1], 206,
+                          {'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(data))})
+
+    def head_object(self, key):
+        self.requests.append(('head', key))
+        return FakeHeader(self.objects[key])
+
+    def object_exists(self, key):
+        self.requests.append(('exists', key))
+        return key in self.objects
+
+    def delete_object(self, key):
+        self.requests.append(('delete', key))
+        self.objects.pop(key, None)
+        return FakeResult(b'', 204)
+
+    def init_multipart_upload(self, key):
+        self.requests.append(('init', key))
+        self.uploads = getattr(self, 'uploads', {})
+        upload_id = str(len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        return SimpleNamespace(upload_id=upload_id)
+
+    def upload_part(self, key, upload_id, part_number, data, headers=None):
+        self.requests.append(('part', key, part_number))
+        self.uploads[upload_id][part_number] = data
+        return SimpleNamespace(etag='etag{}'.format(part_number))
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        self.requests.append(('complete', key))
+        data = self.uploads.pop(upload_id)
+        self.objects[key] = b''.join(data[part.part_number] for part in parts)
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.requests.append(('abort', key))
+        self.uploads.pop(upload_id, None)
+
+
+class StorageTestCase(SimpleTestCase):
+    def setUp(self):
+        self.storage = AliyunMediaStorage()
+        self.bucket = self.storage._bucket = FakeBucket()
+        self.data = bytes(range(256)) * 1000
+        self.key = self.storage._get_target_name('file/a.bin')
+        self.bucket.objects[self.key] = self.data
+
+    def tearDown(self):
+        metadata_cache.delete(self.key)
+
+
+class AliyunFileTests(StorageTestCase):
+    def test_init_without_network(self):
+        """
+        创建存储不访问OSS
+        """
+        storage = AliyunMediaStorage()
+        self.assertIsNone(storage._bucket)
+
+    def test_ranged_read(self):
+        """
+        按范围下载 seek不触发下载
+        """
+        file = self.storage.open('file/a.bin')
+        file.seek(1000)
+        self.assertEqual(self.bucket.requests, [])
+        self.assertEqual(file.read(10), self.data[1000:1010])
+        self.assertEqual(file.read(10), self.data[1010:1020])
+        self.assertEqual(len(self.bucket.requests), 1)
+        self.assertEqual(file.size, len(self.data))
+        file.seek(-5, 2)
+        self.assertEqual(file.read(), self.data[-5:])
+        self.assertEqual(file.read(10), b'')
+
+    def test_chunks_from_start(self):
+        """
+        读取文件头后chunks仍从头返回全部内容
+        """
+        file = self.storage.open('file/a.bin')
+        self.assertEqual(file.read(16), self.data[:16])
+        self.assertEqual(b''.join(file.chunks(4096)), self.data)
+
+    def test_write(self):
+        """
+        写入模式关闭时上传
+        """
+        file = self.storage.open('file/b.bin', 'wb')
+        file.write(b'hello')
+        file.close()
+        self.assertEqual(self.bucket.objects[self.storage._get_target_name('file/b.bin')], b'hello')
+
+
+class MultipartUploadTests(StorageTestCase):
+    def setUp(self):
+        super(MultipartUploadTests, self).setUp()
+        self.storage.multipart_threshold = 1000
+        self.storage.part_size = 300
+        self.storage.upload_threads = 2
+
+    def test_small_file(self):
+        """
+        小文件直接上传
+        """
+        name = self.storage.save('file/small.bin', ContentFile(b'x' * 999))
+        self.assertEqual([request[0] for request in self.bucket.requests if request[0] != 'exists'], ['put'])
+        self.assertEqual(self.storage.size(name), 999)
+
+    def test_multipart(self):
+        """
+        大文件分片上传 合并后内容不变
+        """
+        data = self.data[:2500]
+        name = self.storage.save('file/large.bin', ContentFile(data))
+        target_name = self.storage._get_target_name(name)
+        parts = sorted(request[2] for request in self.bucket.requests if request[0] == 'part')
+        self.assertEqual(parts, list(range(1, 10)))
+        self.assertEqual(self.bucket.objects[target_name], data)
+
+    def test_part_failed(self):
+        """
+        分片上传失败时取消分片上传
+        """
+        def fail(key, upload_id, part_number, data, headers=None):
+            raise IOError('part {}'.format(part_number))
+
+        self.bucket.upload_part = fail
+        content = ContentFile(self.data[:100000])
+        with self.assertRaises(IOError):
+            self.storage.save('file/failed.bin', content)
+        self.assertEqual([request[0] for request in self.bucket.requests if request[0] != 'exists'],
+                         ['init', 'abort'])
+        self.assertNotIn(self.storage._get_target_name('file/failed.bin'), self.bucket.objects)
+
+
+class MetadataCacheTests(StorageTestCase):
+    def test_save_fills_cache(self):
+        """
+        上传后size/exists不再请求OSS
+        """
+        name = self.storage.save('file/c.bin', ContentFile(b'12345'))
+        self.bucket.requests = []
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.storage.size(name), 5)
+        self.assertEqual(self.bucket.requests, [])
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+
+    def test_invalidate(self):
+        """
+        删除后缓存失效 重新上传后缓存新的大小
+        """
+        name = self.storage.save('file/d.bin', ContentFile(b'12345'))
+        self.storage.delete(name)
+        self.bucket.requests = []
+        self.assertFalse(self.storage.exists(name))
+        self.assertEqual(self.bucket.requests, [('exists', self.storage._get_target_name(name))])
+        name = self.storage.save(name, ContentFile(b'1234567'))
+        self.bucket.requests = []
+        self.assertEqual(self.storage.size(name), 7)
+        self.assertEqual(self.bucket.requests, [])
+        self.storage.delete(name)
+
+    def test_head_once(self):
+        """
+        同一文件只请求一次元信息
+        """
+        self.assertEqual(self.storage.size('file/a.bin'), len(self.data))
+        self.assertEqual(self.storage.size('file/a.bin'), len(self.data))
+        self.assertEqual([request[0] for request in self.bucket.requests], ['head'])
+
+
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='author', tel='13800000001')
+        now = timezone.now()
+        # 两两同一时间 游标须按id区分
+        self.posts = [Post.objects.create(user=user, title=str(index), category=1,
+                                          time=now - timedelta(minutes=index // 2)) for index in range(5)]
+
+    def paginate(self, **params):
+        paginator = Pagination()
+        request = Request(APIRequestFactory().get('/post/', params))
+        view = type('View', (), {'cursor_ordering': ('-time', '-id')})
+        page = paginator.paginate_queryset(Post.objects.all(), request, view)
+        return page, paginator.get_paginated_response([post.id for post in page]).data['data']
+
+    def test_pages(self):
+        """
+        按游标逐页读取 同一时间的帖子不重复不遗漏
+        """
+        expected = [post.id for post in sorted(self.posts, key=lambda post: (post.time, post.id), reverse=True)]
+        ids, cursor = [], ''
+        while True:
+            with self.assertNumQueries(1):
+                page, data = self.paginate(cursor=cursor, page_size=2)
+            ids.extend(data['results'])
+            cursor = data['cursor']
+            if not cursor:
+                break
+            self.assertIn('cursor=', data['next'])
+        self.assertEqual(ids, expected)
+        self.assertNotIn('count', data)
+
+    def test_null_time(self):
+        """
+        时间为空的帖子排在最后 同样可以逐页读取
+        """
+        for index in range(3):
+            self.posts.append(Post.objects.create(user=self.posts[0].user, title='无时间', category=1, time=None))
+        timed = sorted((post for post in self.posts if post.time), key=lambda post: (post.time, post.id),
+                       reverse=True)
+        expected = [post.id for post in timed] + sorted((post.id for post in self.posts if not post.time),
+                                                        reverse=True)
+        ids, cursor = [], ''
+        for _ in range(len(expected)):
+            data = self.paginate(cursor=cursor, page_size=2)[1]
+            ids.extend(data['results'])
+            cursor = data['cursor']
+            if not cursor:
+                break
+        self.assertEqual(ids, expected)
+        self.assertEqual(cursor, '')
+
+    def test_invalid_cursor(self):
+        """
+        非法游标返回第一页
+        """
+        first = self.paginate(cursor='', page_size=2)[1]['results']
+        for cursor in ('abc', 'WzFd', 'WyJ4IiwgMV0='):
+            self.assertEqual(self.paginate(cursor=cursor, page_size=2)[1]['results'], first)
+
+    def test_page_number(self):
+        """
+        不带cursor参数时仍按页码分页
+        """
+        data = self.paginate(page=2, page_size=2)[1]
+        self.assertEqual((data['count'], data['page_num'], data['page_no']), (5, 3, 2))
+
+
+class AhoCorasickTests(SimpleTestCase):
+    def test_overlap(self):
+        """
+        重叠、嵌套的词全部命中
+        """
+        matcher = AhoCorasick(['he', 'she', 'his', 'hers', ''])
+        self.assertEqual(list(matcher.iter('ushers')), [(3, 'she'), (3, 'he'), (5, 'hers')])
+        self.assertEqual(matcher.findall('ushers she'), ['she', 'he', 'hers'])
+        self.assertEqual(AhoCorasick(['', '']).findall('text'), [])
+
+    def test_brute_force(self):
+        """
+        与逐词查找结果一致
+        """
+        rand = random.Random(4)
+        for _ in range(50):
+            words = [''.join(rand.choice('abc') for _ in range(rand.randint(1, 4))) for _ in range(10)]
+            text = ''.join(rand.choice('abcd') for _ in range(40))
+            self.assertEqual(set(AhoCorasick(words).findall(text)), {word for word in words if word in text})
+
+
+class BuildAbsoluteUrlTests(SimpleTestCase):
+    def test_build(self):
+        """
+        相对地址拼接域名 与build_absolute_uri一致 完整地址原样返回
+        """
+        request = APIRequestFactory().get('/file/', HTTP_HOST='example.com', secure=True)
+        for url in ('/media/file/a.jpg', '/media/file/%E4%B8%AD.jpg'):
+            self.assertEqual(build_absolute_url(request, url), request.build_absolute_uri(url))
+        url = 'https://bucket.oss-cn-hangzhou.aliyuncs.com/file/a.jpg'
+        self.assertEqual(build_absolute_url(request, url), url)
+        self.assertEqual(build_absolute_url(None, '/media/a.jpg'), '/media/a.jpg')
@@ -1,4 +1,5 @@
 import os
+import hashlib
 from datetime import datetime
 
 from django.http import QueryDict
@@ -136,6 +137,19 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+def get_file_digest(file):
+    """
+    按块计算文件内容的sha256 不将整个文件读入内存
+    :param file: 文件实例
+    :return: 十六进制摘要
+    """
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
 def validate_image_ext(ext):
     """
     :param ext: ext
@@ -156,6 +170,33 @@ def validate_video_ext(ext):
     return False
 
 
+def build_absolute_url(request, url):
+    """
+    拼接完整地址 OSS地址本身已是完整地址 相对地址直接拼接当前请求的域名
+    比request.build_absolute_uri少了地址解析与规范化 用于序列化大量文件地址
+    :param request: 请求 为None时原样返回
+    :param url: 存储返回的地址
+    :return: 完整地址
+    """
+    if request is None or url.startswith(('http://', 'https://')):
+        return url
+    # 同一请求只拼接一次域名前缀
+    prefix = getattr(request, '_absolute_url_prefix', None)
+    if prefix is None:
+        prefix = '{}://{}'.format(request.scheme, request.get_host())
+        request._absolute_url_prefix = prefix
+    return prefix + url
+
+
+def get_max_upload_size(filename):
+    """
+    :param filename: 文件名
+    :return: 该文件允许上传的最大字节数 视频与其他文件限制不同
+    """
+    ext = os.path.splitext(filename)[1][1:]
+    return settings.MAX_VIDEO_SIZE if validate_video_ext(ext) else settings.MAX_FILE_SIZE
+
+
 def validate_file_size(value):
     """
     限制文件大小为20M 20M=20*1024KB=20*1024*1024Byte (Byte既字节)
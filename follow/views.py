@@ -11,6 +11,7 @@ from user.models import User
 from user.filters import UserFilter
 from user.serializers import UserListSerializer
 from friend.models import Friend, FriendState
+from post.utils import sync_friend_timeline
 
 from .models import *
 
@@ -23,6 +24,7 @@ class FollowViewSet(ListModelMixin, GenericViewSet):
     filter_class = UserFilter
     ordering_fields = '__all__'
     search_fields = ('username', 'tel', 'nickname')
+    cursor_ordering = ('id',)
 
     # 空列表
     # override /follow/
@@ -61,6 +63,7 @@ class FollowViewSet(ListModelMixin, GenericViewSet):
         Follow.objects.filter(from_user=request.user, to_user=to_user).update(is_abandon=True)
         # 有好友关系则断开
         Friend.objects.filter(from_user=request.user, to_user=to_user).update(is_abandon=True)
+        sync_friend_timeline(request.user.id, to_user.id)
         return success_response('取消关注成功')
 
     # 检测关注状态
@@ -81,8 +84,7 @@ class FollowViewSet(ListModelMixin, GenericViewSet):
     # 200 分页后关注的用户列表
     @list_route(methods=['GET'])
     def follow_list(self, request, *args, **kwargs):
-        follows = request.user.follow_from_user.all()
-        queryset = User.objects.filter(id__in=[follow.to_user.id for follow in follows])
+        queryset = User.objects.filter(id__in=request.user.follow_from_user.values('to_user'))
         return self.list_queryset(request, queryset, *args, **kwargs)
 
     # 粉丝列表
@@ -91,6 +93,5 @@ class FollowViewSet(ListModelMixin, GenericViewSet):
     # 200 分页后关注的粉丝列表
     @list_route(methods=['GET'])
     def fan_list(self, request, *args, **kwargs):
-        fans = request.user.follow_to_user.all()
-        queryset = User.objects.filter(id__in=[fan.from_user.id for fan in fans])
+        queryset = User.objects.filter(id__in=request.user.follow_to_user.values('from_user'))
         return self.list_queryset(request, queryset, *args, **kwargs)
@@ -51,10 +51,27 @@ class Friend(Base):
         verbose_name = '好友关系'
         verbose_name_plural = '好友关系'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Friend, cls).from_db(db, field_names, values)
+        # 记录数据库中影响看帖的字段 保存时据此判断是否需要同步故事时间线
+        instance._original_visibility = instance.get_visibility_key()
+        return instance
+
+    def get_visibility_key(self):
+        """
+        :return: (黑名单, 禁止看帖, 是否删除) 有字段未加载时返回None
+        """
+        if self.get_deferred_fields() & {'is_block', 'is_post_block', 'is_abandon'}:
+            return None
+        return self.is_block, self.is_post_block, self.is_abandon
+
     def save(self, *args, **kwargs):
         if not self.id and not self.remark:
             self.remark = self.to_user.get_full_name()
-        return super(Friend, self).save(*args, **kwargs)
+        result = super(Friend, self).save(*args, **kwargs)
+        self._original_visibility = self.get_visibility_key()
+        return result
 
     def __str__(self):
         return '{} {}'.format(self.from_user.username, self.to_user.username)
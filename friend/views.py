@@ -14,6 +14,7 @@ from common.utils import isdigit, str2bool, get_list
 from common import jpush
 from common.exception import PushError
 from user.models import User
+from post.utils import sync_friend_timeline
 
 from .models import *
 from .serializers import *
@@ -89,11 +90,10 @@ class FriendViewSet(ModelViewSet):
                 friend_from.remark = to_user.get_full_name()
             friend_from.save()
             # TODO 向他人推送我请求加他为好友
-            try:
-                jpush.audience(to_user.id, '好友请求', '用户{}请求添加您为好友'.format(request.user.get_full_name()),
-                               {'operation': 'friend_add'})
-            except PushError as e:
-                logging.error('{} {}'.format(e.code, e.message))
+            name = request.user.get_full_name()
+            jpush.audience_async(to_user.id, '好友请求', '用户{}请求添加您为好友'.format(name),
+                                 {'operation': 'friend_add'},
+                                 'friend_add', '用户{}和其他{{others}}人请求添加您为好友'.format(name))
             return success_response('请求已发送')
         except User.DoesNotExist:
             return error_response(2, '该用户不存在')
@@ -126,7 +126,12 @@ class FriendViewSet(ModelViewSet):
     # 批量设置禁止看帖好友
     @list_route(methods=['POST'])
     def set_post_block(self, request, *args, **kwargs):
-        self.get_queryset().filter(id__in=get_list(request.data, 'post_block_list')).update(is_post_block=True)
+        friends = self.get_queryset().filter(id__in=get_list(request.data, 'post_block_list'))
+        pairs = list(friends.values_list('from_user_id', 'to_user_id'))
+        friends.update(is_post_block=True)
+        # update不触发post_save 手动同步故事时间线
+        for from_user_id, to_user_id in pairs:
+            sync_friend_timeline(from_user_id, to_user_id)
         return success_response('设置成功')
 
     # 查看待处理的和最近一天添加的好友关系
@@ -220,12 +225,9 @@ class FriendViewSet(ModelViewSet):
                                 friend_from.remark = friend.from_user.get_full_name()
                                 friend_from.save()
                                 # TODO 向用户A推送B通过了他的好友请求
-                                try:
-                                    jpush.audience(friend.from_user.id, '请求通过',
-                                                   '用户{}通过了你的好友请求'.format(request.user.get_full_name()),
-                                                   {'operation': 'friend_pass'})
-                                except PushError as e:
-                                    logging.error('{} {}'.format(e.code, e.message))
+                                jpush.audience_async(friend.from_user.id, '请求通过',
+                                                     '用户{}通过了你的好友请求'.format(request.user.get_full_name()),
+                                                     {'operation': 'friend_pass'})
                                 return success_response('添加好友成功')
                             # 拒绝请求
                             elif state == FriendState.Reject:
@@ -0,0 +1,103 @@
+import math
+
+# geohash base32字符表
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# 帖子存储的geohash精度 9位约4.8m×4.8m
+PRECISION = 9
+
+
+def encode(longitude, latitude, precision=PRECISION):
+    """
+    经纬度编码为geohash 相同前缀的geohash位于同一网格内
+    :param longitude: 经度
+    :param latitude: 纬度
+    :param precision: 位数
+    :return: geohash
+    """
+    lon_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    longitude = float(longitude)
+    latitude = float(latitude)
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            value, value_range = longitude, lon_range
+        else:
+            value, value_range = latitude, lat_range
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def cell_size(precision):
+    """
+    :param precision: geohash位数
+    :return: 该精度下网格的 (经度宽, 纬度高)
+    """
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+    return 360.0 / 2 ** lon_bits, 180.0 / 2 ** lat_bits
+
+
+def cover(lon_min, lon_max, lat_min, lat_max, max_cells=32):
+    """
+    覆盖矩形区域的geohash前缀 选择网格数不超过max_cells的最高精度
+    :return: geohash前缀列表 区域过大时返回None 表示无法用网格缩小范围
+    """
+    lat_min = max(lat_min, -90.0)
+    lat_max = min(lat_max, 90.0)
+    if lon_max - lon_min >= 360.0:
+        lon_min, lon_max = -180.0, 180.0
+    for precision in range(PRECISION, 0, -1):
+        lon_size, lat_size = cell_size(precision)
+        cols = math.floor(lon_max / lon_size) - math.floor(lon_min / lon_size) + 1
+        rows = math.floor(lat_max / lat_size) - math.floor(lat_min / lat_size) + 1
+        if cols * rows > max_cells:
+            continue
+        cells = set()
+        for row in range(rows):
+            latitude = min((math.floor(lat_min / lat_size) + row + 0.5) * lat_size, 90.0)
+            for col in range(cols):
+                # 跨越180度经线时回绕
+                longitude = (math.floor(lon_min / lon_size) + col + 0.5) * lon_size
+                longitude = (longitude + 180.0) % 360.0 - 180.0
+                cells.add(encode(longitude, latitude, precision))
+        return sorted(cells)
+    return None
+
+
+def ring(longitude, latitude, precision, radius):
+    """
+    以(longitude, latitude)所在网格为中心 第radius圈的网格
+    :param precision: geohash位数
+    :param radius: 圈数 0为中心网格
+    :return: geohash列表
+    """
+    lon_size, lat_size = cell_size(precision)
+    col = math.floor(float(longitude) / lon_size)
+    row = math.floor(float(latitude) / lat_size)
+    cells = set()
+    for i in range(-radius, radius + 1):
+        for j in range(-radius, radius + 1):
+            if max(abs(i), abs(j)) != radius:
+                continue
+            lat = (row + i + 0.5) * lat_size
+            if not -90.0 < lat < 90.0:
+                continue
+            lon = ((col + j + 0.5) * lon_size + 180.0) % 360.0 - 180.0
+            cells.add(encode(lon, lat, precision))
+    return sorted(cells)
@@ -0,0 +1,32 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from post.utils import haversine, haversine_many
+
+
+class Command(BaseCommand):
+    help = '对比逐点haversine与批量haversine_many的耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000], help='点数')
+
+    def handle(self, *args, **options):
+        longitude, latitude = 116.397128, 39.916527
+        rng = np.random.RandomState(0)
+        for size in options['sizes']:
+            lons = longitude + rng.uniform(-1, 1, size)
+            lats = latitude + rng.uniform(-1, 1, size)
+
+            start = time.perf_counter()
+            expected = [haversine(longitude, latitude, lon, lat) for lon, lat in zip(lons.tolist(), lats.tolist())]
+            scalar = time.perf_counter() - start
+
+            start = time.perf_counter()
+            distances = haversine_many(longitude, latitude, lons, lats)
+            vector = time.perf_counter() - start
+
+            error = float(np.max(np.abs(distances - np.asarray(expected))))
+            self.stdout.write('{:>8}点 逐点{:.4f}s 批量{:.4f}s 加速{:.1f}倍 最大误差{:.2e}km'.format(
+                size, scalar, vector, scalar / vector, error))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from post import geohash
+from post.models import Post
+
+
+class Command(BaseCommand):
+    help = '根据经纬度重新生成帖子的geohash'
+
+    def handle(self, *args, **options):
+        count = 0
+        posts = Post.all.filter(longitude__isnull=False, latitude__isnull=False)
+        for pk, longitude, latitude in posts.values_list('id', 'longitude', 'latitude').iterator():
+            Post.all.filter(id=pk).update(geohash=geohash.encode(longitude, latitude))
+            count += 1
+        Post.all.filter(longitude__isnull=True).update(geohash=None)
+        Post.all.filter(latitude__isnull=True).update(geohash=None)
+        self.stdout.write('已生成{}条帖子的geohash'.format(count))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from post.models import Post, Timeline
+from post.utils import fan_out_post
+
+
+class Command(BaseCommand):
+    help = '重建好友故事时间线'
+
+    def handle(self, *args, **options):
+        Timeline.objects.all().delete()
+        count = 0
+        for post in Post.objects.filter(status=1).iterator():
+            fan_out_post(post)
+            count += 1
+        self.stdout.write('已重建{}条帖子的故事时间线'.format(count))
@@ -0,0 +1,39 @@
+from django.db.models import Count
+from django.core.management.base import BaseCommand
+
+from post.models import Post, Comment
+
+
+class Command(BaseCommand):
+    help = '重新统计帖子、评论的点赞总数和评论总数 修复计数偏差'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', help='仅输出偏差 不修复')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        post_likes = self.count_by(Post.likes.through.objects, 'post_id')
+        comment_likes = self.count_by(Comment.likes.through.objects, 'comment_id')
+        # 仅统计未删除的评论
+        comments = self.count_by(Comment.objects, 'post_id')
+
+        repaired = 0
+        for pk, likes_count, comment_count in Post.all.values_list('id', 'likes_count', 'comment_count').iterator():
+            real = {'likes_count': post_likes.get(pk, 0), 'comment_count': comments.get(pk, 0)}
+            if real != {'likes_count': likes_count, 'comment_count': comment_count}:
+                repaired += self.repair(Post, pk, real)
+        for pk, likes_count in Comment.all.values_list('id', 'likes_count').iterator():
+            real = {'likes_count': comment_likes.get(pk, 0)}
+            if real['likes_count'] != likes_count:
+                repaired += self.repair(Comment, pk, real)
+        self.stdout.write('共{}条记录计数存在偏差{}'.format(repaired, '' if self.dry_run else '，已修复'))
+
+    @staticmethod
+    def count_by(queryset, field):
+        return dict(queryset.values_list(field).annotate(count=Count('id')).order_by())
+
+    def repair(self, model, pk, real):
+        self.stdout.write('{} {} -> {}'.format(model._meta.verbose_name, pk, real))
+        if not self.dry_run:
+            model.all.filter(pk=pk).update(**real)
+        return 1
@@ -4,7 +4,9 @@ from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 from common.utils import get_time_filename
-from common.models import Base
+from common.models import Base, LikesCountMixin
+
+from . import geohash
 
 
 def get_video_path(instance, filename):
@@ -12,7 +14,7 @@ def get_video_path(instance, filename):
 
 
 # 帖子
-class Post(Base):
+class Post(LikesCountMixin, Base):
     # 用户
     user = models.ForeignKey('user.User',
                              related_name='post_user',
@@ -73,29 +75,66 @@ class Post(Base):
                                    decimal_places=6,
                                    validators=[MinValueValidator(-90), MaxValueValidator(90)],
                                    verbose_name=u'地点-纬度')
+    # 地点-geohash 由经纬度生成 用于附近帖子网格检索
+    geohash = models.CharField(max_length=12,
+                               null=True,
+                               blank=True,
+                               editable=False,
+                               verbose_name=u'地点-geohash')
     # 点赞用户
     likes = models.ManyToManyField('user.User',
                                    blank=True,
                                    verbose_name='点赞用户')
+    # 点赞总数
+    likes_count = models.PositiveIntegerField(default=0,
+                                              verbose_name=u'点赞总数')
+    # 评论总数
+    comment_count = models.PositiveIntegerField(default=0,
+                                                verbose_name=u'评论总数')
 
     class Meta:
         verbose_name = '帖子'
         verbose_name_plural = '帖子'
+        index_together = ('geohash', 'time')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Post, cls).from_db(db, field_names, values)
+        # 记录数据库中的可见性与时间 保存时据此判断是否需要更新故事时间线
+        instance._original_timeline = instance.get_timeline_key()
+        return instance
+
+    def get_timeline_key(self):
+        """
+        :return: (状态, 是否删除, 时间) 有字段未加载时返回None
+        """
+        if self.get_deferred_fields() & {'status', 'is_abandon', 'time'}:
+            return None
+        return self.status, self.is_abandon, self.time
+
+    def save(self, *args, **kwargs):
+        if self.longitude is not None and self.latitude is not None:
+            self.geohash = geohash.encode(self.longitude, self.latitude)
+        else:
+            self.geohash = None
+        result = super(Post, self).save(*args, **kwargs)
+        self._original_timeline = self.get_timeline_key()
+        return result
 
     # 点赞总数
     def get_likes_count(self):
-        return self.likes.count()
+        return self.likes_count
 
     # 评论总数
     def get_comment_count(self):
-        return Comment.objects.filter(post=self).count()
+        return self.comment_count
 
     def __str__(self):
         return '{} {}'.format(self.id, self.title)
 
 
 # 评论
-class Comment(Base):
+class Comment(LikesCountMixin, Base):
     # 用户
     user = models.ForeignKey('user.User',
                              related_name='comment_user',
@@ -115,6 +154,9 @@ class Comment(Base):
     likes = models.ManyToManyField('user.User',
                                    blank=True,
                                    verbose_name='点赞用户')
+    # 点赞总数
+    likes_count = models.PositiveIntegerField(default=0,
+                                              verbose_name=u'点赞总数')
 
     class Meta:
         verbose_name = '评论'
@@ -126,7 +168,65 @@ class Comment(Base):
 
     # 点赞总数
     def get_likes_count(self):
-        return self.likes.count()
+        return self.likes_count
 
     def __str__(self):
         return '{} {} {}'.format(self.id, self.user, self.post)
+
+
+# 故事时间线 好友可见帖子发布时写入每位可见好友的时间线
+class Timeline(models.Model):
+    # 读者
+    user = models.ForeignKey('user.User',
+                             related_name='timeline_user',
+                             on_delete=models.CASCADE,
+                             verbose_name=u'读者')
+    # 帖子
+    post = models.ForeignKey('post.Post',
+                             related_name='timeline_post',
+                             on_delete=models.CASCADE,
+                             verbose_name=u'帖子')
+    # 发帖人
+    author = models.ForeignKey('user.User',
+                               related_name='timeline_author',
+                               on_delete=models.CASCADE,
+                               verbose_name=u'发帖人')
+    # 帖子时间
+    time = models.DateTimeField(null=True,
+                                verbose_name=u'帖子时间')
+
+    class Meta:
+        verbose_name = '故事时间线'
+        verbose_name_plural = '故事时间线'
+        unique_together = ('user', 'post')
+        index_together = (('user', 'time'), ('user', 'author'))
+
+    def __str__(self):
+        return '{} {}'.format(self.user_id, self.post_id)
+
+
+# 设置项版本 设置项更新时递增 各进程据此判断本地缓存是否过期
+class ConfigVersion(models.Model):
+    # 设置项键名
+    key = models.CharField(max_length=255,
+                           unique=True,
+                           verbose_name=u'键名')
+    # 版本
+    version = models.PositiveIntegerField(default=0,
+                                          verbose_name=u'版本')
+
+    class Meta:
+        verbose_name = '设置项版本'
+        verbose_name_plural = '设置项版本'
+
+    @staticmethod
+    def get_version(key):
+        return ConfigVersion.objects.filter(key=key).values_list('version', flat=True).first() or 0
+
+    @staticmethod
+    def bump(key):
+        ConfigVersion.objects.get_or_create(key=key)
+        ConfigVersion.objects.filter(key=key).update(version=models.F('version') + 1)
+
+    def __str__(self):
+        return '{} {}'.format(self.key, self.version)
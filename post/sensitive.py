@@ -0,0 +1,54 @@
+import time
+import threading
+
+from django.conf import settings
+
+from common.utils import get_value
+from common.ahocorasick import AhoCorasick
+
+from .models import ConfigVersion
+
+_lock = threading.Lock()
+# 本进程缓存的敏感词自动机及其版本
+_matcher = None
+_version = None
+_checked_time = 0.0
+
+
+def compile_sensitive_words(value):
+    """
+    :param value: 以中文或英文逗号隔开的敏感词
+    :return: 敏感词自动机
+    """
+    # 去重 去除空词
+    words = set(word.strip() for word in (value or '').replace('，', ',').split(','))
+    return AhoCorasick(sorted(word for word in words if word))
+
+
+def get_sensitive_matcher():
+    """
+    获取敏感词自动机 首次使用时编译
+    每隔SENSITIVE_WORD_CHECK_INTERVAL秒查询一次版本号 其他进程更新敏感词后重新编译
+    :return: 敏感词自动机
+    """
+    global _matcher, _version, _checked_time
+    now = time.monotonic()
+    if _matcher is not None and now - _checked_time < settings.SENSITIVE_WORD_CHECK_INTERVAL:
+        return _matcher
+    with _lock:
+        version = ConfigVersion.get_version(settings.SENSITIVE_WORD)
+        if _matcher is None or version != _version:
+            # 先读版本再读敏感词 并发更新时下次检查会再次编译
+            _matcher = compile_sensitive_words(get_value(settings.SENSITIVE_WORD))
+            _version = version
+        _checked_time = now
+    return _matcher
+
+
+def invalidate():
+    """
+    更新敏感词后递增版本号 所有进程在下次检查时重新编译
+    """
+    global _checked_time
+    ConfigVersion.bump(settings.SENSITIVE_WORD)
+    _checked_time = 0.0
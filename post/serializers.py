@@ -3,7 +3,8 @@ from common.serializers import *
 from common.utils import get_value, validate_image_ext, validate_video_ext, sizeof_fmt
 from user.serializers import UserListSerializer, FileInlineSerializer
 from .models import *
-from .utils import get_post_queryset
+from .utils import get_post_queryset, haversine, haversine_many
+from .sensitive import get_sensitive_matcher
 
 
 # --------------------------------- 帖子 ---------------------------------
@@ -16,7 +17,7 @@ class PostModifySerializer(ModelSerializer):
                 image_errors = []
                 if not validate_image_ext(image.ext):
                     image_errors.append('文件 {} 不是合法的图片类型'.format(image.filename))
-                if image.file.size > settings.MAX_IMAGE_SIZE:
+                if image.get_file_size() > settings.MAX_IMAGE_SIZE:
                     image_errors.append('文件 {} 大小超过{}'.format(image.filename,
                                                               sizeof_fmt(settings.MAX_IMAGE_SIZE)))
                 request = self.context['request']
@@ -34,7 +35,7 @@ class PostModifySerializer(ModelSerializer):
         if data:
             if not validate_video_ext(data.ext):
                 raise serializers.ValidationError('文件 {} 不是非法的视频文件'.format(data.filename))
-            if data.file.size > settings.MAX_VIDEO_SIZE:
+            if data.get_file_size() > settings.MAX_VIDEO_SIZE:
                 raise serializers.ValidationError('文件 {} 大小超过{}'.format(data.filename,
                                                                         sizeof_fmt(settings.MAX_VIDEO_SIZE)))
             request = self.context['request']
@@ -73,15 +74,12 @@ class PostModifySerializer(ModelSerializer):
 
 
 # 列表帖子
-class PostListSerializer(ModelSerializer):
+class PostListSerializer(LikedSerializerMixin, ModelSerializer):
     user = UserListSerializer(read_only=True)
     video = FileInlineSerializer(read_only=True)
     images = FileInlineSerializer(read_only=True, many=True)
     is_liked = serializers.SerializerMethodField()
 
-    def get_is_liked(self, instance):
-        return True if self.context['request'].user in instance.likes.all() else False
-
     def to_representation(self, instance):
         """视频只返回video 图片只返回images"""
         data = super(PostListSerializer, self).to_representation(instance)
@@ -93,26 +91,37 @@ class PostListSerializer(ModelSerializer):
 
     class Meta:
         model = Post
+        list_serializer_class = LikedListSerializer
         fields = ('id', 'user', 'status', 'title', 'content', 'category', 'video', 'images', 'time', 'place',
                   'longitude', 'latitude', 'is_liked', 'get_likes_count', 'get_comment_count', 'get_status_display',
                   'get_category_display')
 
 
+# 列表帖子(带距离) 整页一次计算距离
+class DistanceListSerializer(LikedListSerializer):
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, models.Manager) else data)
+        if iterable:
+            distances = haversine_many(self.context['longitude'], self.context['latitude'],
+                                       [item.longitude for item in iterable], [item.latitude for item in iterable])
+            self.child.distances = dict(zip([item.pk for item in iterable], distances.tolist()))
+        return super(DistanceListSerializer, self).to_representation(iterable)
+
+
 # 列表帖子(带距离)
-class PostDistanceListSerializer(ModelSerializer):
+class PostDistanceListSerializer(LikedSerializerMixin, ModelSerializer):
     user = UserListSerializer(read_only=True)
     video = FileInlineSerializer(read_only=True)
     images = FileInlineSerializer(read_only=True, many=True)
     is_liked = serializers.SerializerMethodField()
     distance = serializers.SerializerMethodField()
-
-    def get_is_liked(self, instance):
-        return True if self.context['request'].user in instance.likes.all() else False
+    distances = None
 
     def get_distance(self, instance):
+        if self.distances is not None and instance.pk in self.distances:
+            return self.distances[instance.pk]
         longitude = self.context['longitude']
         latitude = self.context['latitude']
-        from .utils import haversine
         return haversine(longitude, latitude, instance.longitude, instance.latitude)
 
     def to_representation(self, instance):
@@ -126,22 +135,20 @@ class PostDistanceListSerializer(ModelSerializer):
 
     class Meta:
         model = Post
+        list_serializer_class = DistanceListSerializer
         fields = ('id', 'user', 'status', 'title', 'content', 'category', 'video', 'images', 'time', 'place',
                   'longitude', 'latitude', 'is_liked', 'get_likes_count', 'get_comment_count', 'get_status_display',
                   'get_category_display', 'distance')
 
 
 # 帖子详情
-class PostSerializer(ModelSerializer):
+class PostSerializer(LikedSerializerMixin, ModelSerializer):
     user = UserListSerializer(read_only=True)
     video = FileInlineSerializer(read_only=True)
     images = FileInlineSerializer(read_only=True, many=True)
     comments = serializers.SerializerMethodField()
     is_liked = serializers.SerializerMethodField()
 
-    def get_is_liked(self, instance):
-        return True if self.context['request'].user in instance.likes.all() else False
-
     def to_representation(self, instance):
         """视频只返回video 图片只返回images"""
         data = super(PostSerializer, self).to_representation(instance)
@@ -156,6 +163,7 @@ class PostSerializer(ModelSerializer):
 
     class Meta:
         model = Post
+        list_serializer_class = LikedListSerializer
         fields = ('id', 'user', 'status', 'title', 'content', 'category', 'video', 'images', 'time', 'place',
                   'longitude', 'latitude', 'comments', 'is_liked', 'get_likes_count', 'get_comment_count',
                   'get_status_display', 'get_category_display')
@@ -163,7 +171,8 @@ class PostSerializer(ModelSerializer):
 
 # 附近帖子
 class PostNearBySerializer(ModelSerializer):
-    distance = serializers.DecimalField(max_digits=18, decimal_places=14, min_value=0, required=True, label='距离')
+    distance = serializers.DecimalField(max_digits=18, decimal_places=14, min_value=0,
+                                        max_value=settings.NEARBY_MAX_DISTANCE, required=True, label='距离')
 
     class Meta:
         model = Post
@@ -171,6 +180,17 @@ class PostNearBySerializer(ModelSerializer):
         extra_kwargs = {'longitude': {'required': True}, 'latitude': {'required': True}}
 
 
+# 最近帖子
+class PostNearestSerializer(ModelSerializer):
+    distance = serializers.DecimalField(max_digits=18, decimal_places=14, min_value=0, required=False, label='距离')
+    cursor = serializers.CharField(required=False, allow_blank=True, label='游标')
+
+    class Meta:
+        model = Post
+        fields = ('distance', 'longitude', 'latitude', 'cursor')
+        extra_kwargs = {'longitude': {'required': True}, 'latitude': {'required': True}}
+
+
 # --------------------------------- 评论 ---------------------------------
 # 创建评论
 class CommentModifySerializer(ModelSerializer):
@@ -180,12 +200,7 @@ class CommentModifySerializer(ModelSerializer):
         self.fields['post'].queryset = get_post_queryset(self.context['request'].user)
 
     def validate_text(self, data):
-        # 必须实时import 不然会出现敏感词未更新的情况
-        from .signals import sensitive_words
-        error_words = []
-        for word in sensitive_words:
-            if word in data:
-                error_words.append(word)
+        error_words = get_sensitive_matcher().findall(data)
         if len(error_words) == 0:
             return data
         else:
@@ -202,28 +217,22 @@ class CommentModifySerializer(ModelSerializer):
 
 
 # 评论列表
-class CommentListSerializer(ModelSerializer):
+class CommentListSerializer(LikedSerializerMixin, ModelSerializer):
     user = UserListSerializer(read_only=True)
     is_liked = serializers.SerializerMethodField()
 
-    # 是否已点赞
-    def get_is_liked(self, instance):
-        return True if self.context['request'].user in instance.likes.all() else False
-
     class Meta:
         model = Comment
+        list_serializer_class = LikedListSerializer
         fields = ('id', 'user', 'post', 'text', 'parent', 'create_time', 'update_time', 'is_liked', 'get_likes_count')
 
 
 # 评论详情
-class CommentSerializer(ModelSerializer):
+class CommentSerializer(LikedSerializerMixin, ModelSerializer):
     user = UserListSerializer(read_only=True)
     is_liked = serializers.SerializerMethodField()
 
-    # 是否已点赞
-    def get_is_liked(self, instance):
-        return True if self.context['request'].user in instance.likes.all() else False
-
     class Meta:
         model = Comment
+        list_serializer_class = LikedListSerializer
         fields = ('id', 'user', 'post', 'text', 'parent', 'create_time', 'update_time', 'is_liked', 'get_likes_count')
@@ -1,16 +1,37 @@
 from django.conf import settings
 from django.dispatch import receiver
+from django.db.models.signals import post_save
 from constance.signals import config_updated
-from common.utils import get_value
-
-# 预加载敏感词
-sensitive_words = list(set(get_value(settings.SENSITIVE_WORD).replace('，', ',').split(',')))
+from friend.models import Friend
+from . import sensitive
+from .models import Post, Timeline
+from .utils import fan_out_post, sync_friend_timeline
 
 
 @receiver(config_updated)
 def constance_updated(sender, key, old_value, new_value, **kwargs):
     if key == settings.SENSITIVE_WORD:
-        # 更新全局敏感词
-        global sensitive_words
-        # 去重
-        sensitive_words = list(set(new_value.replace('，', ',').split(',')))
+        # 通知所有进程更新敏感词
+        sensitive.invalidate()
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance=None, created=False, **kwargs):
+    # 好友可见帖子写入好友的故事时间线 点赞、评论计数等其他修改不更新时间线
+    if created:
+        if instance.status == 1:
+            fan_out_post(instance)
+        return
+    original = getattr(instance, '_original_timeline', None)
+    if original is None or original[:2] != (instance.status, instance.is_abandon):
+        fan_out_post(instance)
+    if original is None or original[2] != instance.time:
+        Timeline.objects.filter(post=instance).update(time=instance.time)
+
+
+@receiver(post_save, sender=Friend)
+def friend_saved(sender, instance=None, created=False, **kwargs):
+    # 新建关系或黑名单、禁止看帖、删除变化后同步故事时间线 修改备注等不同步
+    original = getattr(instance, '_original_visibility', None)
+    if created or original is None or original != instance.get_visibility_key():
+        sync_friend_timeline(instance.from_user_id, instance.to_user_id)
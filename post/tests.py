@@ -1,3 +1,371 @@
+import math
+import random
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from constance.signals import config_updated
+from django.conf import settings
+from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APITestCase, APIRequestFactory, force_authenticate
+
+from friend.models import Friend
+from push.models import Push
+from user.models import User
+
+from . import geohash, sensitive
+from .models import Post, Comment, Timeline, ConfigVersion
+from .serializers import CommentListSerializer, CommentSerializer
+from .utils import haversine, haversine_many, filter_nearby, nearest
+
+
+class TimelineTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create(username='author', tel='13800000001')
+        self.reader = User.objects.create(username='reader', tel='13800000002')
+        Friend.objects.create(from_user=self.reader, to_user=self.author)
+
+    def create_post(self, status=1):
+        return Post.objects.create(user=self.author, status=status, title='标题', category=1)
+
+    def test_fan_out_on_create(self):
+        """
+        好友可见的帖子发布后写入好友的时间线 公开帖子不写入
+        """
+        post = self.create_post()
+        self.create_post(status=0)
+        self.assertEqual(list(Timeline.objects.values_list('user', 'post')), [(self.reader.id, post.id)])
+
+    def test_status_change(self):
+        """
+        修改可见范围或删除后同步时间线
+        """
+        post = self.create_post(status=0)
+        post.status = 1
+        post.save()
+        self.assertTrue(Timeline.objects.filter(post=post).exists())
+        post = Post.objects.get(id=post.id)
+        post.is_abandon = True
+        post.save()
+        self.assertFalse(Timeline.objects.filter(post=post).exists())
+
+    def test_time_change(self):
+        """
+        修改帖子时间后更新时间线中的时间
+        """
+        post = self.create_post()
+        post = Post.objects.get(id=post.id)
+        post.time = timezone.now() - timedelta(days=1)
+        post.save()
+        self.assertEqual(Timeline.objects.get(post=post).time, post.time)
+
+    def test_friend_changes(self):
+        """
+        禁止看帖后移除好友的帖子 修改备注不同步时间线
+        """
+        post = self.create_post()
+        friend = Friend.objects.get(from_user=self.reader, to_user=self.author)
+        friend.remark = '新备注'
+        with self.assertNumQueries(1):
+            friend.save()
+        friend.is_post_block = True
+        friend.save()
+        self.assertFalse(Timeline.objects.filter(post=post).exists())
+        friend = Friend.objects.get(id=friend.id)
+        friend.is_post_block = False
+        friend.save()
+        self.assertTrue(Timeline.objects.filter(post=post, user=self.reader).exists())
+
+    def test_no_fan_out_on_other_changes(self):
+        """
+        修改其他字段时不查询好友关系
+        """
+        post = Post.objects.get(id=self.create_post().id)
+        post.title = '新标题'
+        with self.assertNumQueries(1):
+            post.save()
+
+
+class CounterTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='author', tel='13800000001')
+        self.client.force_authenticate(self.user)
+        self.post = Post.objects.create(user=self.user, title='标题', category=1)
+
+    def refresh(self):
+        return Post.objects.get(id=self.post.id)
+
+    def test_like(self):
+        """
+        重复点赞、取消点赞不重复计数
+        """
+        self.assertTrue(self.post.like(self.user))
+        self.assertFalse(self.post.like(self.user))
+        self.assertEqual(self.refresh().likes_count, 1)
+        self.assertTrue(self.post.unlike(self.user))
+        self.assertFalse(self.post.unlike(self.user))
+        self.assertEqual(self.refresh().likes_count, 0)
+
+    def test_like_push_once(self):
+        """
+        重复点赞只推送一次
+        """
+        for _ in range(3):
+            self.client.get(reverse('post-like', args=[self.post.id]))
+        self.assertEqual(self.refresh().likes_count, 1)
+        self.assertEqual(Push.objects.filter(group='post_like:{}'.format(self.post.id)).count(), 1)
+
+    def test_comment_count(self):
+        """
+        发表、删除评论时更新评论总数
+        """
+        response = self.client.post(reverse('comment-list'), {'post': self.post.id, 'text': '评论'}, format='json')
+        self.assertEqual(self.refresh().comment_count, 1)
+        self.client.delete(reverse('comment-detail', args=[response.data['data']['id']]))
+        self.assertEqual(self.refresh().get_comment_count(), 0)
+
+    def test_repair_counts(self):
+        """
+        repair_counts按实际数据修复计数
+        """
+        comment = Comment.objects.create(user=self.user, post=self.post, text='评论')
+        comment.likes.add(self.user)
+        Post.objects.filter(id=self.post.id).update(likes_count=3)
+        out = StringIO()
+        call_command('repair_counts', dry_run=True, stdout=out)
+        self.assertEqual(self.refresh().likes_count, 3)
+        call_command('repair_counts', stdout=out)
+        post = self.refresh()
+        self.assertEqual((post.likes_count, post.comment_count), (0, 1))
+        self.assertEqual(Comment.objects.get(id=comment.id).likes_count, 1)
+
+
+class LikedTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='reader', tel='13800000002')
+        post = Post.objects.create(user=self.user, title='标题', category=1)
+        self.comments = [Comment.objects.create(user=self.user, post=post, text=str(index)) for index in range(4)]
+        for comment in self.comments[::2]:
+            comment.likes.add(self.user)
+
+    def get_context(self, user=None):
+        request = APIRequestFactory().get('/comment/')
+        if user:
+            force_authenticate(request, user)
+        return {'request': Request(request)}
+
+    def test_list(self):
+        """
+        整页一次查询是否点赞
+        """
+        comments = list(Comment.objects.select_related('user').order_by('id'))
+        context = self.get_context(self.user)
+        # 点赞 备注名各一次
+        with self.assertNumQueries(2):
+            data = CommentListSerializer(comments, many=True, context=context).data
+        self.assertEqual([item['is_liked'] for item in data], [True, False, True, False])
+
+    def test_single(self):
+        """
+        单个对象和未登录用户
+        """
+        context = self.get_context(self.user)
+        self.assertTrue(CommentSerializer(self.comments[0], context=context).data['is_liked'])
+        self.assertFalse(CommentSerializer(self.comments[1], context=context).data['is_liked'])
+        data = CommentListSerializer(self.comments, many=True, context=self.get_context()).data
+        self.assertFalse(any(item['is_liked'] for item in data))
+
+
+class GeohashTests(TestCase):
+    def test_encode(self):
+        """
+        与标准geohash编码一致
+        """
+        self.assertEqual(geohash.encode(-5.6, 42.6, 5), 'ezs42')
+        self.assertEqual(geohash.encode(10.40744, 57.64911, 11), 'u4pruydqqvj')
+
+    def test_cover(self):
+        """
+        区域内任意一点的geohash以某个覆盖网格开头 跨越180度经线时回绕
+        """
+        rand = random.Random(1)
+        for box in ((116.2, 116.6, 39.7, 40.1), (179.9, 180.1, -0.1, 0.1), (-0.001, 0.001, 51.4, 51.5)):
+            cells = geohash.cover(*box)
+            self.assertLessEqual(len(cells), 32)
+            for _ in range(200):
+                longitude = (rand.uniform(box[0], box[1]) + 180.0) % 360.0 - 180.0
+                code = geohash.encode(longitude, rand.uniform(box[2], box[3]))
+                self.assertTrue(any(code.startswith(cell) for cell in cells), (box, code))
+        self.assertIsNone(geohash.cover(-180.0, 180.0, -90.0, 90.0, max_cells=1))
+
+    def test_ring(self):
+        """
+        各圈网格互不重复 第1圈为中心网格的8个邻居
+        """
+        center = geohash.ring(116.397, 39.916, 6, 0)
+        first = geohash.ring(116.397, 39.916, 6, 1)
+        self.assertEqual(center, [geohash.encode(116.397, 39.916, 6)])
+        self.assertEqual(len(first), 8)
+        self.assertFalse(set(center) & set(first))
+
+
+class NearbyTests(APITestCase):
+    def setUp(self):
+        user = User.objects.create(username='author', tel='13800000001')
+        self.client.force_authenticate(user)
+        rand = random.Random(2)
+        self.center = (116.397, 39.916)
+        self.posts = [Post.objects.create(user=user, title='标题', category=1,
+                                          longitude=Decimal('{:.6f}'.format(self.center[0] + rand.uniform(-1, 1))),
+                                          latitude=Decimal('{:.6f}'.format(self.center[1] + rand.uniform(-1, 1))))
+                      for _ in range(60)]
+        Post.objects.create(user=user, title='无地点', category=1)
+
+    def distances(self):
+        return {post.id: haversine(self.center[0], self.center[1], float(post.longitude), float(post.latitude))
+                for post in self.posts}
+
+    def test_filter_nearby(self):
+        """
+        网格检索结果与逐个计算距离一致
+        """
+        for distance in (5, 30, 80, 500):
+            expected = {pk for pk, d in self.distances().items() if d <= distance}
+            result = set(filter_nearby(Post.objects.all(), self.center[0], self.center[1], distance)
+                         .values_list('id', flat=True))
+            self.assertEqual(result, expected, distance)
+
+    def test_filter_without_cells(self):
+        """
+        网格过多无法使用时按经纬度范围筛选 跨越180度经线时回绕
+        """
+        with mock.patch('post.geohash.cover', return_value=None):
+            expected = {pk for pk, d in self.distances().items() if d <= 50}
+            result = set(filter_nearby(Post.objects.all(), self.center[0], self.center[1], 50)
+                         .values_list('id', flat=True))
+            self.assertEqual(result, expected)
+            user = self.posts[0].user
+            east = Post.objects.create(user=user, title='东', category=1, longitude=Decimal('179.9'), latitude=0)
+            west = Post.objects.create(user=user, title='西', category=1, longitude=Decimal('-179.9'), latitude=0)
+            result = set(filter_nearby(Post.objects.all(), 179.95, 0, 20).values_list('id', flat=True))
+            self.assertEqual(result, {east.id, west.id})
+
+    def test_max_distance(self):
+        """
+        附近帖子的距离不能超过NEARBY_MAX_DISTANCE
+        """
+        data = {'longitude': self.center[0], 'latitude': self.center[1]}
+        response = self.client.post(reverse('post-nearby-posts'),
+                                    dict(data, distance=settings.NEARBY_MAX_DISTANCE + 1), format='json')
+        self.assertEqual(response.data['code'], 1)
+        response = self.client.post(reverse('post-nearby-posts'), dict(data, distance=30), format='json')
+        expected = {pk for pk, d in self.distances().items() if d <= 30}
+        self.assertEqual({item['id'] for item in response.data['data']['results']}, expected)
+
+    def test_nearest(self):
+        """
+        由近及远的k个帖子与逐个计算距离排序一致
+        """
+        expected = sorted((d, pk) for pk, d in self.distances().items())
+        for k in (1, 10, 100):
+            found = nearest(Post.objects.all(), self.center[0], self.center[1], k)
+            self.assertEqual([pk for d, pk in found], [pk for d, pk in expected[:k]])
+        found = nearest(Post.objects.all(), self.center[0], self.center[1], 100, after=expected[9], distance=50)
+        self.assertEqual([pk for d, pk in found], [pk for d, pk in expected[10:] if d <= 50])
+
+    def test_nearest_posts_deleted(self):
+        """
+        检索后被删除的帖子跳过
+        """
+        expected = [pk for d, pk in sorted((d, pk) for pk, d in self.distances().items())]
+        deleted = expected[1]
+
+        def delete_after(*args, **kwargs):
+            found = nearest(*args, **kwargs)
+            Post.objects.filter(id=deleted).update(is_abandon=True)
+            return found
+
+        with mock.patch('post.views.nearest', side_effect=delete_after):
+            response = self.client.post(reverse('post-nearest-posts') + '?page_size=3',
+                                        {'longitude': self.center[0], 'latitude': self.center[1]}, format='json')
+        self.assertEqual([item['id'] for item in response.data['data']['results']], [expected[0], expected[2]])
+
+    def test_nearest_posts(self):
+        """
+        按游标逐页读取最近帖子 不重复不遗漏
+        """
+        expected = [pk for d, pk in sorted((d, pk) for pk, d in self.distances().items())]
+        ids, cursor = [], ''
+        while True:
+            response = self.client.post(reverse('post-nearest-posts') + '?page_size=7',
+                                        {'longitude': self.center[0], 'latitude': self.center[1], 'cursor': cursor},
+                                        format='json')
+            data = response.data['data']
+            distances = [item['distance'] for item in data['results']]
+            self.assertEqual(distances, sorted(distances))
+            ids.extend(item['id'] for item in data['results'])
+            cursor = data['cursor']
+            if not cursor:
+                break
+        self.assertEqual(ids, expected)
+
+
+class HaversineTests(TestCase):
+    def test_many(self):
+        """
+        批量计算与逐个计算结果一致 包括同一点和对跖点
+        """
+        rand = random.Random(3)
+        points = [(rand.uniform(-180, 180), rand.uniform(-90, 90)) for _ in range(100)]
+        points += [(10.0, 20.0), (-170.0, -20.0)]
+        lons, lats = zip(*points)
+        distances = haversine_many(10.0, 20.0, lons, lats)
+        for (lon, lat), d in zip(points, distances.tolist()):
+            self.assertAlmostEqual(d, haversine(10.0, 20.0, lon, lat), places=6)
+        self.assertEqual(distances[-2], 0)
+        self.assertAlmostEqual(distances[-1], math.pi * 6371.0, places=3)
+        self.assertEqual(len(haversine_many(10.0, 20.0, [], [])), 0)
+
+
+@mock.patch('post.sensitive.get_value')
+class SensitiveWordTests(TestCase):
+    def setUp(self):
+        sensitive._matcher = None
+
+    def test_compile(self, get_value):
+        """
+        支持中英文逗号 忽略空词
+        """
+        matcher = sensitive.compile_sensitive_words('甲，乙, ,丙,,')
+        self.assertEqual(matcher.findall('甲乙丙丁'), ['甲', '乙', '丙'])
+        self.assertEqual(sensitive.compile_sensitive_words(None).findall('甲'), [])
+
+    def test_other_process(self, get_value):
+        """
+        其他进程递增版本号后 下次检查时重新编译
+        """
+        get_value.return_value = '甲'
+        with self.settings(SENSITIVE_WORD_CHECK_INTERVAL=0):
+            self.assertEqual(sensitive.get_sensitive_matcher().findall('甲乙'), ['甲'])
+            get_value.return_value = '乙'
+            self.assertEqual(sensitive.get_sensitive_matcher().findall('甲乙'), ['甲'])
+            ConfigVersion.bump(settings.SENSITIVE_WORD)
+            self.assertEqual(sensitive.get_sensitive_matcher().findall('甲乙'), ['乙'])
 
-# Create your tests here.
+    def test_check_interval(self, get_value):
+        """
+        检查间隔内不查询版本号 本进程更新敏感词后立即生效
+        """
+        get_value.return_value = '甲'
+        with self.settings(SENSITIVE_WORD_CHECK_INTERVAL=3600):
+            sensitive.get_sensitive_matcher()
+            with self.assertNumQueries(0):
+                sensitive.get_sensitive_matcher()
+            get_value.return_value = '乙'
+            config_updated.send(sender=None, key=settings.SENSITIVE_WORD, old_value='甲', new_value='乙')
+            self.assertEqual(sensitive.get_sensitive_matcher().findall('甲乙'), ['乙'])
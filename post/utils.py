@@ -1,7 +1,14 @@
+import json
 import math
+import base64
+import binascii
 from math import radians, cos, sin, asin, sqrt
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
 from friend.models import Friend
-from .models import Post
+from .models import Post, Timeline
+from . import geohash
 
 # earth_radius = 3960.0  # for miles
 earth_radius = 6371.0  # for kms
@@ -16,16 +23,18 @@ def change_in_latitude(distance):
 
 def change_in_longitude(latitude, distance):
     """Given a latitude and a distance west, return the change in longitude."""
-    # Find the radius of a circle around the earth at given latitude.
-    r = earth_radius * math.cos(latitude * degrees_to_radians)
-    return (distance / r) * radians_to_degrees
+    # 圆形区域内经度差最大的点不在中心纬度上 按球面公式计算
+    ratio = math.sin(distance / earth_radius) / math.cos(latitude * degrees_to_radians)
+    return math.asin(min(ratio, 1.0)) * radians_to_degrees
 
 
 def bounding_box(longitude, latitude, distance):
-    print(latitude, longitude)
     lat_change = change_in_latitude(distance)
     lat_max = latitude + lat_change
     lat_min = latitude - lat_change
+    if lat_max >= 90.0 or lat_min <= -90.0:
+        # 圆形区域包含极点 经度不限
+        return -180.0, 180.0, lat_min, lat_max
     lon_change = change_in_longitude(latitude, distance)
     lon_max = longitude + lon_change
     lon_min = longitude - lon_change
@@ -49,9 +58,176 @@ def haversine(lon1, lat1, lon2, lat2):
     return c * r
 
 
+def haversine_many(lon1, lat1, lons, lats):
+    """
+    批量计算一点到多点的球面距离(km) 与haversine结果一致
+    :param lon1: 起点经度
+    :param lat1: 起点纬度
+    :param lons: 终点经度序列
+    :param lats: 终点纬度序列
+    :return: 距离 numpy数组
+    """
+    lon1, lat1 = radians(lon1), radians(lat1)
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+
+    a = np.sin((lats - lat1) / 2) ** 2 + cos(lat1) * np.cos(lats) * np.sin((lons - lon1) / 2) ** 2
+    # 浮点误差可能使a略大于1
+    c = 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return c * earth_radius
+
+
+def filter_nearby(queryset, longitude, latitude, distance):
+    """
+    筛选距离内的帖子 先按覆盖范围的geohash网格前缀检索 再按球面距离精确筛选
+    :param queryset: 帖子queryset
+    :param longitude: 经度
+    :param latitude: 纬度
+    :param distance: 距离(km)
+    :return: 距离内帖子的queryset
+    """
+    box = bounding_box(longitude, latitude, distance)
+    # 网格与经纬度范围都在数据库中筛选 网格过多无法使用时仍不会读取全部帖子
+    condition = Q(geohash__isnull=False) & bounding_box_condition(*box)
+    cells = geohash.cover(*box)
+    if cells is not None:
+        cell_condition = Q()
+        for cell in cells:
+            cell_condition |= Q(geohash__startswith=cell)
+        condition &= cell_condition
+    queryset = queryset.filter(condition)
+    rows = list(queryset.values_list('id', 'longitude', 'latitude'))
+    if not rows:
+        return queryset.none()
+    ids, lons, lats = zip(*rows)
+    distances = haversine_many(longitude, latitude, lons, lats)
+    # 只排除矩形四角圆形之外的帖子 其余条件仍由数据库执行
+    return queryset.exclude(id__in=np.asarray(ids)[distances > distance].tolist())
+
+
+def bounding_box_condition(lon_min, lon_max, lat_min, lat_max):
+    """
+    :return: 经纬度在矩形范围内的查询条件 跨越180度经线时回绕
+    """
+    condition = Q(latitude__gte=max(lat_min, -90.0), latitude__lte=min(lat_max, 90.0))
+    if lon_max - lon_min >= 360.0:
+        return condition
+    if lon_min < -180.0:
+        return condition & (Q(longitude__gte=lon_min + 360.0) | Q(longitude__lte=lon_max))
+    if lon_max > 180.0:
+        return condition & (Q(longitude__gte=lon_min) | Q(longitude__lte=lon_max - 360.0))
+    return condition & Q(longitude__gte=lon_min, longitude__lte=lon_max)
+
+
+def nearest(queryset, longitude, latitude, k, after=None, distance=None, precision=6, max_ring_cells=32):
+    """
+    由近及远的k个帖子 以所在geohash网格为中心逐圈扩大检索范围 一圈内网格过多时换用更粗的精度
+    :param queryset: 帖子queryset
+    :param longitude: 经度
+    :param latitude: 纬度
+    :param k: 个数
+    :param after: 游标(距离, ID) 只返回排在其后的帖子
+    :param distance: 最大距离(km) None时不限
+    :param precision: 起始geohash精度
+    :param max_ring_cells: 每圈最多网格数
+    :return: [(距离, 帖子ID)] 按(距离, ID)升序
+    """
+    candidates = queryset.filter(geohash__isnull=False)
+    found = {}
+    radius = 0
+    while True:
+        condition = Q()
+        for cell in geohash.ring(longitude, latitude, precision, radius):
+            condition |= Q(geohash__startswith=cell)
+        rows = list(candidates.filter(condition).values_list('id', 'longitude', 'latitude'))
+        if rows:
+            ids, lons, lats = zip(*rows)
+            for pk, d in zip(ids, haversine_many(longitude, latitude, lons, lats).tolist()):
+                if (after is None or (d, pk) > after) and (distance is None or d <= distance):
+                    found[pk] = d
+
+        # 已检索中心网格外radius圈 未检索区域经度差或纬度差至少为radius个网格
+        lon_size, lat_size = geohash.cell_size(precision)
+        lon_span, lat_span = radius * lon_size, radius * lat_size
+        if lon_span >= 360.0 and lat_span >= 180.0:
+            break
+        # 未检索区域距中心的最小距离
+        bound = radians(lat_span)
+        if lon_span < 360.0:
+            bound = min(bound, asin(min(cos(radians(latitude)) * sin(radians(min(lon_span, 90.0))), 1.0)))
+        bound *= earth_radius
+        if distance is not None and bound >= distance:
+            break
+        if len([d for d in found.values() if d <= bound]) >= k:
+            break
+
+        if 8 * (radius + 1) > max_ring_cells and precision > 1:
+            # 换用更粗的网格 从未被已检索区域完全覆盖的圈开始
+            precision -= 1
+            coarse_lon_size, coarse_lat_size = geohash.cell_size(precision)
+            radius = int(min(lon_span // coarse_lon_size, lat_span // coarse_lat_size))
+        else:
+            radius += 1
+    return sorted(((d, pk) for pk, d in found.items()))[:k]
+
+
+def encode_distance_cursor(distance, pk):
+    return base64.urlsafe_b64encode(json.dumps([distance, pk]).encode('utf-8')).decode('ascii')
+
+
+def decode_distance_cursor(cursor):
+    """
+    :return: (距离, ID) 空游标或非法游标返回None
+    """
+    if not cursor:
+        return None
+    try:
+        distance, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return float(distance), int(pk)
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+
 def get_post_queryset(user):
-    my_friends = [friend.to_user for friend in
-                  Friend.objects.filter(from_user=user, is_block=False, is_post_block=False).all()]
-    queryset_friend = Post.objects.filter(user__in=my_friends, status=1).all()
+    queryset_friend = Post.objects.filter(id__in=Timeline.objects.filter(user=user).values('post'), status=1).all()
     queryset = Post.objects.filter(status=0).all() | queryset_friend | Post.objects.filter(user=user).all()
     return queryset
+
+
+def fan_out_post(post):
+    """
+    将好友可见的帖子写入可见好友的故事时间线
+    帖子不再好友可见或被删除时从时间线中移除
+    :param post: 帖子
+    :return: 无返回
+    """
+    if post.status != 1 or post.is_abandon:
+        Timeline.objects.filter(post=post).delete()
+        return
+    readers = Friend.objects.filter(to_user_id=post.user_id, is_block=False,
+                                    is_post_block=False).values_list('from_user_id', flat=True)
+    exists = set(Timeline.objects.filter(post=post).values_list('user_id', flat=True))
+    Timeline.objects.bulk_create([Timeline(user_id=reader, post=post, author_id=post.user_id, time=post.time)
+                                  for reader in set(readers) if reader not in exists])
+
+
+def sync_friend_timeline(from_user_id, to_user_id):
+    """
+    好友关系变化后同步from_user的故事时间线
+    拉黑、禁止看帖、删除好友时移除to_user的帖子 否则补全to_user的好友可见帖子
+    :param from_user_id: 关系起始人ID(读者)
+    :param to_user_id: 关系结束人ID(发帖人)
+    :return: 无返回
+    """
+    # 在同一事务中完成 并发读取的故事列表不会看到同步到一半的时间线
+    with transaction.atomic():
+        visible = Friend.objects.filter(from_user_id=from_user_id, to_user_id=to_user_id,
+                                        is_block=False, is_post_block=False).exists()
+        timeline = Timeline.objects.filter(user_id=from_user_id, author_id=to_user_id)
+        if not visible:
+            timeline.delete()
+            return
+        exists = set(timeline.values_list('post_id', flat=True))
+        posts = Post.objects.filter(user_id=to_user_id, status=1).values_list('id', 'time')
+        Timeline.objects.bulk_create([Timeline(user_id=from_user_id, post_id=post_id, author_id=to_user_id,
+                                               time=time) for post_id, time in posts if post_id not in exists])
@@ -1,13 +1,16 @@
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+from django.db import transaction
+from django.db.models import F
+
 from rest_framework.decorators import list_route, detail_route
 from rest_framework.permissions import IsAuthenticated
 
 from common.permissions import IsPostOwnerOrReadOnly, IsCommentOwnerOrReadOnly
 from common.response import success_response, error_response
 from common.viewset import ModelViewSet
-from common.exception import PushError
 from common import jpush
 
 from recommend.models import Recommend
@@ -15,7 +18,7 @@ from recommend.models import Recommend
 from .models import *
 from .serializers import *
 from .filters import *
-from .utils import bounding_box, haversine, get_post_queryset
+from .utils import filter_nearby, nearest, encode_distance_cursor, decode_distance_cursor, get_post_queryset
 
 logger = logging.getLogger("info")
 
@@ -34,6 +37,7 @@ class PostViewSet(ModelViewSet):
     filter_class = PostFilter
     ordering_fields = '__all__'
     search_fields = ('title', 'content', 'user__nickname')
+    cursor_ordering = ('-time', '-id')
 
     # 修改、删除需要所有者权限
     def get_permissions(self):
@@ -58,9 +62,8 @@ class PostViewSet(ModelViewSet):
 
     # 好友的故事
     def get_queryset_friend(self):
-        my_friends = [friend.to_user for friend in
-                      Friend.objects.filter(from_user=self.request.user, is_block=False, is_post_block=False).all()]
-        queryset = self.queryset.filter(user__in=my_friends, status=1)
+        queryset = self.queryset.filter(id__in=Timeline.objects.filter(user=self.request.user).values('post'),
+                                        status=1)
         return queryset
 
     # 我的帖子列表
@@ -71,7 +74,9 @@ class PostViewSet(ModelViewSet):
     # 故事列表
     @list_route(methods=['GET'])
     def story_list(self, request, *args, **kwargs):
-        return self.list_queryset(request, self.get_queryset_friend(), *args, **kwargs)
+        # 按时间线(读者, 时间)索引倒序读取
+        queryset = self.queryset.filter(timeline_post__user=request.user, status=1).order_by('-timeline_post__time')
+        return self.list_queryset(request, queryset, *args, **kwargs)
 
     # 帖子列表
     @list_route(methods=['GET'])
@@ -83,14 +88,13 @@ class PostViewSet(ModelViewSet):
     @detail_route(methods=['GET'])
     def like(self, request, pk, *args, **kwargs):
         instance = self.get_object()
-        instance.likes.add(request.user)
-        # TODO 向贴主推送点赞
-        try:
-            jpush.audience(instance.user.id, '帖子点赞',
-                           "用户{}赞了您的帖子".format(request.user.get_full_name(user=instance.user)),
-                           {'operation': 'post_like', 'post': instance.id})
-        except PushError as e:
-            logging.error('{} {}'.format(e.code, e.message))
+        # 已点过赞时不重复推送
+        if instance.like(request.user):
+            # TODO 向贴主推送点赞
+            name = request.user.get_full_name(user=instance.user)
+            jpush.audience_async(instance.user.id, '帖子点赞', "用户{}赞了您的帖子".format(name),
+                                 {'operation': 'post_like', 'post': instance.id},
+                                 'post_like:{}'.format(instance.id), "用户{}和其他{{others}}人赞了您的帖子".format(name))
         return success_response('点赞成功')
 
     # 取消点赞
@@ -99,7 +103,7 @@ class PostViewSet(ModelViewSet):
         # 范围为我点过赞的帖子
         self.queryset = request.user.post_set.all()
         instance = self.get_object()
-        instance.likes.remove(request.user)
+        instance.unlike(request.user)
         return success_response('取消点赞成功')
 
     # 帖子点赞用户列表(未分页)
@@ -118,16 +122,8 @@ class PostViewSet(ModelViewSet):
             longitude = float(data['longitude'])
             latitude = float(data['latitude'])
             distance = float(data['distance'])
-            lon_min, lon_max, lat_min, lat_max = bounding_box(longitude, latitude, distance)
-            # 正方形内帖子
-            box_queryset = self.get_queryset().filter(longitude__gte=lon_min, longitude__lte=lon_max,
-                                                      latitude__gte=lat_min, latitude__lte=lat_max)
-            # 正方形内筛选圆形区域
-            ids = []
-            for x in box_queryset:
-                if haversine(longitude, latitude, x.longitude, x.latitude) <= distance:
-                    ids.append(x.id)
-            queryset = box_queryset.filter(id__in=ids)
+            # 覆盖圆形区域的网格内筛选圆形区域
+            queryset = filter_nearby(self.get_queryset(), longitude, latitude, distance)
             # list部分
             queryset = self.filter_queryset(queryset)
             context = self.get_serializer_context()
@@ -138,11 +134,44 @@ class PostViewSet(ModelViewSet):
                 serializer = PostDistanceListSerializer(page, context=context, many=True)
                 return self.get_paginated_response(serializer.data)
 
-            serializer = self.get_serializer(queryset, context=context, many=True)
+            serializer = PostDistanceListSerializer(queryset, context=context, many=True)
             return success_response(serializer.data)
         else:
             return error_response(1, self.humanize_errors(serializer))
 
+    # 最近帖子 按距离由近及远 以cursor翻页
+    # Receive ----------------------------------
+    # longitude 经度 latitude 纬度
+    # distance 最大距离(km) 可选
+    # cursor 上一页返回的游标 首页为空
+    # Return -----------------------------------
+    # 200 cursor 下一页游标(为空时没有下一页) results 帖子列表 400-1 数据格式错误
+    @list_route(methods=['POST'])
+    def nearest_posts(self, request, *args, **kwargs):
+        serializer = PostNearestSerializer(data=request.data)
+        if serializer.is_valid():
+            data = serializer.validated_data
+            longitude = float(data['longitude'])
+            latitude = float(data['latitude'])
+            distance = float(data['distance']) if 'distance' in data else None
+            page_size = self.paginator.get_page_size(request) or self.paginator.max_page_size
+            after = decode_distance_cursor(data.get('cursor'))
+
+            # 多取一条判断是否有下一页
+            found = nearest(self.filter_queryset(self.get_queryset()), longitude, latitude, page_size + 1,
+                            after=after, distance=distance)
+            cursor = encode_distance_cursor(*found[page_size - 1]) if len(found) > page_size else ''
+            found = found[:page_size]
+            posts = Post.objects.in_bulk([pk for d, pk in found])
+            context = self.get_serializer_context()
+            context.update({'longitude': longitude, 'latitude': latitude})
+            # 检索后被删除的帖子不返回
+            serializer = PostDistanceListSerializer([posts[pk] for d, pk in found if pk in posts], context=context,
+                                                    many=True)
+            return success_response(OrderedDict([('cursor', cursor), ('results', serializer.data)]))
+        else:
+            return error_response(1, self.humanize_errors(serializer))
+
     # 推荐帖子
     @list_route(methods=['GET'])
     def recommend_posts(self, request, *args, **kwargs):
@@ -167,6 +196,7 @@ class CommentViewSet(ModelViewSet):
     filter_class = CommentFilter
     ordering_fields = '__all__'
     search_fields = ('text',)
+    cursor_ordering = ('-create_time', '-id')
 
     # 修改、删除需要所有者权限
     def get_permissions(self):
@@ -179,23 +209,21 @@ class CommentViewSet(ModelViewSet):
 
     # 限制评论用户
     def perform_create(self, serializer):
-        instance = serializer.save(user=self.request.user)
+        with transaction.atomic():
+            instance = serializer.save(user=self.request.user)
+            Post.all.filter(id=instance.post_id).update(comment_count=F('comment_count') + 1)
         # TODO 向贴主推送评论
-        try:
-            jpush.audience(instance.post.user.id, '帖子评论',
-                           "用户{}评论了您的帖子".format(instance.user.get_full_name(user=instance.post.user)),
-                           {'operation': 'post_comment', 'post': instance.post.id})
-        except PushError as e:
-            logging.error('{} {}'.format(e.code, e.message))
+        name = instance.user.get_full_name(user=instance.post.user)
+        jpush.audience_async(instance.post.user.id, '帖子评论', "用户{}评论了您的帖子".format(name),
+                             {'operation': 'post_comment', 'post': instance.post.id},
+                             'post_comment:{}'.format(instance.post.id), "用户{}和其他{{others}}人评论了您的帖子".format(name))
 
         # TODO 回帖向回帖人推送回复
         if instance.parent:
-            try:
-                jpush.audience(instance.parent.post.user.id, '帖子评论回复',
-                               "用户{}回复了您的评论".format(instance.user.get_full_name(user=instance.parent.post.user)),
-                               {'operation': 'post_comment', 'post': instance.post.id})
-            except PushError as e:
-                logging.error('{} {}'.format(e.code, e.message))
+            name = instance.user.get_full_name(user=instance.parent.post.user)
+            jpush.audience_async(instance.parent.post.user.id, '帖子评论回复', "用户{}回复了您的评论".format(name),
+                                 {'operation': 'post_comment', 'post': instance.post.id},
+                                 'comment_reply:{}'.format(instance.post.id), "用户{}和其他{{others}}人回复了您的评论".format(name))
         return instance
 
     # 禁止修改
@@ -205,22 +233,23 @@ class CommentViewSet(ModelViewSet):
     # 假删除
     def perform_destroy(self, instance):
         # 若删除的为父评论 所有的子评论升级为一级评论
-        Comment.objects.filter(parent=instance).update(parent=None)
-        instance.is_abandon = True
-        instance.save()
+        with transaction.atomic():
+            Comment.objects.filter(parent=instance).update(parent=None)
+            instance.is_abandon = True
+            instance.save()
+            Post.all.filter(id=instance.post_id).update(comment_count=F('comment_count') - 1)
 
     # 点赞
     @detail_route(methods=['GET'])
     def like(self, request, pk, *args, **kwargs):
         instance = self.get_object()
-        instance.likes.add(request.user)
-        # TODO 向评论人推送点赞
-        try:
-            jpush.audience(instance.user.id, '评论点赞',
-                           "用户{}赞了您的评论".format(request.user.get_full_name(instance.user)),
-                           {'operation': 'comment_like', 'post': instance.post.id})
-        except PushError as e:
-            logging.error('{} {}'.format(e.code, e.message))
+        # 已点过赞时不重复推送
+        if instance.like(request.user):
+            # TODO 向评论人推送点赞
+            name = request.user.get_full_name(instance.user)
+            jpush.audience_async(instance.user.id, '评论点赞', "用户{}赞了您的评论".format(name),
+                                 {'operation': 'comment_like', 'post': instance.post.id},
+                                 'comment_like:{}'.format(instance.id), "用户{}和其他{{others}}人赞了您的评论".format(name))
         return success_response('点赞成功')
 
     # 取消点赞
@@ -229,7 +258,7 @@ class CommentViewSet(ModelViewSet):
         # 范围为我点过赞的评论
         self.queryset = request.user.comment_set.all()
         instance = self.get_object()
-        instance.likes.remove(request.user)
+        instance.unlike(request.user)
         return success_response('取消点赞成功')
 
     # 评论点赞用户列表(未分页)
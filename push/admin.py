@@ -0,0 +1,13 @@
+from django.contrib import admin
+
+from .models import *
+
+
+# 推送
+class PushAdmin(admin.ModelAdmin):
+    list_display = ['id', 'alias', 'title', 'state', 'attempts', 'next_time', 'error', 'create_time']
+    search_fields = ('alias', 'title')
+    list_filter = ('state',)
+
+
+admin.site.register(Push, PushAdmin)
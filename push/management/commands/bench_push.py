@@ -0,0 +1,94 @@
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from common import jpush
+from push.models import Push
+from push.utils import send_pushes
+
+# 测试推送的分组前缀 只领取测试推送 不影响队列中的真实推送
+GROUP_PREFIX = 'bench:'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    本地模拟的极光推送接口 记录请求数
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        StandInHandler.requests += 1
+        body = json.dumps({'sendno': '0', 'msg_id': str(StandInHandler.requests)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = '向本地模拟推送接口发送推送 统计吞吐量与合并比例(数据不保留)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=5000, help='推送事件数')
+        parser.add_argument('--recipients', type=int, default=100, help='接收用户数')
+        parser.add_argument('--groups', type=int, default=5, help='每个用户的分组数(如帖子数)')
+        parser.add_argument('--batch', type=int, default=1000, help='每批领取的推送数')
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url, jpush.push_url = jpush.push_url, 'http://127.0.0.1:{}/v3/push'.format(server.server_port)
+        # 不输出每个请求的调试日志
+        jpush_logger = logging.getLogger('jpush')
+        level = jpush_logger.level
+        jpush_logger.setLevel(logging.WARNING)
+        try:
+            with transaction.atomic():
+                self.bench(options)
+                transaction.set_rollback(True)
+        finally:
+            jpush.push_url = url
+            jpush_logger.setLevel(level)
+            server.shutdown()
+
+    def bench(self, options):
+        rng = random.Random(0)
+        now = timezone.now()
+        pushes = []
+        for index in range(options['events']):
+            post = rng.randrange(options['groups'])
+            pushes.append(Push(alias=str(rng.randrange(options['recipients'])), title='帖子点赞',
+                               msg_content='用户{}赞了您的帖子'.format(index),
+                               extras=json.dumps({'operation': 'post_like', 'post': post}),
+                               group='{}post_like:{}'.format(GROUP_PREFIX, post),
+                               summary='用户{}和其他{{others}}人赞了您的帖子'.format(index), next_time=now))
+        Push.objects.bulk_create(pushes)
+
+        StandInHandler.requests = 0
+        start = time.perf_counter()
+        while True:
+            claimed = Push.claim(Push.get_due_ids(options['batch'], GROUP_PREFIX))
+            if not claimed:
+                break
+            send_pushes(claimed)
+        elapsed = time.perf_counter() - start
+
+        events = options['events']
+        calls = StandInHandler.requests
+        self.stdout.write('事件{} 接口调用{} 合并比例{:.1f}:1 耗时{:.3f}s 吞吐量{:.0f}事件/s'.format(
+            events, calls, events / max(calls, 1), elapsed, events / elapsed))
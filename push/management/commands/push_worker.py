@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from push.models import Push
+from push.utils import send_pushes
+
+
+class Command(BaseCommand):
+    help = '发送推送队列中的推送 合并同组推送 失败时按指数退避重试'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', dest='once', help='发送一批后退出')
+        parser.add_argument('--batch', type=int, default=1000, help='每批领取的推送数')
+        parser.add_argument('--interval', type=float, default=1.0, help='队列为空时的等待秒数')
+
+    def handle(self, *args, **options):
+        while True:
+            pushes = Push.claim(Push.get_due_ids(options['batch']))
+            if pushes:
+                send_pushes(pushes)
+            if options['once']:
+                self.stdout.write('已处理{}条推送'.format(len(pushes)))
+                break
+            if not pushes:
+                time.sleep(options['interval'])
@@ -0,0 +1,134 @@
+import json
+from datetime import timedelta
+
+from django.db import models
+from django.db.models import F
+from django.conf import settings
+from django.utils import timezone
+
+
+# 推送队列 请求中只写入队列 由push_worker在后台发送
+class Push(models.Model):
+    # 别名 既用户ID
+    alias = models.CharField(max_length=255,
+                             verbose_name=u'别名')
+    # 标题
+    title = models.CharField(max_length=255,
+                             verbose_name=u'标题')
+    # 内容
+    msg_content = models.TextField(verbose_name=u'内容')
+    # 附加字段 JSON
+    extras = models.TextField(blank=True,
+                              verbose_name=u'附加字段')
+    # 合并分组 同一用户同一分组在合并窗口内的推送合并为一条
+    group = models.CharField(max_length=255,
+                             blank=True,
+                             verbose_name=u'合并分组')
+    # 合并后的内容模板 {others}为其余推送数
+    summary = models.TextField(blank=True,
+                               verbose_name=u'合并内容')
+    STATE = {
+        0: u'待发送',
+        1: u'发送中',
+        2: u'已发送',
+        3: u'发送失败',
+    }
+    # 状态
+    state = models.PositiveIntegerField(choices=STATE.items(),
+                                        default=0,
+                                        verbose_name=u'状态')
+    # 已尝试次数
+    attempts = models.PositiveIntegerField(default=0,
+                                           verbose_name=u'已尝试次数')
+    # 下次发送时间 发送中时为领取超时时间
+    next_time = models.DateTimeField(default=timezone.now,
+                                     verbose_name=u'下次发送时间')
+    # 最近一次错误
+    error = models.CharField(max_length=255,
+                             blank=True,
+                             verbose_name=u'最近一次错误')
+    # 创建时间
+    create_time = models.DateTimeField(auto_now_add=True,
+                                       verbose_name=u'创建时间')
+    # 更新时间
+    update_time = models.DateTimeField(auto_now=True,
+                                       verbose_name=u'更新时间')
+
+    class Meta:
+        verbose_name = '推送'
+        verbose_name_plural = '推送'
+        ordering = ('id',)
+        index_together = (('state', 'next_time'), ('alias', 'group', 'state'))
+
+    @staticmethod
+    def enqueue(alias, title, msg_content, extras=None, group='', summary=''):
+        """
+        写入推送队列
+        :param group: 合并分组 为空时不合并 否则延迟PUSH_COALESCE_WINDOW秒 与窗口内同组的推送一起发送
+        :param summary: 合并后的内容模板
+        """
+        alias = str(alias)
+        next_time = timezone.now()
+        if group:
+            # 对齐到同组第一条待发送推送的发送时间
+            pending = Push.objects.filter(alias=alias, group=group, state=0) \
+                .order_by('next_time').values_list('next_time', flat=True).first()
+            next_time = pending or next_time + timedelta(seconds=settings.PUSH_COALESCE_WINDOW)
+        return Push.objects.create(alias=alias, title=title, msg_content=msg_content,
+                                   extras=json.dumps(extras or {}), group=group, summary=summary,
+                                   next_time=next_time)
+
+    @staticmethod
+    def get_due_ids(limit, group_prefix=''):
+        """
+        :param limit: 最多返回的推送数
+        :param group_prefix: 只返回分组以此开头的推送
+        :return: 到期待发送的和领取超时(发送进程异常退出)的推送ID
+        """
+        queryset = Push.objects.filter(state__in=(0, 1), next_time__lte=timezone.now())
+        if group_prefix:
+            queryset = queryset.filter(group__startswith=group_prefix)
+        # 同组推送的发送时间相同 按别名与分组排序使同组推送尽量在同一批中合并
+        return list(queryset.order_by('next_time', 'alias', 'group', 'id').values_list('id', flat=True)[:limit])
+
+    @staticmethod
+    def claim(ids):
+        """
+        领取推送 同一条推送只会被一个发送进程领取
+        :param ids: 推送ID列表
+        :return: 领取成功的推送
+        """
+        now = timezone.now()
+        claimed = []
+        for pk in ids:
+            # 以条件更新作为乐观锁
+            if Push.objects.filter(id=pk, state__in=(0, 1), next_time__lte=now).update(
+                    state=1, next_time=now + timedelta(seconds=settings.PUSH_CLAIM_TIMEOUT)):
+                claimed.append(pk)
+        return list(Push.objects.filter(id__in=claimed))
+
+    def get_extras(self):
+        return json.loads(self.extras) if self.extras else {}
+
+    @staticmethod
+    def mark_sent(ids):
+        Push.objects.filter(id__in=ids).update(state=2, attempts=F('attempts') + 1, error='',
+                                               update_time=timezone.now())
+
+    def mark_failed(self, error):
+        """
+        发送失败 按指数退避重试 超过最大次数后不再重试
+        :param error: 错误信息
+        """
+        self.attempts += 1
+        self.error = str(error)[:255]
+        if self.attempts >= settings.PUSH_MAX_ATTEMPTS:
+            self.state = 3
+        else:
+            self.state = 0
+            delay = min(settings.PUSH_RETRY_DELAY * 2 ** (self.attempts - 1), settings.PUSH_MAX_RETRY_DELAY)
+            self.next_time = timezone.now() + timedelta(seconds=delay)
+        self.save()
+
+    def __str__(self):
+        return '{} {} {}'.format(self.id, self.alias, self.title)
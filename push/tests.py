@@ -0,0 +1,108 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from common.exception import PushError
+
+from .models import Push
+from .utils import coalesce, batch, send_pushes
+
+
+class PushQueueTests(TestCase):
+    def due(self, push):
+        Push.objects.filter(id=push.id).update(next_time=timezone.now() - timedelta(seconds=1))
+
+    def test_enqueue_aligns_group(self):
+        """
+        同一用户同组的推送对齐到第一条的发送时间
+        """
+        first = Push.enqueue(1, '点赞', 'a赞了您的帖子', group='post_like:1')
+        second = Push.enqueue(1, '点赞', 'b赞了您的帖子', group='post_like:1')
+        other = Push.enqueue(1, '消息', '好友请求')
+        self.assertEqual(first.next_time, second.next_time)
+        self.assertLess(other.next_time, first.next_time)
+
+    def test_claim_once(self):
+        """
+        同一条推送只能被领取一次
+        """
+        push = Push.enqueue(1, '消息', '内容')
+        self.due(push)
+        ids = Push.get_due_ids(10)
+        self.assertEqual(len(Push.claim(ids)), 1)
+        self.assertEqual(Push.claim(ids), [])
+
+    def test_get_due_ids_group_prefix(self):
+        """
+        按分组前缀只返回指定的推送
+        """
+        for group in ('bench:post_like:1', 'post_like:1'):
+            self.due(Push.enqueue(1, '点赞', '内容', group=group))
+        ids = Push.get_due_ids(10, 'bench:')
+        self.assertEqual(list(Push.objects.filter(id__in=ids).values_list('group', flat=True)),
+                         ['bench:post_like:1'])
+
+    def test_mark_failed_backoff(self):
+        """
+        失败后按指数退避重试 超过最大次数后不再重试
+        """
+        push = Push.enqueue(1, '消息', '内容')
+        with self.settings(PUSH_MAX_ATTEMPTS=3, PUSH_RETRY_DELAY=10, PUSH_MAX_RETRY_DELAY=15):
+            push.mark_failed('error')
+            self.assertEqual(push.state, 0)
+            delay = push.next_time - timezone.now()
+            self.assertTrue(timedelta(seconds=9) < delay <= timedelta(seconds=10))
+            push.mark_failed('error')
+            self.assertLessEqual(push.next_time - timezone.now(), timedelta(seconds=15))
+            push.mark_failed('error')
+            self.assertEqual(push.state, 3)
+
+
+class PushCoalesceTests(TestCase):
+    def create(self, alias, group, index):
+        return Push.objects.create(alias=alias, title='点赞', msg_content='用户{}赞了您的帖子'.format(index),
+                                   group=group, summary='用户{}和其他{{others}}人赞了您的帖子'.format(index))
+
+    def test_coalesce(self):
+        """
+        同一用户同组的推送合并为一条 使用最新一条的合并内容
+        """
+        pushes = [self.create('1', 'post_like:1', index) for index in range(3)]
+        messages = coalesce(pushes + [self.create('2', 'post_like:1', 3)])
+        self.assertEqual(len(messages), 2)
+        items, (title, msg_content, extras) = messages[0]
+        self.assertEqual(items, pushes)
+        self.assertEqual(msg_content, '用户2和其他2人赞了您的帖子')
+        self.assertEqual(extras['count'], 3)
+        self.assertEqual(messages[1][1][1], '用户3赞了您的帖子')
+
+    def test_batch(self):
+        """
+        内容相同的消息合并为一次多别名推送
+        """
+        pushes = [Push.objects.create(alias=str(alias), title='系统', msg_content='通知') for alias in range(3)]
+        batches = batch(coalesce(pushes))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0][1], ['0', '1', '2'])
+
+    @mock.patch('common.jpush.audience')
+    def test_send_pushes(self, audience):
+        """
+        发送成功的标记为已发送 失败的等待重试
+        """
+        sent = self.create('1', 'post_like:1', 0)
+        failed = self.create('2', 'post_like:2', 1)
+        audience.side_effect = self.fail_for('2')
+        self.assertEqual(send_pushes([sent, failed]), 2)
+        self.assertEqual(Push.objects.get(id=sent.id).state, 2)
+        failed = Push.objects.get(id=failed.id)
+        self.assertEqual((failed.state, failed.attempts), (0, 1))
+
+    @staticmethod
+    def fail_for(alias):
+        def audience(aliases, *args):
+            if alias in aliases:
+                raise PushError('error', 2)
+        return audience
@@ -0,0 +1,72 @@
+import json
+import logging
+from collections import OrderedDict
+
+from common import jpush
+from common.exception import PushError
+
+logger = logging.getLogger("info")
+
+
+def coalesce(pushes):
+    """
+    合并同一用户同一分组的推送
+    :param pushes: 推送列表
+    :return: [(推送列表, (标题, 内容, 附加字段))] 每项发送一条消息
+    """
+    groups = OrderedDict()
+    for push in pushes:
+        key = (push.alias, push.group) if push.group else push.id
+        groups.setdefault(key, []).append(push)
+    messages = []
+    for items in groups.values():
+        latest = max(items, key=lambda item: item.id)
+        extras = latest.get_extras()
+        msg_content = latest.msg_content
+        if len(items) > 1:
+            extras['count'] = len(items)
+            if latest.summary:
+                msg_content = latest.summary.replace('{others}', str(len(items) - 1))
+        messages.append((items, (latest.title, msg_content, extras)))
+    return messages
+
+
+def batch(messages):
+    """
+    内容相同的消息合并为一次多别名推送
+    :param messages: coalesce的结果
+    :return: [(推送列表, 别名列表, (标题, 内容, 附加字段))] 每项调用一次推送接口
+    """
+    batches = OrderedDict()
+    for items, message in messages:
+        title, msg_content, extras = message
+        key = (title, msg_content, json.dumps(extras, sort_keys=True))
+        batches.setdefault(key, []).append((items, message))
+    result = []
+    for values in batches.values():
+        for start in range(0, len(values), jpush.MAX_ALIAS):
+            chunk = values[start:start + jpush.MAX_ALIAS]
+            items = [push for pushes, message in chunk for push in pushes]
+            aliases = [pushes[0].alias for pushes, message in chunk]
+            result.append((items, aliases, chunk[0][1]))
+    return result
+
+
+def send_pushes(pushes):
+    """
+    合并后发送已领取的推送 失败的推送按指数退避重试
+    :param pushes: 已领取的推送
+    :return: 调用推送接口的次数
+    """
+    from push.models import Push
+    batches = batch(coalesce(pushes))
+    for items, aliases, message in batches:
+        title, msg_content, extras = message
+        try:
+            jpush.audience(aliases, title, msg_content, extras)
+            Push.mark_sent([push.id for push in items])
+        except PushError as e:
+            logger.error('{} {}'.format(e.code, e.message))
+            for push in items:
+                push.mark_failed('{} {}'.format(e.code, e.message))
+    return len(batches)
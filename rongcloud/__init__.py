@@ -15,6 +15,7 @@ from .group import Group
 from .chatroom import Chatroom
 from .push import Push
 from .sms import SMS
+from .base import stats
 
 
 class RongCloud:
@@ -30,3 +31,8 @@ class RongCloud:
         self.Chatroom = Chatroom(app_key, app_secret)
         self.Push = Push(app_key, app_secret)
         self.SMS = SMS(app_key, app_secret)
+
+    @staticmethod
+    def stats():
+        """各接口的调用次数 失败次数 重试次数与耗时(秒) 统计范围为当前进程"""
+        return stats.snapshot()
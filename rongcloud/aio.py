@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+融云 Server API asyncio 客户端
+与RongCloud的方法一致 方法均为协程 在并发上限内同时发出多个请求
+
+    im = AsyncRongCloud(app_key, app_secret, concurrency=20)
+    results = loop.run_until_complete(asyncio.gather(
+        *[im.User.getToken(user.id, user.username, user.get_portrait()) for user in users]))
+"""
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .base import RongCloudBase, Response, stats
+from .user import User
+from .message import Message
+from .wordfilter import Wordfilter
+from .group import Group
+from .chatroom import Chatroom
+from .push import Push
+from .sms import SMS
+
+
+class AsyncRongCloudBase(RongCloudBase):
+    """
+    请求在线程池中通过共用的keep-alive Session发出 签名 超时 重试与耗时统计与同步客户端相同
+    """
+
+    def __init__(self, key, secret, client):
+        self.pool_size = client.concurrency
+        super(AsyncRongCloudBase, self).__init__(key, secret)
+        self._client = client
+
+    def _http_call(self, url, method, **kwargs):
+        # 推迟到线程池中执行
+        return functools.partial(RongCloudBase._http_call, self, url, method, **kwargs)
+
+
+def _async_method(func):
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        async with self._client.get_semaphore():
+            # 取得并发名额后再生成签名 避免排队过久时间戳过期
+            result = func(self, *args, **kwargs)
+            # 同步方法须以Response(self.call_api(...), desc)返回 call_api此时返回推迟执行的请求
+            # 否则请求已在事件循环线程中发出 或返回值不是Response
+            if not isinstance(result, Response) or not isinstance(result.response, functools.partial):
+                raise TypeError('{} 须返回Response(self.call_api(...), desc)'.format(func.__qualname__))
+            loop = asyncio.get_event_loop()
+            result.response = await loop.run_in_executor(self._client.executor, result.response)
+        return result
+
+    return wrapper
+
+
+def _make_async(cls):
+    """
+    公开方法须只调用一次call_api 并返回Response(call_api的返回值, desc)
+    call_api在异步类中返回推迟执行的请求 由协程放入线程池执行后替换为真正的响应
+    :param cls: 同步接口类 如User
+    :return: 公开方法均为协程的接口类
+    """
+    attrs = {name: _async_method(value) for name, value in vars(cls).items()
+             if callable(value) and not name.startswith('_')}
+    return type('Async' + cls.__name__, (AsyncRongCloudBase, cls), attrs)
+
+
+AsyncUser = _make_async(User)
+AsyncMessage = _make_async(Message)
+AsyncWordfilter = _make_async(Wordfilter)
+AsyncGroup = _make_async(Group)
+AsyncChatroom = _make_async(Chatroom)
+AsyncPush = _make_async(Push)
+AsyncSMS = _make_async(SMS)
+
+
+class AsyncRongCloud:
+    def __init__(self, app_key=None, app_secret=None, concurrency=10):
+        """
+        :param concurrency: 同时进行的请求数上限
+        """
+        if app_key is None:
+            app_key = os.environ.get('IM_KEY', '')
+        if app_secret is None:
+            app_secret = os.environ.get('IM_SECRET', '')
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(concurrency)
+        self._semaphore = None
+        self.User = AsyncUser(app_key, app_secret, self)
+        self.Message = AsyncMessage(app_key, app_secret, self)
+        self.Wordfilter = AsyncWordfilter(app_key, app_secret, self)
+        self.Group = AsyncGroup(app_key, app_secret, self)
+        self.Chatroom = AsyncChatroom(app_key, app_secret, self)
+        self.Push = AsyncPush(app_key, app_secret, self)
+        self.SMS = AsyncSMS(app_key, app_secret, self)
+
+    def get_semaphore(self):
+        # 在事件循环中创建
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    @staticmethod
+    def stats():
+        """各接口的调用次数 失败次数 重试次数与耗时(秒) 与同步客户端共用"""
+        return stats.snapshot()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -7,17 +7,126 @@ import json
 import logging
 import random
 import hashlib
-import datetime
+import threading
+from collections import deque
+
 import requests
+from requests.adapters import HTTPAdapter
+
+# 每个app key与连接池大小共用一个Session 复用keep-alive连接
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(app_key, pool_size):
+    """
+    :param app_key: 融云app key
+    :param pool_size: 连接池大小
+    :return: 共用的requests.Session
+    """
+    key = (app_key, pool_size)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions[key] = session
+    return session
+
+
+class LatencyStats(object):
+    """
+    按接口统计调用次数 失败次数 重试次数与耗时
+    """
+    # 每个接口保留最近的耗时样本数 用于计算分位数
+    samples = 1000
+    # 汇总日志输出间隔(秒)
+    log_interval = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._actions = {}
+        self._last_log = time.time()
+
+    def record(self, action, duration, ok=True, retries=0):
+        with self._lock:
+            item = self._actions.get(action)
+            if item is None:
+                item = self._actions[action] = {'count': 0, 'errors': 0, 'retries': 0, 'total': 0.0,
+                                                'max': 0.0, 'recent': deque(maxlen=self.samples)}
+            item['count'] += 1
+            item['errors'] += 0 if ok else 1
+            item['retries'] += retries
+            item['total'] += duration
+            item['max'] = max(item['max'], duration)
+            item['recent'].append(duration)
+            should_log = time.time() - self._last_log >= self.log_interval
+            if should_log:
+                self._last_log = time.time()
+        if should_log:
+            for name, value in sorted(self.snapshot().items()):
+                logging.info("RongCloud {0}: {1}".format(name, value))
+
+    def snapshot(self):
+        """
+        :return: {接口: {count, errors, retries, avg, p50, p95, max}} 耗时单位为秒
+        """
+        with self._lock:
+            items = {action: dict(item, recent=sorted(item['recent'])) for action, item in self._actions.items()}
+        result = {}
+        for action, item in items.items():
+            recent = item['recent']
+            result[action] = {
+                'count': item['count'],
+                'errors': item['errors'],
+                'retries': item['retries'],
+                'avg': item['total'] / item['count'],
+                'p50': recent[int(len(recent) * 0.5)],
+                'p95': recent[min(int(len(recent) * 0.95), len(recent) - 1)],
+                'max': item['max'],
+            }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._actions = {}
+
+
+stats = LatencyStats()
 
 
 class RongCloudBase(object):
     api_host = "http://api.cn.ronghub.com"
     sms_host = "http://api.sms.ronghub.com"
+    # (连接超时, 读取超时) 秒
+    timeout = (3.05, 10)
+    # 连接池大小
+    pool_size = 10
+    # 幂等接口失败后的重试次数
+    retries = 2
+    # 重试间隔(秒) 每次翻倍
+    backoff = 0.2
+    # 重复调用结果不变的接口 连接失败 超时或5xx时可以重试
+    idempotent_actions = (
+        '/user/getToken.json',
+        '/user/refresh.json',
+        '/user/checkOnline.json',
+        '/user/block.json',
+        '/user/unblock.json',
+        '/user/block/query.json',
+        '/user/blacklist/add.json',
+        '/user/blacklist/query.json',
+        '/user/blacklist/remove.json',
+    )
 
     def __init__(self, key='', secret=''):
         self._app_key = key
         self._app_secret = secret
+        self._session = get_session(key, self.pool_size)
 
     @staticmethod
     def _merge_dict(data, *override):
@@ -47,19 +156,42 @@ class RongCloudBase(object):
         return self._merge_dict(self._make_common_signature(),
                                 {"content-type": content_type})
 
-    def _http_call(self, url, method, **kwargs):
-        """Makes a http call. Logs response information."""
+    def _http_call(self, url, method, action=None, idempotent=None, **kwargs):
+        """Makes a http call. Logs response information.
+        :param action: 接口路径 用于统计耗时
+        :param idempotent: 是否可以重试 默认按idempotent_actions判断
+        """
+        action = action or url
+        if idempotent is None:
+            idempotent = action in self.idempotent_actions
+        kwargs.setdefault('timeout', self.timeout)
         logging.debug("Request[{0}]: {1}".format(method, url))
-        start_time = datetime.datetime.now()
-
         logging.debug("Header: {0}".format(kwargs['headers']))
         logging.debug("Params: {0}".format(kwargs['data']))
-        response = requests.request(method, url, verify=False, **kwargs)
 
-        duration = datetime.datetime.now() - start_time
-        logging.debug("Response[{0:d}]: {1}, Duration: {2}.{3}s.".format(
-            response.status_code, response.reason, duration.seconds,
-            duration.microseconds))
+        start_time = time.time()
+        attempt = 0
+        while True:
+            try:
+                response = self._session.request(method, url, **kwargs)
+                if response.status_code < 500 or not idempotent or attempt >= self.retries:
+                    break
+            except requests.exceptions.ConnectTimeout:
+                # 未建立连接 请求未发出 任何接口都可以重试
+                if attempt >= self.retries:
+                    stats.record(action, time.time() - start_time, False, attempt)
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not idempotent or attempt >= self.retries:
+                    stats.record(action, time.time() - start_time, False, attempt)
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+        duration = time.time() - start_time
+        stats.record(action, duration, response.ok, attempt)
+        logging.debug("Response[{0:d}]: {1}, Duration: {2:.3f}s, Retries: {3}.".format(
+            response.status_code, response.reason, duration, attempt))
         return response
 
     def _filter_params(self, params):
@@ -89,6 +221,7 @@ class RongCloudBase(object):
         return self._http_call(
             url=url + action,
             method=methodname,
+            action=action,
             data=data,
             headers=self._headers(content_type),
             **kwargs)
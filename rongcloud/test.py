@@ -1,16 +1,25 @@
 #! /usr/bin/env python
 # coding=utf-8
 import json
+import time
+import asyncio
 import logging
 import os
+import threading
 import unittest
+from unittest import mock
 
-from common.rongcloud import RongCloud
+import requests
+
+from rongcloud import RongCloud
+from rongcloud.aio import AsyncRongCloud, AsyncUser, _async_method
+from rongcloud.base import RongCloudBase, Response, stats
 
 FORMAT = '%(asctime)-15s %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
 
+@unittest.skipUnless(os.environ.get('APP_KEY'), '需要设置APP_KEY APP_SECRET 访问融云接口')
 class Example(unittest.TestCase):
     def setUp(self):
         app_key = os.environ['APP_KEY']
@@ -430,5 +439,171 @@ class Example(unittest.TestCase):
         self.assertEqual(r.result['code'], 200)
 
 
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, result=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.reason = 'OK' if self.ok else 'Error'
+        self._result = result or {'code': 200}
+
+    def json(self):
+        return self._result
+
+
+class FakeSession(object):
+    """
+    按顺序返回预设的结果 结果为异常时抛出 记录请求的接口
+    """
+
+    def __init__(self, results=None):
+        self.results = list(results or [])
+        self.actions = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self.actions.append(url.split('.com', 1)[1])
+            result = self.results.pop(0) if self.results else FakeResponse(result=dict(kwargs['data'], code=200))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class MockedSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.session = FakeSession()
+        patchers = [mock.patch('rongcloud.base.get_session', return_value=self.session),
+                    mock.patch.object(RongCloudBase, 'backoff', 0)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        stats.reset()
+        self.addCleanup(stats.reset)
+
+
+class RetryTests(MockedSessionTestCase):
+    def setUp(self):
+        super(RetryTests, self).setUp()
+        self.rcloud = RongCloud('key', 'secret')
+
+    def test_idempotent_retry(self):
+        """
+        幂等接口连接失败、超时或5xx时重试
+        """
+        self.session.results = [requests.exceptions.ConnectionError(), requests.exceptions.ReadTimeout(),
+                                FakeResponse(200, {'code': 200, 'token': 't'})]
+        r = self.rcloud.User.getToken(userId='1', name='name', portraitUri='')
+        self.assertEqual(r.result['token'], 't')
+        self.assertEqual(len(self.session.actions), 3)
+        self.session.results = [FakeResponse(502), FakeResponse(200)]
+        self.assertTrue(self.rcloud.User.checkOnline(userId='1').ok)
+        self.assertEqual(stats.snapshot()['/user/checkOnline.json']['retries'], 1)
+
+    def test_retry_limit(self):
+        """
+        超过重试次数后抛出异常
+        """
+        self.session.results = [requests.exceptions.ConnectionError()] * (RongCloudBase.retries + 1)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.rcloud.User.getToken(userId='1', name='name', portraitUri='')
+        self.assertEqual(len(self.session.actions), RongCloudBase.retries + 1)
+
+    def test_not_idempotent(self):
+        """
+        发送消息等非幂等接口不重试 只有连接超时(请求未发出)时重试
+        """
+        self.session.results = [requests.exceptions.ReadTimeout()]
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.rcloud.Message.publishPrivate(fromUserId='1', toUserId='2', objectName='RC:TxtMsg',
+                                               content=json.dumps({'content': 'hi'}), pushContent='hi')
+        self.assertEqual(self.session.actions, ['/message/private/publish.json'])
+        self.session.results = [FakeResponse(500)]
+        self.assertFalse(self.rcloud.Message.publishPrivate(fromUserId='1', toUserId='2', objectName='RC:TxtMsg',
+                                                            content='{}', pushContent='hi').ok)
+        self.session.results = [requests.exceptions.ConnectTimeout(), FakeResponse(200)]
+        self.assertTrue(self.rcloud.Message.publishPrivate(fromUserId='1', toUserId='2', objectName='RC:TxtMsg',
+                                                           content='{}', pushContent='hi').ok)
+        self.assertEqual(len(self.session.actions), 4)
+
+    def test_stats(self):
+        """
+        成功和失败的调用都计入统计
+        """
+        self.session.results = [FakeResponse(200), FakeResponse(404), requests.exceptions.ReadTimeout()]
+        self.rcloud.Message.publishPrivate(fromUserId='1', toUserId='2', objectName='RC:TxtMsg', content='{}')
+        self.rcloud.Message.publishPrivate(fromUserId='1', toUserId='2', objectName='RC:TxtMsg', content='{}')
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.rcloud.Message.publishPrivate(fromUserId='1', toUserId='2', objectName='RC:TxtMsg', content='{}')
+        item = RongCloud.stats()['/message/private/publish.json']
+        self.assertEqual((item['count'], item['errors'], item['retries']), (3, 2, 0))
+
+
+
+class SlowSession(FakeSession):
+    """
+    请求耗时一段时间 记录同时进行的请求数
+    """
+
+    def __init__(self):
+        super(SlowSession, self).__init__()
+        self.running = 0
+        self.max_running = 0
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)
+        try:
+            return super(SlowSession, self).request(method, url, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+class AsyncClientTests(MockedSessionTestCase):
+    def setUp(self):
+        super(AsyncClientTests, self).setUp()
+        self.session = SlowSession()
+        patcher = mock.patch('rongcloud.base.get_session', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def run_calls(*calls):
+        async def gather():
+            return await asyncio.gather(*calls)
+        return asyncio.run(gather())
+
+    def test_concurrency(self):
+        """
+        同时进行的请求不超过并发上限 结果与同步客户端一致
+        """
+        client = AsyncRongCloud('key', 'secret', concurrency=3)
+        self.addCleanup(client.close)
+        results = self.run_calls(*[client.User.getToken(str(index), 'name', '') for index in range(10)])
+        self.assertEqual(self.session.max_running, 3)
+        sync = RongCloud('key', 'secret')
+        for index, result in enumerate(results):
+            self.assertIsInstance(result, Response)
+            expected = sync.User.getToken(str(index), 'name', '')
+            self.assertEqual((result.status, result.result), (expected.status, expected.result))
+        self.assertEqual(RongCloud.stats()['/user/getToken.json']['count'], 20)
+
+    def test_contract(self):
+        """
+        未按Response(call_api(...), desc)返回的方法报错 不在事件循环线程中发出请求
+        """
+        def eager(self, userId):
+            return Response(RongCloudBase._http_call(self, self.api_host, 'POST', data={}, headers={}), {})
+
+        client = AsyncRongCloud('key', 'secret')
+        self.addCleanup(client.close)
+        user = type('EagerUser', (AsyncUser,), {'eager': _async_method(eager)})('key', 'secret', client)
+        with self.assertRaises(TypeError):
+            self.run_calls(user.eager('1'))
+
+
 if __name__ == "__main__":
     unittest.main()
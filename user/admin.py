@@ -28,11 +28,19 @@ class TelAdmin(admin.ModelAdmin):
 
 # 文件
 class FileAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'filename', 'file', 'ext', 'size', 'update_time']
+    list_display = ['id', 'user', 'filename', 'file', 'ext', 'size', 'thumbnail_state', 'update_time']
+    list_filter = ('thumbnail_state',)
     search_fields = ('filename',)
     readonly_fields = ('ext', 'size')
 
 
+# 分片上传
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['upload_id', 'user', 'filename', 'size', 'part_size', 'state', 'create_time']
+    search_fields = ('upload_id', 'filename')
+    list_filter = ('state',)
+
+
 # 协议
 class AgreementAdmin(admin.ModelAdmin):
     list_display = ['user', 'version', 'is_agree', 'is_abandon', 'update_time']
@@ -46,4 +54,5 @@ class AgreementAdmin(admin.ModelAdmin):
 admin.site.register(User, MyUserAdmin)
 admin.site.register(TelVerify, TelAdmin)
 admin.site.register(File, FileAdmin)
+admin.site.register(UploadSession, UploadSessionAdmin)
 admin.site.register(Agreement, AgreementAdmin)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from common.utils import sizeof_fmt, get_file_digest
+from user.models import File
+
+
+class Command(BaseCommand):
+    help = '为已有文件补全字节大小与内容摘要'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-digest', action='store_true', dest='no_digest',
+                            help='只补全大小 不下载文件计算摘要')
+
+    def handle(self, *args, **options):
+        count = 0
+        failed = 0
+        files = File.objects.filter(Q(byte_size=0) | Q(digest='')).exclude(file='')
+        for instance in files.iterator():
+            try:
+                values = {}
+                if not instance.byte_size:
+                    values['byte_size'] = instance.file.size
+                    values['size'] = sizeof_fmt(values['byte_size'])
+                if not instance.digest and not options['no_digest']:
+                    # 流式下载计算摘要
+                    instance.file.open('rb')
+                    values['digest'] = get_file_digest(instance.file)
+                    instance.file.close()
+                if values:
+                    File.objects.filter(id=instance.id).update(**values)
+                    count += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write('文件{} {}'.format(instance.id, e))
+        self.stdout.write('已补全{}个文件 失败{}个'.format(count, failed))
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from user.models import File, UploadSession
+from user.uploads import get_multipart_upload
+
+
+class Command(BaseCommand):
+    help = '取消超过UPLOAD_SESSION_EXPIRE仍未完成的分片上传 释放OSS分片与本地暂存文件'
+
+    def handle(self, *args, **options):
+        multipart_upload = get_multipart_upload(File._meta.get_field('file').storage)
+        expire_time = timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_EXPIRE)
+        count = 0
+        for instance in UploadSession.objects.filter(state=0, update_time__lt=expire_time):
+            try:
+                multipart_upload.abort_multipart_upload(instance.name, instance.backend_id)
+            except Exception as e:
+                self.stderr.write('{} {}'.format(instance.upload_id, e))
+                continue
+            instance.state = 2
+            instance.save()
+            instance.parts.all().delete()
+            count += 1
+        self.stdout.write('已取消{}个分片上传'.format(count))
@@ -0,0 +1,20 @@
+from django.core.files.storage import get_storage_class
+from django.core.management.base import BaseCommand, CommandError
+
+from common.storage import AliyunBaseStorage
+
+
+class Command(BaseCommand):
+    help = '创建OSS Bucket并设置访问权限 部署时执行一次'
+
+    def handle(self, *args, **options):
+        storage = get_storage_class()()
+        if not isinstance(storage, AliyunBaseStorage):
+            raise CommandError('DEFAULT_FILE_STORAGE不是OSS存储')
+        result = storage.provision_bucket()
+        if result == 'created':
+            self.stdout.write('已创建Bucket {}'.format(storage.bucket_name))
+        elif result == 'checked':
+            self.stdout.write('Bucket {} 已存在 权限已检查'.format(storage.bucket_name))
+        else:
+            self.stdout.write('无权列举或创建Bucket 跳过')
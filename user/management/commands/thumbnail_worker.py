@@ -0,0 +1,33 @@
+import time
+import operator
+from functools import reduce
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from user.models import File
+from user.thumbnails import THUMBNAIL_EXTS
+
+
+class Command(BaseCommand):
+    help = '在进程池中为上传的图片生成缩略图'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', dest='once', help='处理一批后退出')
+        parser.add_argument('--batch', type=int, default=100, help='每批处理的文件数')
+        parser.add_argument('--interval', type=float, default=5.0, help='没有待处理文件时的等待秒数')
+        parser.add_argument('--backfill', action='store_true', dest='backfill',
+                            help='将已有的图片(含生成失败的)标记为待生成')
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            images = reduce(operator.or_, [Q(ext__iexact=ext) for ext in THUMBNAIL_EXTS])
+            count = File.objects.filter(images, thumbnail_state__in=(0, 3)).exclude(file='').update(thumbnail_state=1)
+            self.stdout.write('已标记{}个文件'.format(count))
+        while True:
+            count = File.generate_thumbnails(options['batch'])
+            if options['once']:
+                self.stdout.write('已处理{}个文件'.format(count))
+                break
+            if not count:
+                time.sleep(options['interval'])
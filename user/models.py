@@ -1,28 +1,41 @@
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from collections import OrderedDict
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models.fields.files import FieldFile
 from django.conf import settings
 from django.utils import timezone
 from django.core.validators import RegexValidator
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import PermissionsMixin
 from django.contrib.auth.models import AbstractBaseUser, UserManager
+from django_cleanup import cleanup
 
 from rest_framework_jwt.settings import api_settings
 
 from common.models import Base
-from common.utils import get_time_filename, send_sms, sizeof_fmt, validate_file_size
+from common.storage import MetadataCache
+from common.utils import get_time_filename, send_sms, sizeof_fmt, validate_file_size, get_file_digest
 from common.exception import SmsError
+from common.constants import FriendState
 from friend.models import Friend
 
+from .thumbnails import has_thumbnails, get_thumbnail_format, get_thumbnail_ext, get_thumbnail_name, \
+    delete_thumbnails, generate_thumbnails
+
 from rongcloud import RongCloud
 
 # 融云实例
 im = RongCloud(settings.IM_KEY, settings.IM_SECRET)
 
 
+# 文件地址缓存 文件名对应的地址不变 不必每次序列化都由存储重新计算
+url_cache = MetadataCache(settings.MEDIA_URL_CACHE_SIZE, settings.OSS_METADATA_CACHE_TTL)
+
+
 def get_portrait_path(instance, filename):
     return 'user/{}'.format(get_time_filename(filename))
 
@@ -116,24 +129,58 @@ class User(AbstractBaseUser, PermissionsMixin):
     def get_full_name(self, user=None):
         full_name = self.nickname if self.nickname else self.username
         if user:
-            try:
-                friend = Friend.objects.get(from_user=user, to_user=self, state=2)
-                return friend.remark if friend.remark else full_name
-            except (Friend.DoesNotExist, Friend.MultipleObjectsReturned):
-                return full_name
+            remark = User.get_remarks(user, to_users=[self.id], state=FriendState.Agree).get(self.id)
+            return remark if remark else full_name
         else:
             return full_name
 
     get_full_name.short_description = '全名'
 
+    @staticmethod
+    def get_remarks(user, to_users=None, state=None):
+        """
+        批量获取user为其他用户设置的备注名 一次查询
+        :param user: 关系起始人
+        :param to_users: 关系结束人ID列表 None时获取全部
+        :param state: 好友状态 None时不限
+        :return: {to_user_id: remark} 存在多条关系的用户不返回
+        """
+        queryset = Friend.objects.filter(from_user=user)
+        if to_users is not None:
+            queryset = queryset.filter(to_user__in=to_users)
+        if state is not None:
+            queryset = queryset.filter(state=state)
+        remarks = {}
+        duplicates = set()
+        for to_user_id, remark in queryset.values_list('to_user_id', 'remark'):
+            if to_user_id in remarks:
+                duplicates.add(to_user_id)
+            remarks[to_user_id] = remark
+        for to_user_id in duplicates:
+            del remarks[to_user_id]
+        return remarks
+
+    @staticmethod
+    def get_full_names(users, user=None):
+        """
+        批量获取全名 user为好友时使用备注名
+        :param users: 用户列表
+        :param user: 查看人
+        :return: {user_id: full_name}
+        """
+        remarks = User.get_remarks(user, [u.id for u in users], FriendState.Agree) if user else {}
+        return {u.id: remarks.get(u.id) or u.get_full_name() for u in users}
+
     # 获取名称
     def get_short_name(self):
         return self.nickname
 
-    # 获取头像
-    def get_portrait(self):
+    # 获取头像 size为缩略图尺寸名 默认为原图
+    def get_portrait(self, size=None):
         if self.portrait:
-            return self.portrait.file.url
+            if size:
+                return self.portrait.get_thumbnail_url(size)
+            return self.portrait.get_url()
         else:
             if self.gender == 0:
                 return '/static/default/user/default_female.png'
@@ -294,9 +341,38 @@ class TelVerify(models.Model):
 
 
 def get_file_path(instance, filename):
+    # 以内容摘要命名 相同内容对应同一个OSS文件
+    if instance.digest:
+        ext = os.path.splitext(filename)[1].lower()
+        return 'file/{}/{}{}'.format(instance.digest[:2], instance.digest, ext)
     return 'file/{}'.format(get_time_filename(filename))
 
 
+class SharedFieldFile(FieldFile):
+    """
+    可被多条记录引用的文件 仍有其他记录引用时只解除引用 不删除OSS文件
+    """
+
+    def delete(self, save=True):
+        if self.name:
+            others = self.field.model._default_manager.filter(**{self.field.name: self.name})
+            pk = getattr(self.instance, 'pk', None)
+            if pk is not None:
+                others = others.exclude(pk=pk)
+            if others.exists():
+                self.name = None
+                setattr(self.instance, self.field.name, self.name)
+                if save:
+                    self.instance.save()
+                return
+            delete_thumbnails(self.storage, self.name)
+        super(SharedFieldFile, self).delete(save)
+
+
+class SharedFileField(models.FileField):
+    attr_class = SharedFieldFile
+
+
 # 文件
 class File(models.Model):
     # 上传人
@@ -306,9 +382,11 @@ class File(models.Model):
                              blank=True,
                              verbose_name=u'上传人')
     # 文件
-    file = models.FileField(upload_to=get_file_path,
-                            validators=[validate_file_size],
-                            verbose_name=u'文件')
+    # 文件 内容相同的记录共用同一个OSS文件
+    file = SharedFileField(upload_to=get_file_path,
+                           validators=[validate_file_size],
+                           db_index=True,
+                           verbose_name=u'文件')
     # 文件名
     filename = models.CharField(max_length=255,
                                 blank=True,
@@ -321,6 +399,29 @@ class File(models.Model):
     size = models.CharField(max_length=255,
                             blank=True,
                             verbose_name=u'文件大小')
+    # 文件大小(字节)
+    byte_size = models.BigIntegerField(default=0,
+                                       verbose_name=u'文件大小(字节)')
+    # 文件内容sha256
+    digest = models.CharField(max_length=64,
+                              blank=True,
+                              db_index=True,
+                              verbose_name=u'文件摘要')
+    THUMBNAIL_STATE = {
+        0: u'无缩略图',
+        1: u'待生成',
+        2: u'已生成',
+        3: u'生成失败',
+    }
+    # 缩略图状态 图片上传后由thumbnail_worker生成缩略图
+    thumbnail_state = models.PositiveIntegerField(choices=THUMBNAIL_STATE.items(),
+                                                  default=0,
+                                                  db_index=True,
+                                                  verbose_name=u'缩略图状态')
+    # 缩略图扩展名 生成时确定 各进程对WebP的支持可能不同 地址按记录的格式生成
+    thumbnail_ext = models.CharField(max_length=8,
+                                     blank=True,
+                                     verbose_name=u'缩略图格式')
     # 创建时间
     create_time = models.DateTimeField(auto_now_add=True,
                                        verbose_name=u'创建时间')
@@ -333,28 +434,361 @@ class File(models.Model):
         verbose_name_plural = '文件'
         ordering = ('-id',)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(File, cls).from_db(db, field_names, values)
+        # 记录数据库中的文件名 修改时无需再查询一次 文件字段未加载(defer/only)时保存时再查询
+        if 'file' not in instance.get_deferred_fields():
+            instance._original_file = instance.__dict__.get('file')
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super(File, self).refresh_from_db(*args, **kwargs)
+        self._original_file = self.file.name
+
     def save(self, *args, **kwargs):
-        if not self.id:
+        if self.file.name not in (self.get_original_file(), getattr(self, '_info_file', None)):
             self.set_info()
-        else:
-            # 改
-            this = File.objects.get(id=self.id)
-            if this.file != self.file:
-                this.file.delete(save=False)
-                self.set_info()
-        return super(File, self).save(*args, **kwargs)
+        upload = None
+        uploaded = None
+        if not self.file._committed:
+            upload = self.file
+            stored = self.get_stored_file()
+            if stored:
+                self.use_file(stored)
+            else:
+                # 在事务之外上传 上传期间不持有行锁
+                uploaded = self.save_file(upload)
+        try:
+            with transaction.atomic():
+                if upload is not None and uploaded is None and not self.lock_stored_file():
+                    # 引用的文件已被同时删除 重新上传
+                    uploaded = self.save_file(upload)
+                result = super(File, self).save(*args, **kwargs)
+        except Exception:
+            File.release_files([uploaded] if uploaded else [])
+            raise
+        # 原文件由django_cleanup在提交后通过SharedFieldFile.delete释放 新建记录后需刷新其记录的原文件
+        cleanup.refresh(self)
+        self._original_file = self.file.name
+        return result
+
+    def get_original_file(self):
+        """
+        :return: 数据库中的文件名 新建的记录为None
+        """
+        if not self.id:
+            return None
+        if hasattr(self, '_original_file'):
+            return self._original_file
+        return File.objects.filter(id=self.id).values_list('file', flat=True).first()
+
+    def get_stored_file(self):
+        """
+        :return: 内容与格式相同的已存储文件名 没有时返回None
+        """
+        if not self.digest:
+            return None
+        return File.objects.filter(digest=self.digest, byte_size=self.byte_size, ext__iexact=self.ext) \
+            .exclude(file='').values_list('file', flat=True).first()
+
+    def use_file(self, name):
+        """
+        引用已存储的文件 文件信息不变
+        :param name: 存储中的文件名
+        """
+        self.file = name
+        self._info_file = name
+
+    def save_file(self, upload):
+        """
+        上传文件
+        :param upload: 上传的文件
+        :return: 存储中的文件名
+        """
+        self.file = upload
+        self.file.save(upload.name, upload.file, save=False)
+        self._info_file = self.file.name
+        return self.file.name
+
+    def lock_stored_file(self):
+        """
+        锁定引用同一文件的记录 避免其同时被删除后文件随之删除
+        :return: 是否仍有记录引用该文件
+        """
+        return len(File.objects.select_for_update().filter(file=self.file.name).values_list('id', flat=True)) > 0
+
+    @staticmethod
+    def bulk_upload(uploads, user=None):
+        """
+        在线程池中并行上传多个文件 上传在事务之外进行 全部成功后在一个事务中插入所有记录
+        内容相同的文件只上传一次 已有的文件直接引用 任一文件上传失败或插入失败时删除本次上传的文件
+        :param uploads: 已校验的上传文件列表
+        :param user: 上传人
+        :return: 新建的文件记录 与uploads顺序一致
+        """
+        instances = [File(user=user, file=upload) for upload in uploads]
+        for instance in instances:
+            instance.set_info()
+        stored = {(digest, byte_size, ext.lower()): name for digest, byte_size, ext, name in
+                  File.objects.filter(digest__in={instance.digest for instance in instances}).exclude(file='')
+                      .values_list('digest', 'byte_size', 'ext', 'file')}
+        # 每种内容只上传第一个
+        pending = OrderedDict()
+        for instance in instances:
+            key = instance.get_content_key()
+            if key not in stored:
+                pending.setdefault(key, instance)
+
+        storage = File._meta.get_field('file').storage
+
+        def upload(instance):
+            return storage.save(get_file_path(instance, instance.file.name), instance.file.file)
+
+        uploaded = {}
+        error = None
+        with ThreadPoolExecutor(settings.FILE_UPLOAD_THREADS) as executor:
+            futures = [(key, executor.submit(upload, instance)) for key, instance in pending.items()]
+            for key, future in futures:
+                try:
+                    uploaded[key] = future.result()
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            File.release_files(uploaded.values())
+            raise error
+
+        try:
+            with transaction.atomic():
+                # 锁定被引用的记录 被同时删除的文件重新上传
+                reused = set(stored.values())
+                locked = set(File.objects.select_for_update().filter(file__in=reused).values_list('file', flat=True))
+                for key, name in stored.items():
+                    if name not in locked:
+                        uploaded[key] = upload(next(instance for instance in instances
+                                                    if instance.get_content_key() == key))
+                # 文件均已上传 逐条插入以取得各自的ID
+                for instance in instances:
+                    key = instance.get_content_key()
+                    instance.use_file(uploaded.get(key) or stored[key])
+                    instance.save()
+        except Exception:
+            File.release_files(uploaded.values())
+            raise
+        return instances
+
+    def get_content_key(self):
+        """
+        :return: 判断内容与格式相同的键
+        """
+        return self.digest, self.byte_size, self.ext.lower()
+
+    @staticmethod
+    def release_files(names):
+        for name in names:
+            File.release_file(name)
+
+    @staticmethod
+    def release_file(name):
+        """
+        没有记录引用时删除OSS文件
+        :param name: 文件名
+        """
+        if not File.objects.filter(file=name).exists():
+            storage = File._meta.get_field('file').storage
+            delete_thumbnails(storage, name)
+            storage.delete(name)
+
+    @staticmethod
+    def generate_thumbnails(limit):
+        """
+        为待生成缩略图的文件生成缩略图 引用同一OSS文件的记录只生成一次
+        :param limit: 最多处理的文件记录数
+        :return: 处理的文件记录数
+        """
+        pending = list(File.objects.filter(thumbnail_state=1).order_by('id')[:limit].values_list('id', 'file'))
+        names = {name for pk, name in pending}
+        ids = [pk for pk, name in pending]
+        # 内容相同的文件已生成过缩略图 沿用其格式
+        done = dict(File.objects.filter(file__in=names, thumbnail_state=2).values_list('file', 'thumbnail_ext'))
+        for name, ext in done.items():
+            File.objects.filter(id__in=ids, file=name).update(thumbnail_state=2, thumbnail_ext=ext)
+        fmt = get_thumbnail_format()
+        errors = generate_thumbnails(File._meta.get_field('file').storage, sorted(names - set(done)), fmt)
+        File.objects.filter(id__in=ids, thumbnail_state=1).exclude(file__in=errors.keys()) \
+            .update(thumbnail_state=2, thumbnail_ext=get_thumbnail_ext(fmt))
+        File.objects.filter(id__in=ids, file__in=errors.keys()).update(thumbnail_state=3)
+        return len(pending)
+
+    @staticmethod
+    def get_file_url(name):
+        """
+        :param name: 存储中的文件名
+        :return: 文件地址 按文件名缓存
+        """
+        item = url_cache.get(name)
+        if item is None:
+            url = File._meta.get_field('file').storage.url(name)
+            url_cache.set(name, url=url)
+            return url
+        return item['url']
+
+    def get_url(self):
+        """
+        :return: 文件地址 没有文件时为空
+        """
+        if not self.file:
+            return ''
+        return File.get_file_url(self.file.name)
+
+    def get_thumbnail_url(self, size):
+        """
+        :param size: 缩略图尺寸名 见settings.THUMBNAIL_SIZES
+        :return: 缩略图地址 缩略图尚未生成时返回原文件地址
+        """
+        if self.thumbnail_state == 2:
+            # 未记录格式的旧记录按当前格式
+            ext = self.thumbnail_ext or get_thumbnail_ext()
+            return File.get_file_url(get_thumbnail_name(self.file.name, size, ext))
+        return self.get_url()
+
+    def get_thumbnail_urls(self):
+        """
+        :return: {尺寸名: 缩略图地址} 不是图片时为空
+        """
+        if self.thumbnail_state in (1, 2):
+            return {size: self.get_thumbnail_url(size) for size in settings.THUMBNAIL_SIZES}
+        return {}
 
     def set_info(self):
-        filename = self.file.name
-        self.filename = filename
-        ext = os.path.splitext(filename)[1][1:]
-        self.ext = ext
-        self.size = sizeof_fmt(self.file.size)
+        # 新建记录引用已存储的文件(分片上传 直传OSS)时保留传入的原文件名 存储中的文件名无意义
+        if self.id or not self.file._committed or not self.filename:
+            self.filename = self.file.name
+        self.ext = os.path.splitext(self.filename)[1][1:]
+        self.byte_size = self.file.size
+        self.size = sizeof_fmt(self.byte_size)
+        self.thumbnail_state = 1 if has_thumbnails(self.filename) else 0
+        self.thumbnail_ext = ''
+        if self.file._committed:
+            # 已在存储中的文件(分片上传 直传OSS) 不为计算摘要下载文件 由backfill_file_info补全
+            # 文件未变时保留已有的摘要
+            if self.file.name != getattr(self, '_original_file', None):
+                self.digest = ''
+        else:
+            # 文件尚未上传 从本地上传的文件计算
+            self.digest = get_file_digest(self.file)
+
+    def get_file_size(self):
+        """
+        :return: 文件大小(字节) 优先使用数据库中记录的大小 避免请求OSS
+        """
+        if self.byte_size:
+            return self.byte_size
+        return self.file.size
 
     def __str__(self):
         return self.filename
 
 
+# 分片上传会话 断线后可以从未上传的分片继续
+class UploadSession(models.Model):
+    # 上传人
+    user = models.ForeignKey('user.User',
+                             on_delete=models.CASCADE,
+                             related_name='upload_session_user',
+                             verbose_name=u'上传人')
+    # 会话ID
+    upload_id = models.CharField(max_length=32,
+                                 unique=True,
+                                 verbose_name=u'会话ID')
+    # 存储的分片上传ID
+    backend_id = models.CharField(max_length=255,
+                                  verbose_name=u'存储上传ID')
+    # 存储中的文件名
+    name = models.CharField(max_length=255,
+                            verbose_name=u'存储文件名')
+    # 原文件名
+    filename = models.CharField(max_length=255,
+                                verbose_name=u'文件名')
+    # 文件大小(字节)
+    size = models.BigIntegerField(verbose_name=u'文件大小(字节)')
+    # 分片大小(字节)
+    part_size = models.PositiveIntegerField(verbose_name=u'分片大小(字节)')
+    STATE = {
+        0: u'上传中',
+        1: u'已完成',
+        2: u'已取消',
+    }
+    # 状态
+    state = models.PositiveIntegerField(choices=STATE.items(),
+                                        default=0,
+                                        verbose_name=u'状态')
+    # 完成后生成的文件
+    file = models.ForeignKey('user.File',
+                             null=True,
+                             blank=True,
+                             on_delete=models.SET_NULL,
+                             related_name='upload_session_file',
+                             verbose_name=u'文件')
+    # 创建时间
+    create_time = models.DateTimeField(auto_now_add=True,
+                                       verbose_name=u'创建时间')
+    # 更新时间
+    update_time = models.DateTimeField(auto_now=True,
+                                       verbose_name=u'更新时间')
+
+    class Meta:
+        verbose_name = '分片上传'
+        verbose_name_plural = '分片上传'
+        ordering = ('-id',)
+
+    @property
+    def part_count(self):
+        return max((self.size + self.part_size - 1) // self.part_size, 1)
+
+    def get_part_length(self, part_number):
+        """
+        :return: 第part_number个分片应有的大小 最后一个分片为剩余大小
+        """
+        if part_number < self.part_count:
+            return self.part_size
+        return self.size - self.part_size * (self.part_count - 1)
+
+    def __str__(self):
+        return '{} {}'.format(self.upload_id, self.filename)
+
+
+# 已上传的分片
+class UploadPart(models.Model):
+    # 上传会话
+    session = models.ForeignKey('user.UploadSession',
+                                on_delete=models.CASCADE,
+                                related_name='parts',
+                                verbose_name=u'上传会话')
+    # 分片序号 从1开始
+    part_number = models.PositiveIntegerField(verbose_name=u'分片序号')
+    # 分片大小(字节)
+    size = models.PositiveIntegerField(verbose_name=u'分片大小(字节)')
+    # 分片内容md5
+    md5 = models.CharField(max_length=32,
+                           verbose_name=u'md5')
+    # 存储返回的etag
+    etag = models.CharField(max_length=255,
+                            verbose_name=u'etag')
+    # 上传时间
+    create_time = models.DateTimeField(auto_now=True,
+                                       verbose_name=u'上传时间')
+
+    class Meta:
+        verbose_name = '分片'
+        verbose_name_plural = '分片'
+        ordering = ('part_number',)
+        unique_together = ('session', 'part_number')
+
+    def __str__(self):
+        return '{} {}'.format(self.session_id, self.part_number)
+
+
 # 协议
 class Agreement(Base):
     # 用户
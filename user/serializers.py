@@ -2,12 +2,22 @@ from django.contrib.auth import password_validation
 from django.contrib.auth.hashers import make_password
 
 from common.serializers import *
-from common.utils import validate_image_ext, sizeof_fmt
-from friend.models import Friend
+from common.utils import validate_image_ext, sizeof_fmt, get_max_upload_size, build_absolute_url
 from .models import *
 from .utils import random_username, is_tel
 
 
+def get_request_remarks(request):
+    """
+    当前请求用户为其他用户设置的备注名 每个请求只查询一次 所有用户序列化类共用
+    :param request: 请求
+    :return: {to_user_id: remark}
+    """
+    if not hasattr(request, '_remarks'):
+        request._remarks = User.get_remarks(request.user)
+    return request._remarks
+
+
 # --------------------------------- 用户 ---------------------------------
 # 创建用户
 class UserCreateSerializer(ModelSerializer):
@@ -72,45 +82,52 @@ class UserExpandSerializer(ModelSerializer):
 # 列表用户
 class UserListSerializer(ModelSerializer):
     portrait = serializers.SerializerMethodField()
+    portrait_thumbnails = serializers.SerializerMethodField()
     full_name = serializers.SerializerMethodField()
 
     class Meta:
         model = User
-        fields = ('id', 'username', 'portrait', 'gender', 'get_gender_display', 'full_name')
+        fields = ('id', 'username', 'portrait', 'portrait_thumbnails', 'gender', 'get_gender_display', 'full_name')
 
     def get_portrait(self, instance):
         request = self.context.get('request')
-        return request.build_absolute_uri(instance.get_portrait())
+        return build_absolute_url(request, instance.get_portrait())
+
+    # 各尺寸头像缩略图
+    def get_portrait_thumbnails(self, instance):
+        request = self.context.get('request')
+        return {size: build_absolute_url(request, instance.get_portrait(size)) for size in settings.THUMBNAIL_SIZES}
 
     def get_full_name(self, instance):
         request = self.context['request']
         if hasattr(request, 'user') and request.user.is_authenticated:
-            try:
-                friend = Friend.objects.get(from_user=request.user, to_user=instance)
-                return friend.remark
-            except (Friend.DoesNotExist, Friend.MultipleObjectsReturned):
-                pass
+            remarks = get_request_remarks(request)
+            if instance.id in remarks:
+                return remarks[instance.id]
         return instance.get_full_name()
 
 
 # 全部信息
 class UserSerializer(ModelSerializer):
     portrait = serializers.SerializerMethodField()
+    portrait_thumbnails = serializers.SerializerMethodField()
     full_name = serializers.SerializerMethodField()
 
     class Meta:
         model = User
-        fields = ('id', 'username', 'tel', 'portrait', 'gender', 'nickname', 'birth_day', 'email',
-                  'location', 'introduction', 'last_login', 'get_gender_display', 'full_name')
+        fields = ('id', 'username', 'tel', 'portrait', 'portrait_thumbnails', 'gender', 'nickname', 'birth_day',
+                  'email', 'location', 'introduction', 'last_login', 'get_gender_display', 'full_name')
 
     def get_portrait(self, instance):
         request = self.context.get('request')
-        return request.build_absolute_uri(instance.get_portrait())
+        return build_absolute_url(request, instance.get_portrait())
+
+    # 各尺寸头像缩略图
+    def get_portrait_thumbnails(self, instance):
+        request = self.context.get('request')
+        return {size: build_absolute_url(request, instance.get_portrait(size)) for size in settings.THUMBNAIL_SIZES}
 
     def get_full_name(self, instance):
-        request = self.context['request']
-        if hasattr(request, 'user') and request.user.is_authenticated:
-            instance.get_full_name(user=request.user)
         return instance.get_full_name()
 
 
@@ -120,7 +137,7 @@ class UserModifySerializer(ModelSerializer):
         if data:
             if not validate_image_ext(data.ext):
                 raise serializers.ValidationError('非法的图片类型')
-            if data.file.size > settings.MAX_IMAGE_SIZE:
+            if data.get_file_size() > settings.MAX_IMAGE_SIZE:
                 raise serializers.ValidationError('文件 {} 大小超过{}'.format(data.filename,
                                                                         sizeof_fmt(settings.MAX_IMAGE_SIZE)))
             request = self.context['request']
@@ -160,9 +177,70 @@ class FileSerializer(ModelSerializer):
 
 # 文件-级联显示
 class FileInlineSerializer(ModelSerializer):
+    file = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
+
     class Meta:
         model = File
-        fields = ('id', 'file', 'filename', 'ext', 'size')
+        fields = ('id', 'file', 'filename', 'ext', 'size', 'thumbnails')
+
+    def get_file(self, instance):
+        if not instance.file:
+            return None
+        return build_absolute_url(self.context.get('request'), instance.get_url())
+
+    # 各尺寸缩略图 不是图片时为空
+    def get_thumbnails(self, instance):
+        request = self.context.get('request')
+        return {size: build_absolute_url(request, url) for size, url in instance.get_thumbnail_urls().items()}
+
+
+# --------------------------------- 分片上传 ---------------------------------
+# 创建分片上传
+class UploadSessionCreateSerializer(ModelSerializer):
+    # 文件名用于生成存储路径 不能包含目录
+    def validate_filename(self, value):
+        if '/' in value or '\\' in value:
+            raise serializers.ValidationError('文件名不能包含路径')
+        return value
+
+    def validate(self, data):
+        max_size = get_max_upload_size(data['filename'])
+        if data['size'] <= 0:
+            raise serializers.ValidationError({'size': '文件大小必须大于0'})
+        if data['size'] > max_size:
+            raise serializers.ValidationError({'size': '文件 {} 大小超过{}'.format(data['filename'],
+                                                                            sizeof_fmt(max_size))})
+        return data
+
+    class Meta:
+        model = UploadSession
+        fields = ('filename', 'size')
+
+
+# 分片上传详情
+class UploadSessionSerializer(ModelSerializer):
+    part_count = serializers.ReadOnlyField()
+    parts = serializers.SerializerMethodField()
+    file = FileInlineSerializer(read_only=True)
+
+    # 已上传的分片序号
+    def get_parts(self, instance):
+        return [part.part_number for part in instance.parts.all()]
+
+    class Meta:
+        model = UploadSession
+        fields = ('upload_id', 'filename', 'size', 'part_size', 'part_count', 'parts', 'state', 'file')
+
+
+# 上传分片
+class UploadPartSerializer(serializers.Serializer):
+    # 分片序号 从1开始
+    part_number = serializers.IntegerField(min_value=1)
+    # 分片内容md5
+    md5 = serializers.RegexField(r'^[0-9a-fA-F]{32}$')
+    # 分片内容
+    file = serializers.FileField()
 
 
 # --------------------------------- 协议 ---------------------------------
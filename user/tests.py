@@ -1,8 +1,23 @@
+import os
+import hashlib
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import override_settings
 from django.urls import reverse
+from PIL import Image
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase, APIRequestFactory, \
+    force_authenticate
 
 from .models import *
+from .serializers import UserListSerializer, FileInlineSerializer
+from .thumbnails import get_thumbnail_name
 
 
 class UserTests(APITestCase):
@@ -18,3 +33,407 @@ class UserTests(APITestCase):
         data = {'tel': tel_verify.tel, 'code': tel_verify.code, 'password': 'Oasis123456'}
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class RemarkTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='viewer', tel='13800000001')
+        self.friends = [User.objects.create(username='friend{}'.format(index), tel='1380000001{}'.format(index),
+                                            nickname='昵称{}'.format(index)) for index in range(3)]
+        Friend.objects.create(from_user=self.user, to_user=self.friends[0], state=FriendState.Agree, remark='备注')
+        Friend.objects.create(from_user=self.user, to_user=self.friends[1], state=FriendState.Pending, remark='')
+
+    def test_full_names(self):
+        """
+        好友使用备注名 没有备注时使用昵称
+        """
+        self.assertEqual(User.get_full_names(self.friends, self.user),
+                         {self.friends[0].id: '备注', self.friends[1].id: '昵称1', self.friends[2].id: '昵称2'})
+        self.assertEqual(self.friends[0].get_full_name(user=self.user), '备注')
+        self.assertEqual(self.friends[0].get_full_name(), '昵称0')
+
+    def test_serializer(self):
+        """
+        同一请求内多个用户序列化只查询一次备注
+        """
+        request = APIRequestFactory().get('/user/')
+        force_authenticate(request, self.user)
+        context = {'request': Request(request)}
+        with self.assertNumQueries(1):
+            data = UserListSerializer(self.friends, many=True, context=context).data
+            UserListSerializer(self.friends[0], context=context).data
+        self.assertEqual([item['full_name'] for item in data], ['备注', '昵称1', '昵称2'])
+
+
+@override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+                   MEDIA_ROOT=tempfile.mkdtemp(), UPLOAD_SPOOL_DIR=tempfile.mkdtemp())
+class FileTestCase(APITransactionTestCase):
+    """
+    不包在事务中 提交后的回调(释放文件)照常执行
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='uploader', tel='13800000000')
+        self.client.force_authenticate(self.user)
+        self.storage = File._meta.get_field('file').storage
+
+    @staticmethod
+    def upload(content, name='a.jpg'):
+        return SimpleUploadedFile(name, content)
+
+    def data(self, response):
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return response.data['data']
+
+
+class FileInfoTests(FileTestCase):
+    def test_set_info(self):
+        """
+        上传时记录字节大小与内容摘要
+        """
+        file = File(user=self.user, file=self.upload(b'hello'))
+        file.save()
+        file = File.objects.get(id=file.id)
+        self.assertEqual((file.byte_size, file.size, file.ext), (5, '5.0B', 'jpg'))
+        self.assertEqual(file.digest, hashlib.sha256(b'hello').hexdigest())
+        self.assertEqual(file.get_file_size(), 5)
+
+    def test_keep_digest(self):
+        """
+        重新计算已上传文件的信息时保留摘要
+        """
+        file = File(user=self.user, file=self.upload(b'hello'))
+        file.save()
+        file = File.objects.get(id=file.id)
+        file.set_info()
+        self.assertEqual(file.digest, hashlib.sha256(b'hello').hexdigest())
+
+    def test_deferred_file(self):
+        """
+        未加载文件字段的记录保存时不重新计算文件信息
+        """
+        file = File(user=self.user, file=self.upload(b'hello'))
+        file.save()
+        file = File.objects.only('id', 'filename').get(id=file.id)
+        file.filename = 'b.jpg'
+        file.save(update_fields=['filename'])
+        file = File.objects.get(id=file.id)
+        self.assertEqual((file.filename, file.byte_size), ('b.jpg', 5))
+        self.assertTrue(self.storage.exists(file.file.name))
+
+
+class FileDedupeTests(FileTestCase):
+    def create(self, content, name='a.jpg'):
+        file = File(user=self.user, file=self.upload(content, name))
+        file.save()
+        return file
+
+    def test_reuse(self):
+        """
+        内容和格式相同的文件共用同一个存储文件
+        """
+        first = self.create(b'same')
+        second = self.create(b'same', 'b.JPG')
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(second.filename, 'b.JPG')
+
+    def test_ext_in_key(self):
+        """
+        内容相同但格式不同时不共用
+        """
+        first = self.create(b'same')
+        second = self.create(b'same', 'a.png')
+        self.assertNotEqual(first.file.name, second.file.name)
+        self.assertTrue(second.file.name.endswith('.png'))
+
+    def test_delete_shared(self):
+        """
+        仍有记录引用时不删除存储文件 最后一条记录删除后删除
+        """
+        first = self.create(b'same')
+        second = self.create(b'same')
+        name = first.file.name
+        first.delete()
+        self.assertTrue(self.storage.exists(name))
+        second.delete()
+        self.assertFalse(self.storage.exists(name))
+
+    def test_change_file(self):
+        """
+        修改文件后释放不再被引用的原文件
+        """
+        file = self.create(b'old')
+        name = file.file.name
+        file.file = self.upload(b'new')
+        file.save()
+        self.assertFalse(self.storage.exists(name))
+        self.assertEqual(file.digest, hashlib.sha256(b'new').hexdigest())
+
+    def test_upload_outside_transaction(self):
+        """
+        上传文件时不在事务中
+        """
+        in_atomic = []
+        save = self.storage.save
+
+        def record(*args, **kwargs):
+            in_atomic.append(connection.in_atomic_block)
+            return save(*args, **kwargs)
+
+        with mock.patch.object(self.storage, 'save', record):
+            self.create(b'content')
+        self.assertEqual(in_atomic, [False])
+
+
+class FileBulkUploadTests(FileTestCase):
+    def test_bulk_upload(self):
+        """
+        批量上传 返回的记录与上传顺序一致 相同内容只上传一次
+        """
+        File(user=self.user, file=self.upload(b'stored', 'stored.jpg')).save()
+        uploads = [self.upload(b'same', '1.jpg'), self.upload(b'other', '2.jpg'),
+                   self.upload(b'same', '3.jpg'), self.upload(b'stored', '4.jpg')]
+        with mock.patch.object(self.storage, 'save', wraps=self.storage.save) as save:
+            instances = File.bulk_upload(uploads, self.user)
+        self.assertEqual(save.call_count, 2)
+        for instance, filename in zip(instances, ['1.jpg', '2.jpg', '3.jpg', '4.jpg']):
+            self.assertEqual(File.objects.get(id=instance.id).filename, filename)
+        self.assertEqual(instances[0].file.name, instances[2].file.name)
+        self.assertEqual(File.objects.filter(file=instances[3].file.name).count(), 2)
+
+    def test_bulk_upload_failed(self):
+        """
+        任一文件上传失败时删除本次上传的文件 不插入记录
+        """
+        save = self.storage.save
+
+        def fail(name, content, *args, **kwargs):
+            if content.read() == b'fail':
+                raise IOError('upload failed')
+            content.seek(0)
+            return save(name, content, *args, **kwargs)
+
+        with mock.patch.object(self.storage, 'save', fail), self.assertRaises(IOError):
+            File.bulk_upload([self.upload(b'ok'), self.upload(b'fail')], self.user)
+        self.assertEqual(File.objects.count(), 0)
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'file', hashlib.sha256(b'ok').hexdigest()[:2])),
+                         [])
+
+    def test_bulk_create_api(self):
+        """
+        批量上传接口
+        """
+        response = self.client.post(reverse('file-bulk-create'),
+                                    {'files': [self.upload(b'a', 'a.jpg'), self.upload(b'b', 'b.txt')]},
+                                    format='multipart')
+        data = self.data(response)
+        self.assertEqual([item['filename'] for item in data], ['a.jpg', 'b.txt'])
+        self.assertEqual([item['id'] for item in data],
+                         list(File.objects.filter(user=self.user).order_by('id').values_list('id', flat=True)))
+
+
+class FileThumbnailTests(FileTestCase):
+    @staticmethod
+    def image(color='red'):
+        output = BytesIO()
+        Image.new('RGB', (400, 300), color).save(output, 'PNG')
+        return output.getvalue()
+
+    def create(self, content):
+        file = File(user=self.user, file=self.upload(content, 'a.png'))
+        file.save()
+        return file
+
+    def test_keep_format(self):
+        """
+        缩略图地址使用生成时的格式 不随当前进程是否支持WebP变化
+        """
+        file = self.create(self.image())
+        with mock.patch('user.thumbnails.webp_supported', return_value=False):
+            File.generate_thumbnails(10)
+        file = File.objects.get(id=file.id)
+        self.assertEqual((file.thumbnail_state, file.thumbnail_ext), (2, 'jpg'))
+        for size in settings.THUMBNAIL_SIZES:
+            self.assertTrue(file.get_thumbnail_url(size).endswith('_{}.jpg'.format(size)))
+            self.assertTrue(self.storage.exists(get_thumbnail_name(file.file.name, size, 'jpg')))
+        # 内容相同的文件沿用已生成的缩略图
+        other = self.create(self.image())
+        File.generate_thumbnails(10)
+        self.assertEqual(File.objects.get(id=other.id).thumbnail_ext, 'jpg')
+
+    def test_delete(self):
+        """
+        删除最后一条引用时删除缩略图
+        """
+        file = self.create(self.image('blue'))
+        File.generate_thumbnails(10)
+        file = File.objects.get(id=file.id)
+        names = [get_thumbnail_name(file.file.name, size, file.thumbnail_ext) for size in settings.THUMBNAIL_SIZES]
+        self.assertTrue(all(self.storage.exists(name) for name in names))
+        file.delete()
+        self.assertFalse(any(self.storage.exists(name) for name in names))
+
+
+class FileUrlTests(FileTestCase):
+    def test_url_cache(self):
+        """
+        同一文件名只调用一次storage.url 序列化结果与build_absolute_uri一致
+        """
+        file = File(user=self.user, file=self.upload(b'url', '中文.txt'))
+        file.save()
+        request = APIRequestFactory().get('/file/')
+        with mock.patch.object(type(self.storage._wrapped), 'url', autospec=True,
+                               side_effect=type(self.storage._wrapped).url) as url:
+            data = FileInlineSerializer([file, file], many=True, context={'request': Request(request)}).data
+        self.assertEqual(url.call_count, 1)
+        self.assertEqual(data[0]['file'], request.build_absolute_uri(self.storage.url(file.file.name)))
+        self.assertEqual(data[1]['file'], data[0]['file'])
+
+
+class FileDirectUploadTests(FileTestCase):
+    def policy(self, filename='a.jpg', content=b'direct'):
+        response = self.client.post(reverse('file-policy'), {'filename': filename, 'size': len(content)},
+                                    format='json')
+        return self.data(response)
+
+    def post_form(self, data, content=b'direct', **fields):
+        form = dict(data['fields'], file=self.upload(content), **fields)
+        return APIClient().post(data['url'], form, format='multipart')
+
+    def test_reject_path(self):
+        """
+        文件名不能包含路径
+        """
+        for filename in ('../post/evil.jpg', '..\\evil.jpg'):
+            response = self.client.post(reverse('file-policy'), {'filename': filename, 'size': 1}, format='json')
+            self.assertEqual(response.data['code'], 1)
+            response = self.client.post(reverse('uploadsession-list'), {'filename': filename, 'size': 1},
+                                        format='json')
+            self.assertEqual(response.data['code'], 1)
+
+    def test_direct_upload(self):
+        """
+        按表单上传后确认生成文件记录
+        """
+        data = self.policy()
+        self.assertEqual(self.post_form(data).status_code, status.HTTP_201_CREATED)
+        file = self.data(self.client.post(reverse('file-confirm'), {'token': data['token']}, format='json'))
+        self.assertEqual(file['filename'], 'a.jpg')
+        instance = File.objects.get(id=file['id'])
+        self.assertEqual((instance.byte_size, instance.user), (6, self.user))
+
+    def test_tampered_form(self):
+        """
+        修改表单中的文件名或超过大小限制时拒绝上传
+        """
+        data = self.policy()
+        self.assertEqual(self.post_form(data, key='file/evil.jpg').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.post_form(data, content=b'x' * (settings.MAX_FILE_SIZE + 1)).status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+    def test_confirm_errors(self):
+        """
+        token无效、不属于当前用户、文件未上传时确认失败
+        """
+        data = self.policy()
+        self.assertEqual(self.client.post(reverse('file-confirm'), {'token': 'x'}, format='json').data['code'], 1)
+        self.assertEqual(self.client.post(reverse('file-confirm'), {'token': data['token']},
+                                          format='json').data['code'], 2)
+        other = APIClient()
+        other.force_authenticate(User.objects.create(username='other', tel='13800000009'))
+        self.post_form(data)
+        self.assertEqual(other.post(reverse('file-confirm'), {'token': data['token']}, format='json').data['code'], 1)
+
+    def test_direct_status(self):
+        """
+        只接受OSS支持的成功状态码
+        """
+        data = self.policy()
+        for value, code in (('200', 200), ('abc', 204), ('500', 204)):
+            self.assertEqual(self.post_form(data, success_action_status=value).status_code, code)
+
+    def test_direct_disabled(self):
+        """
+        存储支持直传时不提供本地直传
+        """
+        data = self.policy()
+        with mock.patch.object(type(self.storage._wrapped), 'get_post_policy', create=True):
+            self.assertEqual(self.post_form(data).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_confirm_twice(self):
+        """
+        重复确认返回同一文件 只生成一条记录
+        """
+        data = self.policy()
+        self.post_form(data)
+        first = self.data(self.client.post(reverse('file-confirm'), {'token': data['token']}, format='json'))
+        second = self.data(self.client.post(reverse('file-confirm'), {'token': data['token']}, format='json'))
+        self.assertEqual(first['id'], second['id'])
+        self.assertEqual(File.objects.filter(user=self.user).count(), 1)
+
+
+@override_settings(UPLOAD_PART_SIZE=4)
+class UploadSessionTests(FileTestCase):
+    def start(self, content, filename='a.jpg'):
+        response = self.client.post(reverse('uploadsession-list'), {'filename': filename, 'size': len(content)},
+                                    format='json')
+        return self.data(response)
+
+    def part(self, session, part_number, data, md5=None):
+        url = reverse('uploadsession-part', args=[session['upload_id']])
+        return self.client.post(url, {'part_number': part_number, 'md5': md5 or hashlib.md5(data).hexdigest(),
+                                      'file': self.upload(data, 'blob')}, format='multipart')
+
+    def complete(self, session):
+        return self.client.post(reverse('uploadsession-complete', args=[session['upload_id']]))
+
+    def test_upload(self):
+        """
+        分片全部上传后合并为一个文件 保留原文件名
+        """
+        content = b'0123456789'
+        session = self.start(content)
+        self.assertEqual(session['part_count'], 3)
+        for index in (3, 1, 2):
+            self.data(self.part(session, index, content[(index - 1) * 4:index * 4]))
+        with mock.patch.object(File, 'save', autospec=True, side_effect=File.save) as save:
+            file = self.data(self.complete(session))
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(file['filename'], 'a.jpg')
+        instance = File.objects.get(id=file['id'])
+        self.assertEqual((instance.filename, instance.ext, instance.byte_size), ('a.jpg', 'jpg', 10))
+        with self.storage.open(instance.file.name) as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(self.complete(session).data['code'], 2)
+        self.assertEqual(File.objects.count(), 1)
+
+    def test_resume(self):
+        """
+        查询会话得到已上传的分片 重传同一分片覆盖原分片 其他用户无法访问
+        """
+        content = b'0123456789'
+        session = self.start(content)
+        self.data(self.part(session, 2, b'xxxx'))
+        self.data(self.part(session, 1, content[:4]))
+        url = reverse('uploadsession-detail', args=[session['upload_id']])
+        self.assertEqual(self.data(self.client.get(url))['parts'], [1, 2])
+        self.data(self.part(session, 2, content[4:8]))
+        self.data(self.part(session, 3, content[8:]))
+        file = File.objects.get(id=self.data(self.complete(session))['id'])
+        with self.storage.open(file.file.name) as f:
+            self.assertEqual(f.read(), content)
+        other = APIClient()
+        other.force_authenticate(User.objects.create(username='other', tel='13800000009'))
+        self.assertEqual(other.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_part_errors(self):
+        """
+        分片大小错误、md5不符、分片未传完时失败
+        """
+        session = self.start(b'0123456789')
+        self.assertEqual(self.part(session, 1, b'012').data['code'], 3)
+        self.assertEqual(self.part(session, 1, b'0123', md5='0' * 32).data['code'], 4)
+        self.data(self.part(session, 1, b'0123'))
+        self.assertEqual(self.complete(session).data['code'], 3)
+        self.data(self.client.delete(reverse('uploadsession-detail', args=[session['upload_id']])))
+        self.assertEqual(self.part(session, 2, b'4567').data['code'], 2)
@@ -0,0 +1,144 @@
+import os
+import logging
+from io import BytesIO
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger("info")
+
+# 可以生成缩略图的图片格式 svg为矢量图 不处理
+THUMBNAIL_EXTS = ('jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp')
+
+# 缩略图格式对应的扩展名
+THUMBNAIL_FORMAT_EXTS = {'WEBP': 'webp', 'JPEG': 'jpg'}
+
+
+def has_thumbnails(name):
+    """
+    :param name: 文件名
+    :return: 文件是否可以生成缩略图
+    """
+    return os.path.splitext(name)[1][1:].lower() in THUMBNAIL_EXTS
+
+
+@lru_cache()
+def webp_supported():
+    """
+    :return: Pillow是否支持WebP 每个进程只检查一次
+    """
+    return features.check('webp')
+
+
+def get_thumbnail_format():
+    """
+    :return: 缩略图格式 Pillow不支持WebP时使用JPEG
+    """
+    if settings.THUMBNAIL_FORMAT == 'WEBP' and not webp_supported():
+        return 'JPEG'
+    return settings.THUMBNAIL_FORMAT
+
+
+def get_thumbnail_ext(fmt=None):
+    """
+    :param fmt: 缩略图格式 默认为当前进程使用的格式
+    :return: 缩略图扩展名
+    """
+    return THUMBNAIL_FORMAT_EXTS[fmt or get_thumbnail_format()]
+
+
+def get_thumbnail_name(name, size, ext):
+    """
+    缩略图与原文件存放在同一目录 如 file/ab/abcd.jpg 的small缩略图为 file/ab/abcd_small.webp
+    :param name: 原文件名
+    :param size: 缩略图尺寸名 见settings.THUMBNAIL_SIZES
+    :param ext: 缩略图扩展名 生成时记录在文件记录中 不随当前进程是否支持WebP变化
+    :return: 缩略图文件名
+    """
+    return '{}_{}.{}'.format(os.path.splitext(name)[0], size, ext)
+
+
+def delete_thumbnails(storage, name):
+    """
+    删除原文件的全部缩略图 引用记录已删除 不知道生成时的格式 各格式都删除
+    """
+    if name and has_thumbnails(name):
+        for size in settings.THUMBNAIL_SIZES:
+            for ext in THUMBNAIL_FORMAT_EXTS.values():
+                storage.delete(get_thumbnail_name(name, size, ext))
+
+
+def render_thumbnails(data, sizes, fmt, quality):
+    """
+    在子进程中执行 只依赖Pillow 不访问数据库与存储
+    按EXIF方向旋正后裁剪缩放到固定尺寸 输出不包含EXIF等元数据
+    :param data: 原图内容
+    :param sizes: {尺寸名: (宽, 高)}
+    :param fmt: 输出格式 WEBP/JPEG
+    :param quality: 输出质量
+    :return: {尺寸名: 缩略图内容}
+    """
+    image = Image.open(BytesIO(data))
+    # JPEG直接按缩小的比例解码 大图无需解码全部像素
+    image.draft('RGB', (max(width for width, height in sizes.values()),
+                        max(height for width, height in sizes.values())))
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha and fmt == 'WEBP' else 'RGB')
+    thumbnails = {}
+    for size, box in sizes.items():
+        thumbnail = ImageOps.fit(image, box, Image.LANCZOS)
+        # 不带原图的EXIF ICC等信息
+        thumbnail.info = {}
+        output = BytesIO()
+        thumbnail.save(output, fmt, quality=quality)
+        thumbnails[size] = output.getvalue()
+    return thumbnails
+
+
+# 生成缩略图的进程池 首次使用时创建
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(settings.THUMBNAIL_PROCESSES)
+    return _executor
+
+
+def generate_thumbnails(storage, names, fmt):
+    """
+    在进程池中为多个文件生成缩略图 并保存到原文件所在目录
+    :param storage: 文件存储
+    :param names: 原文件名列表
+    :param fmt: 缩略图格式 WEBP/JPEG
+    :return: {原文件名: 生成失败的异常} 全部成功时为空
+    """
+    ext = get_thumbnail_ext(fmt)
+    sizes = {size: tuple(box) for size, box in settings.THUMBNAIL_SIZES.items()}
+    futures = {}
+    errors = {}
+    for name in names:
+        try:
+            with storage.open(name, 'rb') as file:
+                data = file.read()
+            futures[name] = get_executor().submit(render_thumbnails, data, sizes, fmt, settings.THUMBNAIL_QUALITY)
+        except Exception as e:
+            errors[name] = e
+    for name, future in futures.items():
+        try:
+            for size, content in future.result().items():
+                thumbnail_name = get_thumbnail_name(name, size, ext)
+                # 本地存储遇到同名文件会改名 先删除
+                if storage.exists(thumbnail_name):
+                    storage.delete(thumbnail_name)
+                storage.save(thumbnail_name, ContentFile(content))
+        except Exception as e:
+            errors[name] = e
+    for name, error in errors.items():
+        logger.error('生成缩略图失败 文件：{} 原因：{}'.format(name, error))
+    return errors
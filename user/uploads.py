@@ -0,0 +1,133 @@
+import os
+import hmac
+import json
+import time
+import uuid
+import base64
+import shutil
+import hashlib
+
+from django.conf import settings
+from django.core.files import File as DjangoFile
+from django.utils.encoding import force_bytes
+
+
+class SpoolMultipartUpload(object):
+    """
+    不支持分片上传的存储(如本地FileSystemStorage)使用的分片上传
+    分片先写入本地暂存目录 完成时按序合并后保存到存储 接口与AliyunBaseStorage的分片上传一致
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @staticmethod
+    def _path(upload_id, *names):
+        return os.path.join(settings.UPLOAD_SPOOL_DIR, upload_id, *names)
+
+    def init_multipart_upload(self, name):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._path(upload_id))
+        return upload_id
+
+    def upload_part(self, name, upload_id, part_number, data, md5):
+        path = self._path(upload_id, '{}.part'.format(part_number))
+        # 先写临时文件再改名 重传分片时不会读到写了一半的分片
+        with open(path + '.tmp', 'wb') as part:
+            part.write(data)
+        os.replace(path + '.tmp', path)
+        return md5
+
+    def complete_multipart_upload(self, name, upload_id, parts):
+        path = self._path(upload_id, 'file')
+        with open(path, 'wb') as output:
+            for number, etag, size in parts:
+                with open(self._path(upload_id, '{}.part'.format(number)), 'rb') as part:
+                    shutil.copyfileobj(part, output)
+        with open(path, 'rb') as content:
+            name = self.storage.save(name, DjangoFile(content))
+        shutil.rmtree(self._path(upload_id), ignore_errors=True)
+        return name
+
+    def abort_multipart_upload(self, name, upload_id):
+        shutil.rmtree(self._path(upload_id), ignore_errors=True)
+
+
+def get_multipart_upload(storage):
+    """
+    :param storage: 文件存储
+    :return: 存储支持分片上传时返回存储本身 否则使用本地暂存目录
+    """
+    if hasattr(storage, 'init_multipart_upload'):
+        return storage
+    return SpoolMultipartUpload(storage)
+
+
+class LocalPostPolicy(object):
+    """
+    不支持直传的存储(如本地FileSystemStorage)使用的直传表单 模拟OSS的PostObject
+    表单使用SECRET_KEY签名 由FileViewSet.direct校验后保存 接口与AliyunBaseStorage.get_post_policy一致
+    """
+
+    def __init__(self, storage, url):
+        self.storage = storage
+        self.url = url
+
+    @staticmethod
+    def _sign(policy):
+        return base64.b64encode(hmac.new(force_bytes(settings.SECRET_KEY), force_bytes(policy),
+                                         hashlib.sha1).digest()).decode()
+
+    def get_post_policy(self, name, max_size, expire):
+        policy = base64.b64encode(json.dumps({
+            'expiration': int(time.time()) + expire,
+            'conditions': [
+                ['eq', '$key', name],
+                ['content-length-range', 1, max_size],
+            ],
+        }).encode()).decode()
+        return {
+            'url': self.url,
+            'fields': {
+                'key': name,
+                'policy': policy,
+                'Signature': self._sign(policy),
+                'success_action_status': '201',
+            },
+        }
+
+    @classmethod
+    def verify(cls, fields, size):
+        """
+        校验直传表单
+        :param fields: 上传的表单字段
+        :param size: 上传文件的字节数
+        :return: 校验通过时返回文件名 否则返回None
+        """
+        policy = fields.get('policy', '')
+        if not hmac.compare_digest(cls._sign(policy), fields.get('Signature', '')):
+            return None
+        try:
+            policy = json.loads(base64.b64decode(policy).decode())
+        except ValueError:
+            return None
+        if policy['expiration'] < time.time():
+            return None
+        key = fields.get('key')
+        for condition in policy['conditions']:
+            if condition[0] == 'eq' and condition[1] == '$key' and condition[2] != key:
+                return None
+            if condition[0] == 'content-length-range' and not condition[1] <= size <= condition[2]:
+                return None
+        return key
+
+
+def get_post_policy(storage, url):
+    """
+    :param storage: 文件存储
+    :param url: 本地直传地址 存储不支持直传时使用
+    :return: 存储支持直传时返回存储本身 否则使用本地模拟
+    """
+    if hasattr(storage, 'get_post_policy'):
+        return storage
+    return LocalPostPolicy(storage, url)
@@ -1,13 +1,19 @@
+import uuid
+import hashlib
 import logging
 
 from datetime import datetime
-from django.db import transaction
 from django.conf import settings
+from django.core import signing
+from django.core.urlresolvers import reverse
 from django.contrib.auth import authenticate, login, logout
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 
+from django.db import transaction
 from django.db.models import Q
-from rest_framework.decorators import list_route
+from rest_framework import status
+from rest_framework.decorators import list_route, detail_route
+from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.throttling import UserRateThrottle
 
@@ -15,7 +21,7 @@ from common.permissions import IsSelf, IsFileOwnerOrReadOnly
 from common.response import success_response, error_response
 from common.viewset import ModelViewSet, CreateModelMixin, HumanizationSerializerErrorsMixin, GenericViewSet
 from common.exception import VerifyError
-from common.utils import get_list
+from common.utils import get_list, get_time_filename, get_max_upload_size, sizeof_fmt, build_absolute_url
 
 from friend.models import Friend
 
@@ -23,6 +29,7 @@ from .serializers import *
 from .filters import *
 # from .signals import *
 from .utils import *
+from .uploads import get_multipart_upload, get_post_policy, LocalPostPolicy
 
 logger = logging.getLogger("info")
 
@@ -121,7 +128,7 @@ class UserViewSet(ModelViewSet):
                 user = serializer.create(serializer.validated_data)
                 user.refresh_im_token()
                 data = {'id': user.id, 'token': user.get_token(), 'im_token': user.get_im_token(),
-                        'name': user.get_full_name(), 'portal': request.build_absolute_uri(user.get_portrait())}
+                        'name': user.get_full_name(), 'portal': build_absolute_url(request, user.get_portrait())}
                 return success_response(data)
             else:
                 return error_response(1, self.humanize_errors(serializer))
@@ -178,7 +185,7 @@ class UserViewSet(ModelViewSet):
                     user.last_login = timezone.now()
                     user.save()
                     data = {'id': user.id, 'token': user.get_token(), 'im_token': user.get_im_token(),
-                            'name': user.get_full_name(), 'portal': request.build_absolute_uri(user.get_portrait())}
+                            'name': user.get_full_name(), 'portal': build_absolute_url(request, user.get_portrait())}
                     return success_response(data)
                 else:
                     return error_response(4, '该账号未激活')
@@ -405,25 +412,220 @@ class FileViewSet(ModelViewSet):
         else:
             return serializer.save()
 
+    # 批量上传 先校验全部文件 再并行上传 最后一次插入全部记录
     @list_route(methods=['POST'])
-    @transaction.atomic
     def bulk_create(self, request):
         errors = []
-        data = []
-        sid = transaction.savepoint()
+        uploads = []
         for file in get_list(request.data, 'files'):
             serializer = FileModifySerializer(data={'file': file})
             if serializer.is_valid():
-                instance = self.perform_create(serializer)
-                data.append(FileInlineSerializer(instance, context=self.get_serializer_context()).data)
+                uploads.append(serializer.validated_data['file'])
             else:
                 errors.append(self.humanize_errors(serializer))
-        if len(errors) == 0:
-            transaction.savepoint_commit(sid)
-            return success_response(data)
-        else:
-            transaction.savepoint_rollback(sid)
+        if len(errors) != 0:
             return error_response(1, errors)
+        user = request.user if request.user.is_authenticated else None
+        try:
+            instances = File.bulk_upload(uploads, user)
+        except Exception as e:
+            logger.error('批量上传失败 原因：{}'.format(e))
+            return error_response(2, '文件上传失败')
+        return success_response(FileInlineSerializer(instances, many=True, context=self.get_serializer_context()).data)
+
+    @staticmethod
+    def get_storage():
+        return File._meta.get_field('file').storage
+
+    # 申请直传表单 客户端按表单直接上传到OSS 文件内容不经过应用服务器
+    # Receive ----------------------------------
+    # filename: 文件名
+    # size: 文件大小(字节)
+    # Return -----------------------------------
+    # 200 url: 上传地址 fields: 表单字段(文件放在最后一个字段file中) token: 上传完成后确认用 400-1 数据格式错误
+    @list_route(methods=['POST'])
+    def policy(self, request):
+        serializer = UploadSessionCreateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return error_response(1, self.humanize_errors(serializer))
+        filename = serializer.validated_data['filename']
+        max_size = get_max_upload_size(filename)
+        name = 'file/{}'.format(get_time_filename(filename))
+        policy = get_post_policy(self.get_storage(), request.build_absolute_uri(reverse('file-direct')))
+        data = policy.get_post_policy(name, max_size, settings.UPLOAD_POLICY_EXPIRE)
+        data['token'] = signing.dumps({'name': name, 'user': request.user.id, 'filename': filename},
+                                      salt='user.File.policy')
+        return success_response(data)
+
+    # 确认直传 文件已上传到OSS后生成文件记录 重复确认返回同一文件
+    # Receive ----------------------------------
+    # token: 申请直传表单时返回的token
+    # Return -----------------------------------
+    # 200 文件信息 400-1 token无效或已过期 400-2 文件未上传 400-3 文件大小超过限制
+    @list_route(methods=['POST'])
+    def confirm(self, request):
+        try:
+            # 上传需在表单有效期内完成 确认留出同样长的余量
+            data = signing.loads(request.data.get('token', ''), salt='user.File.policy',
+                                 max_age=settings.UPLOAD_POLICY_EXPIRE * 2)
+        except signing.BadSignature:
+            return error_response(1, 'token无效或已过期')
+        if data['user'] != request.user.id:
+            return error_response(1, 'token无效或已过期')
+        with transaction.atomic():
+            # 锁定用户 同一用户的确认依次执行 重复提交不会生成两条记录
+            User.objects.select_for_update().filter(id=request.user.id).first()
+            file = File.objects.filter(user=request.user, file=data['name']).first()
+            if file is None:
+                storage = self.get_storage()
+                # 只读取文件元数据 不下载文件内容
+                if not storage.exists(data['name']):
+                    return error_response(2, '文件未上传')
+                max_size = get_max_upload_size(data['filename'])
+                if storage.size(data['name']) > max_size:
+                    storage.delete(data['name'])
+                    return error_response(3, '文件 {} 大小超过{}'.format(data['filename'], sizeof_fmt(max_size)))
+                file = File(user=request.user, file=data['name'], filename=data['filename'])
+                file.save()
+        return success_response(FileInlineSerializer(file, context=self.get_serializer_context()).data)
+
+    # 本地直传 存储不支持直传时模拟OSS的PostObject 表单签名即授权
+    # Receive ----------------------------------
+    # policy表单字段 file: 文件
+    # Return -----------------------------------
+    # 200/201/204 上传成功(同OSS 由success_action_status指定 默认204) 403 表单无效或已过期 404 存储支持直传
+    @list_route(methods=['POST'], permission_classes=[AllowAny], authentication_classes=[])
+    def direct(self, request):
+        storage = self.get_storage()
+        if not isinstance(get_post_policy(storage, ''), LocalPostPolicy):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        upload = request.FILES.get('file')
+        name = LocalPostPolicy.verify(request.data, upload.size) if upload else None
+        if name is None:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        if storage.exists(name):
+            storage.delete(name)
+        storage.save(name, upload)
+        success_status = request.data.get('success_action_status')
+        return Response(status=int(success_status) if success_status in ('200', '201', '204') else 204)
+
+
+# 分片上传 断线后查询已上传的分片 继续上传剩余分片
+class UploadSessionViewSet(HumanizationSerializerErrorsMixin, GenericViewSet):
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+    permission_classes = (IsAuthenticated,)
+    lookup_field = 'upload_id'
+
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user)
+
+    @staticmethod
+    def get_multipart_upload():
+        return get_multipart_upload(File._meta.get_field('file').storage)
+
+    # 需在事务中调用
+    def get_locked_object(self):
+        instance = self.get_object()
+        return self.get_queryset().select_for_update().get(id=instance.id)
+
+    # 开始分片上传
+    # Receive ----------------------------------
+    # filename: 文件名
+    # size: 文件大小(字节)
+    # Return -----------------------------------
+    # 200 会话信息(upload_id part_size part_count) 400-1 数据格式错误
+    def create(self, request, *args, **kwargs):
+        serializer = UploadSessionCreateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return error_response(1, self.humanize_errors(serializer))
+        filename = serializer.validated_data['filename']
+        name = 'file/{}'.format(get_time_filename(filename))
+        instance = UploadSession.objects.create(user=request.user,
+                                                upload_id=uuid.uuid4().hex,
+                                                backend_id=self.get_multipart_upload().init_multipart_upload(name),
+                                                name=name,
+                                                filename=filename,
+                                                size=serializer.validated_data['size'],
+                                                part_size=settings.UPLOAD_PART_SIZE)
+        return success_response(self.get_serializer(instance).data)
+
+    # 查询会话 parts为已上传的分片序号
+    def retrieve(self, request, *args, **kwargs):
+        return success_response(self.get_serializer(self.get_object()).data)
+
+    # 上传分片 同一分片可重复上传
+    # Receive ----------------------------------
+    # part_number: 分片序号 从1开始
+    # md5: 分片内容md5
+    # file: 分片内容
+    # Return -----------------------------------
+    # 200 上传成功 400-1 数据格式错误 400-2 会话已结束 400-3 分片大小错误 400-4 md5校验失败 400-5 上传失败
+    @detail_route(methods=['POST'])
+    def part(self, request, *args, **kwargs):
+        instance = self.get_object()
+        serializer = UploadPartSerializer(data=request.data)
+        if not serializer.is_valid():
+            return error_response(1, self.humanize_errors(serializer))
+        if instance.state != 0:
+            return error_response(2, '上传会话已结束')
+        part_number = serializer.validated_data['part_number']
+        if part_number > instance.part_count:
+            return error_response(1, '分片序号超出范围')
+        data = serializer.validated_data['file'].read()
+        if len(data) != instance.get_part_length(part_number):
+            return error_response(3, '分片大小应为{}字节'.format(instance.get_part_length(part_number)))
+        md5 = serializer.validated_data['md5'].lower()
+        if hashlib.md5(data).hexdigest() != md5:
+            return error_response(4, 'md5校验失败')
+        try:
+            etag = self.get_multipart_upload().upload_part(instance.name, instance.backend_id, part_number, data, md5)
+        except Exception as e:
+            logger.error('分片上传失败 原因：{}'.format(e))
+            return error_response(5, '分片上传失败')
+        UploadPart.objects.update_or_create(session=instance, part_number=part_number,
+                                            defaults={'size': len(data), 'md5': md5, 'etag': etag})
+        instance.save(update_fields=['update_time'])
+        return success_response('上传成功')
+
+    # 完成上传 合并分片并生成文件
+    # Return -----------------------------------
+    # 200 文件信息 400-2 会话已结束 400-3 分片未上传完 400-5 合并失败
+    @detail_route(methods=['POST'])
+    def complete(self, request, *args, **kwargs):
+        with transaction.atomic():
+            # 锁定会话 重复提交时只有一次能完成
+            instance = self.get_locked_object()
+            if instance.state != 0:
+                return error_response(2, '上传会话已结束')
+            parts = list(instance.parts.all())
+            if len(parts) != instance.part_count:
+                return error_response(3, '还有{}个分片未上传'.format(instance.part_count - len(parts)))
+            try:
+                name = self.get_multipart_upload().complete_multipart_upload(
+                    instance.name, instance.backend_id, [(part.part_number, part.etag, part.size) for part in parts])
+            except Exception as e:
+                logger.error('合并分片失败 原因：{}'.format(e))
+                return error_response(5, '合并分片失败')
+            file = File(user=request.user, file=name, filename=instance.filename)
+            file.save()
+            instance.file = file
+            instance.state = 1
+            instance.save()
+            instance.parts.all().delete()
+        return success_response(FileInlineSerializer(file, context=self.get_serializer_context()).data)
+
+    # 取消上传
+    def destroy(self, request, *args, **kwargs):
+        with transaction.atomic():
+            instance = self.get_locked_object()
+            if instance.state != 0:
+                return error_response(2, '上传会话已结束')
+            self.get_multipart_upload().abort_multipart_upload(instance.name, instance.backend_id)
+            instance.state = 2
+            instance.save()
+            instance.parts.all().delete()
+        return success_response('已取消')
 
 
 # 协议